@@ -0,0 +1,238 @@
+"""
+Caché semántica de respuestas para preguntas de catálogo/FAQ.
+Si una consulta no personalizada se parece lo suficiente (coseno >= umbral) a otra respondida
+hace poco, se devuelve la respuesta guardada sin lanzar el crew. La caché se vacía cuando cambia
+la versión del catálogo de Odoo o de la base de conocimientos.
+"""
+import os
+import re
+import threading
+import time
+from typing import Dict, List, Optional
+import numpy as np
+from config import (
+    ANSWER_CACHE_ENABLED, ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL_SECONDS,
+    ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_VERSION_CHECK_SECONDS
+)
+from logger import get_logger
+
+log = get_logger("answer_cache")
+
+AGENT_NAME = os.getenv("AGENT_NAME", "Sofía")
+TENANT_NAME = os.getenv("TENANT_NAME", "Tortillas Mejicanas")
+
+# Preguntas de catálogo / FAQ: lo único que se puede responder igual a cualquier cliente.
+# Sin "hay"/"tienen": la disponibilidad cambia con el stock y la versión del catálogo no lo sigue.
+_FAQ_PATTERN = re.compile(
+    r"\b(precios?|cu[aá]nto|cuesta|vale|valen|horarios?|abr[ií]s|abren|cierran|"
+    r"venden|vend[eé]is|productos?|cat[aá]logo|env[ií]os?|entregas?|reparto|ingredientes?|gluten|"
+    r"al[eé]rgenos?|caducidad|conservar|formas? de pago|pagar|d[oó]nde est[aá]is|ubicaci[oó]n)\b",
+    re.IGNORECASE,
+)
+
+# Cualquier señal de que la respuesta depende del cliente, del stock o de la conversación
+_PERSONAL_PATTERN = re.compile(
+    r"\b(quiero|quisiera|necesito|pedidos?|pedir|encargar|encargo|comprar|reservar?|reuni[oó]n|cita|"
+    r"agendar|mis?|me|m[ií]os?|facturas?|direcci[oó]n|cancelar|cambiar|estado)\b"
+    r"|\b\d+\s*(cajas?|packs?|uds?|unidades|bolsas?|botellas?|kg|kilos?)\b"
+    r"|\b(stock|disponibles?|disponibilidad|existencias|quedan?|agotad[oa]s?)\b"
+    r"|^(y|pero|entonces|vale|o|tambi[eé]n)\b",
+    re.IGNORECASE,
+)
+
+# Preguntas elípticas: se refieren a algo dicho antes ("¿Cuánto cuesta eso?", "¿Y la grande?")
+_DEICTIC_PATTERN = re.compile(
+    r"\b(eso|esa|ese|esos|esas|esto|esta|este|estos|estas|aquel\w*|ah[ií]|lo mismo|otr[oa]s?)\b"
+    r"|\b(el|la|los|las)\s+(grandes?|peque[ñn][oa]s?|median[oa]s?|de)\b"
+    r"|\b(venden|vend[eé]is|tienen|ten[eé]is|hay)\s+(de|del)\b"
+    r"|^(cu[aá]nto|qu[eé] precio)\s+(\w+\s+)?(cuesta|cuestan|vale|valen|sale|salen|tiene|tienen)$",
+    re.IGNORECASE,
+)
+
+# Presentación de la primera respuesta a un usuario nuevo (REGLA 1 del crew): no se sirve a otros
+_INTRO_PATTERN = re.compile(
+    rf"^\s*(¡?\s*(hola|buen[oa]s(\s+(d[ií]as|tardes|noches))?)\b[\s,.!]*)?(soy|me llamo)\s+{re.escape(AGENT_NAME)}\b"
+    rf"(\s*,?\s*(tu|su)\s+asistente(\s+virtual)?)?(\s+de\s+{re.escape(TENANT_NAME)})?"
+    r"[\s,.!:;\u2600-\u27BF\uFE0F\U0001F300-\U0001FAFF]*",
+    re.IGNORECASE,
+)
+
+
+def is_cacheable_question(message: str) -> bool:
+    """True si el mensaje es una pregunta genérica de catálogo/FAQ (no personalizada ni elíptica)."""
+    # Sin los signos de apertura/cierre: "¿Y cuánto valen?" empieza igual que "y cuánto valen"
+    text = message.strip().strip("¿?¡!.,;: ").strip()
+    if len(text.split()) < 2:
+        return False
+    if _PERSONAL_PATTERN.search(text) or _DEICTIC_PATTERN.search(text):
+        return False
+    return bool(_FAQ_PATTERN.search(text))
+
+
+def strip_introduction(reply: str) -> str:
+    """Quita la presentación de la secretaria del principio de la respuesta."""
+    return _INTRO_PATTERN.sub("", reply, count=1).strip()
+
+
+class SemanticAnswerCache:
+    """Pares (embedding normalizado, respuesta) con TTL, umbral de similitud y versión de catálogo."""
+
+    def __init__(self, threshold: float = 0.95, ttl_seconds: int = 3600, max_entries: int = 500) -> None:
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._vectors: List[np.ndarray] = []
+        self._entries: List[Dict] = []
+        self._matrix: Optional[np.ndarray] = None
+        self._version: Optional[str] = None
+        self._stats: Dict[str, int] = {"hits": 0, "misses": 0, "stores": 0, "invalidations": 0}
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> Optional[np.ndarray]:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else None
+
+    def _sync_version(self, version: str) -> None:
+        if version != self._version:
+            if self._entries:
+                self._stats["invalidations"] += 1
+                log.info("Answer cache invalidated: catalog/knowledge base changed")
+            self._vectors, self._entries, self._matrix = [], [], None
+            self._version = version
+
+    def _remove(self, indexes: List[int]) -> None:
+        for i in sorted(indexes, reverse=True):
+            del self._vectors[i]
+            del self._entries[i]
+        self._matrix = None
+
+    def _best_match(self, vector: np.ndarray) -> Optional[int]:
+        now = time.time()
+        self._remove([i for i, e in enumerate(self._entries) if now - e["created_at"] > self.ttl_seconds])
+        if not self._entries:
+            return None
+        if self._matrix is None:
+            self._matrix = np.vstack(self._vectors)
+        sims = self._matrix @ vector
+        best = int(np.argmax(sims))
+        return best if sims[best] >= self.threshold else None
+
+    def lookup(self, embedding: List[float], version: str) -> Optional[str]:
+        """Respuesta guardada para una consulta equivalente, o None."""
+        vector = self._normalize(embedding)
+        with self._lock:
+            self._sync_version(version)
+            best = self._best_match(vector) if vector is not None else None
+            if best is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            return self._entries[best]["reply"]
+
+    def store(self, embedding: List[float], reply: str, version: str) -> None:
+        """Guarda la respuesta; sustituye a la de una consulta equivalente si ya existía."""
+        vector = self._normalize(embedding)
+        if vector is None:
+            return
+        with self._lock:
+            self._sync_version(version)
+            best = self._best_match(vector)
+            if best is not None:
+                self._remove([best])
+            self._vectors.append(vector)
+            self._entries.append({"reply": reply, "created_at": time.time()})
+            if len(self._entries) > self.max_entries:
+                self._remove(list(range(len(self._entries) - self.max_entries)))
+            self._matrix = None
+            self._stats["stores"] += 1
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._sync_version(f"manual:{time.time()}")
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries))
+
+
+answer_cache = SemanticAnswerCache(ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_MAX_ENTRIES)
+
+_version_state: Dict = {"value": None, "checked_at": 0.0, "refreshing": False}
+_version_lock = threading.Lock()
+
+
+def _read_catalog_version() -> str:
+    from vector_index import get_kb_index
+    from tools_odoo import odoo
+
+    index = get_kb_index()
+    if index is not None:
+        kb_version = f"gen{index.generation}"
+    else:
+        from tools_supabase import supabase
+        res = supabase.table("kb_items").select("updated_at").order("updated_at", desc=True).limit(1).execute()
+        kb_version = res.data[0]["updated_at"] if res.data else "empty"
+    return f"kb:{kb_version}|odoo:{odoo.get_catalog_version()}"
+
+
+def _refresh_catalog_version() -> None:
+    try:
+        value = _read_catalog_version()
+    except Exception as e:
+        # Sin versión fiable la caché queda desactivada hasta la siguiente comprobación
+        log.warning(f"Catalog version refresh failed: {type(e).__name__}: {e}")
+        value = None
+    with _version_lock:
+        _version_state.update(value=value, checked_at=time.time(), refreshing=False)
+
+
+def current_catalog_version() -> Optional[str]:
+    """
+    Versión combinada de la base de conocimientos y del catálogo de Odoo.
+    Devuelve la última leída y, si tiene más de ANSWER_CACHE_VERSION_CHECK_SECONDS, la relee en un
+    hilo aparte: el turno nunca espera a Odoo ni a Supabase. None mientras no haya una versión válida.
+    """
+    with _version_lock:
+        stale = time.time() - _version_state["checked_at"] >= ANSWER_CACHE_VERSION_CHECK_SECONDS
+        if stale and not _version_state["refreshing"]:
+            _version_state["refreshing"] = True
+            threading.Thread(target=_refresh_catalog_version, name="catalog-version", daemon=True).start()
+        return _version_state["value"]
+
+
+def lookup_answer(message: str) -> Optional[str]:
+    """Respuesta cacheada para una pregunta FAQ equivalente; None si no aplica o no hay acierto."""
+    if not ANSWER_CACHE_ENABLED or not is_cacheable_question(message):
+        return None
+    version = current_catalog_version()
+    if version is None:
+        return None
+    try:
+        from embedding_cache import embed_query
+        return answer_cache.lookup(embed_query(message), version)
+    except Exception as e:
+        log.warning(f"Answer cache lookup failed: {type(e).__name__}: {e}")
+        return None
+
+
+def store_answer(message: str, reply: str, partner: Optional[Dict] = None) -> None:
+    """Guarda la respuesta (sin la presentación) si la pregunta es FAQ y el texto no contiene datos del cliente."""
+    if not ANSWER_CACHE_ENABLED or not is_cacheable_question(message):
+        return
+    reply = strip_introduction(reply or "")
+    if not reply or re.search(rf"\b(soy|me llamo)\s+{re.escape(AGENT_NAME)}\b", reply, re.IGNORECASE):
+        return
+    if partner:
+        personal = [partner.get(k) for k in ("name", "email", "phone", "street")]
+        if any(value and str(value).lower() in reply.lower() for value in personal):
+            return
+    version = current_catalog_version()
+    if version is None:
+        return
+    try:
+        from embedding_cache import embed_query
+        answer_cache.store(embed_query(message), reply, version)
+    except Exception as e:
+        log.warning(f"Answer cache store failed: {type(e).__name__}: {e}")
@@ -1,14 +1,15 @@
-from fastapi import FastAPI, Request, Response, BackgroundTasks
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 import sys
 import os
-import httpx
 import asyncio
 import hashlib
 import hmac
+import json
 import time
-from collections import defaultdict
-from typing import Dict
+import threading
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Tuple, Union
 from pydantic import BaseModel, field_validator, ValidationError
 
 from utils import normalize_phone
@@ -16,17 +17,52 @@ from utils import normalize_phone
 # Añadir el directorio raíz al path para importar los módulos locales
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from crew_logic import run_odoo_crew
 from config import (
     WHATSAPP_VERIFY_TOKEN, WHATSAPP_API_TOKEN,
     WHATSAPP_PHONE_NUMBER_ID, WHATSAPP_APP_SECRET,
-    API_SECRET_KEY, DEV_MODE
+    API_SECRET_KEY, DEV_MODE, WHATSAPP_DEBOUNCE_SECONDS, WHATSAPP_DEBOUNCE_MAX_SECONDS,
+    CREW_MAX_CONCURRENCY, CREW_MAX_QUEUE, CREW_PRELOAD,
+    RATE_LIMIT_DEFAULT, RATE_LIMIT_ROUTES, RATE_LIMIT_API_KEYS
 )
+from metrics import stream_latency, intent_latency, turn_latency, turn_usage
+from prefetch import get_prefetch_stats
+from tool_memo import get_tool_memo_stats
+from phone_mailbox import PhoneMailbox
+from crew_executor import BoundedExecutor, ExecutorSaturated, BUSY_MESSAGE
+from job_queue import build_job_queue
+from whatsapp_sender import whatsapp_sender
+from outbound_scheduler import outbound_scheduler
+from whatsapp_turn import _crew_logic, run_odoo_crew, process_whatsapp_message
+from state_backend import MemoryStateBackend, build_state_backend
 from logger import get_logger
 
 log = get_logger("api")
 
-app = FastAPI(title="Tortillas Mejicanas WhatsApp Agent API")
+# ==========================================
+# CARGA DIFERIDA DEL CREW
+# ==========================================
+# La API arranca sin crew_logic (ver whatsapp_turn): /api, /api/health y la verificación del webhook
+# responden al momento y el crew se carga en segundo plano al arrancar (CREW_PRELOAD) o en el primer turno.
+
+def _preload_crew() -> None:
+    started = time.perf_counter()
+    try:
+        _crew_logic()
+    except Exception as e:
+        log.error(f"Crew preload failed: {type(e).__name__}", exc_info=True)
+        return
+    log.info(f"Crew preloaded in {time.perf_counter() - started:.1f}s")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if CREW_PRELOAD:
+        threading.Thread(target=_preload_crew, name="crew-preload", daemon=True).start()
+    yield
+
+app = FastAPI(title="Tortillas Mejicanas WhatsApp Agent API", lifespan=lifespan)
+
+# Todos los turnos del crew pasan por aquí: concurrencia y cola acotadas
+crew_executor = BoundedExecutor(max_workers=CREW_MAX_CONCURRENCY, max_queue=CREW_MAX_QUEUE)
 
 # ==========================================
 # UTILIDADES DE SEGURIDAD
@@ -68,56 +104,96 @@ def _check_bearer_token(request: Request) -> bool:
     return auth == f"Bearer {API_SECRET_KEY}"
 
 # ==========================================
-# RATE LIMITER (In-Memory, por IP)
+# RATE LIMITER (por IP, ruta y API key)
 # ==========================================
 
+Limit = Tuple[int, float]
+
+def parse_rate_limits(spec: str) -> Dict[str, Limit]:
+    """'nombre=peticiones/segundos,...' → {nombre: (peticiones, segundos)}."""
+    limits: Dict[str, Limit] = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, limit = item.rpartition("=")
+        requests_, _, seconds = limit.partition("/")
+        limits[name.strip()] = (int(requests_), float(seconds))
+    return limits
+
 class RateLimiter:
-    """Rate limiter simple basado en ventana deslizante por IP."""
+    """
+    Rate limiter de ventana deslizante (contador O(1) por clave en el backend, compartido entre workers).
+    Cada ruta puede tener su propio límite; una API key con límite propio comparte cuota entre todas
+    sus IPs, el resto de peticiones se limitan por IP.
+    """
     
-    def __init__(self, max_requests: int = 10, window_seconds: int = 60):
+    def __init__(self, max_requests: int = 10, window_seconds: int = 60, backend=None,
+                 routes: Optional[Dict[str, Limit]] = None, api_keys: Optional[Dict[str, Limit]] = None):
         self.max_requests = max_requests
         self.window_seconds = window_seconds
-        self._requests: Dict[str, list] = defaultdict(list)
+        self.routes = routes or {}
+        # Las claves se guardan como hash: nunca llegan en claro al backend compartido
+        self._api_keys = {self._digest(key): limit for key, limit in (api_keys or {}).items()}
+        self._backend = backend if backend is not None else MemoryStateBackend()
+
+    @staticmethod
+    def _digest(api_key: str) -> str:
+        return hashlib.sha256(api_key.encode()).hexdigest()[:16]
     
-    def is_allowed(self, client_ip: str) -> bool:
-        """Devuelve True si la IP no ha excedido el límite."""
-        now = time.time()
-        # Limpiar timestamps viejos
-        self._requests[client_ip] = [
-            t for t in self._requests[client_ip]
-            if now - t < self.window_seconds
-        ]
-        if len(self._requests[client_ip]) >= self.max_requests:
-            return False
-        self._requests[client_ip].append(now)
-        return True
-
-rate_limiter = RateLimiter(max_requests=10, window_seconds=60)
+    def is_allowed(self, client_ip: str, route: str = "", api_key: str = "") -> bool:
+        """Devuelve True si la IP (o la API key con límite propio) no ha excedido el límite de la ruta."""
+        limit = self.routes.get(route, (self.max_requests, self.window_seconds))
+        identity = f"ip:{client_ip}"
+        digest = self._digest(api_key) if api_key else ""
+        if digest in self._api_keys:
+            limit, identity = self._api_keys[digest], f"key:{digest}"
+        return self._backend.hit(f"rate:{route}:{identity}", limit[0], limit[1])
+
+    async def is_allowed_async(self, client_ip: str, route: str = "", api_key: str = "") -> bool:
+        """is_allowed desde el event loop: con un backend que bloquea (SQLite/Redis) se consulta en un hilo."""
+        if not getattr(self._backend, "blocking", True):
+            return self.is_allowed(client_ip, route, api_key)
+        return await asyncio.to_thread(self.is_allowed, client_ip, route, api_key)
+
+# Un único backend para ambos: con STATE_BACKEND=sqlite/redis varios workers/hosts comparten límites y dedup
+state_backend = build_state_backend()
+
+_default_limit = parse_rate_limits(f"={RATE_LIMIT_DEFAULT}")[""]
+rate_limiter = RateLimiter(
+    max_requests=_default_limit[0], window_seconds=_default_limit[1], backend=state_backend,
+    routes=parse_rate_limits(RATE_LIMIT_ROUTES), api_keys=parse_rate_limits(RATE_LIMIT_API_KEYS)
+)
 
 # ==========================================
 # DEDUPLICACIÓN DE WEBHOOKS
 # ==========================================
 
 class MessageDedup:
-    """Previene el procesamiento duplicado de mensajes de WhatsApp."""
+    """Previene el procesamiento duplicado de mensajes de WhatsApp (marca atómica con caducidad en el backend)."""
     
-    def __init__(self, ttl_seconds: int = 300):
+    def __init__(self, ttl_seconds: int = 300, backend=None):
         self.ttl = ttl_seconds
-        self._seen: Dict[str, float] = {}
+        self._backend = backend if backend is not None else MemoryStateBackend()
     
     def is_duplicate(self, message_id: str) -> bool:
         """Devuelve True si el message_id ya fue procesado recientemente."""
-        now = time.time()
-        # Limpiar entradas expiradas periódicamente
-        if len(self._seen) > 1000:
-            self._seen = {k: v for k, v in self._seen.items() if now - v < self.ttl}
-        
-        if message_id in self._seen:
-            return True
-        self._seen[message_id] = now
-        return False
+        return not self._backend.claim(f"wamid:{message_id}", self.ttl)
+
+    def forget(self, message_id: str) -> None:
+        """Olvida un message_id (p. ej. si no se pudo encolar y Meta lo reintentará)."""
+        self._backend.release(f"wamid:{message_id}")
 
-message_dedup = MessageDedup(ttl_seconds=86400) # 24 horas
+    async def is_duplicate_async(self, message_id: str) -> bool:
+        """is_duplicate desde el event loop (en un hilo si el backend bloquea)."""
+        if not getattr(self._backend, "blocking", True):
+            return self.is_duplicate(message_id)
+        return await asyncio.to_thread(self.is_duplicate, message_id)
+
+    async def forget_async(self, message_id: str) -> None:
+        """forget desde el event loop (en un hilo si el backend bloquea)."""
+        if not getattr(self._backend, "blocking", True):
+            return self.forget(message_id)
+        await asyncio.to_thread(self.forget, message_id)
+
+message_dedup = MessageDedup(ttl_seconds=86400, backend=state_backend) # 24 horas
 
 # ==========================================
 # HEALTH CHECK
@@ -145,23 +221,45 @@ def debug_env():
         "DEV_MODE": DEV_MODE
     }
 
+HEALTH_CHECK_TIMEOUT = 5.0
+
+async def _check_supabase() -> None:
+    """Consulta mínima a la REST API de Supabase con httpx (sin importar el SDK ni el crew)."""
+    import httpx
+    from config import SUPABASE_URL, SUPABASE_KEY
+    async with httpx.AsyncClient(timeout=HEALTH_CHECK_TIMEOUT) as client:
+        response = await client.get(
+            f"{SUPABASE_URL.rstrip('/')}/rest/v1/organizations",
+            params={"select": "id", "limit": "1"},
+            headers={"apikey": SUPABASE_KEY, "Authorization": f"Bearer {SUPABASE_KEY}"},
+        )
+    response.raise_for_status()
+
+_health_odoo = None
+
+def _check_odoo() -> None:
+    """Autenticación XML-RPC con un OdooClient propio (odoo_client no arrastra CrewAI como tools_odoo)."""
+    global _health_odoo
+    if _health_odoo is None:
+        from odoo_client import OdooClient
+        _health_odoo = OdooClient()
+    _health_odoo._ensure_authenticated()
+
 @app.get("/api/health")
 async def health_check():
-    """Health check con estado de dependencias externas."""
+    """Health check con estado de dependencias externas (sin cargar el crew)."""
     checks = {"api": "ok"}
     
     # Check Supabase
     try:
-        from tools_supabase import supabase
-        supabase.table("organizations").select("id").limit(1).execute()
+        await _check_supabase()
         checks["supabase"] = "ok"
     except Exception:
         checks["supabase"] = "error"
     
-    # Check Odoo
+    # Check Odoo (XML-RPC es bloqueante: fuera del event loop)
     try:
-        from tools_odoo import odoo
-        odoo._ensure_authenticated()
+        await asyncio.wait_for(asyncio.to_thread(_check_odoo), HEALTH_CHECK_TIMEOUT)
         checks["odoo"] = "ok"
     except Exception:
         checks["odoo"] = "error"
@@ -172,6 +270,26 @@ async def health_check():
         content={"status": "healthy" if all_ok else "degraded", "checks": checks}
     )
 
+@app.get("/api/metrics")
+async def metrics(request: Request):
+    """Percentiles en proceso (ventana deslizante): desglose por turno, intención, streaming y pool."""
+    if not _check_bearer_token(request):
+        return JSONResponse(status_code=401, content={"error": "No autorizado"})
+    return {
+        "turn_latency": turn_latency.snapshot(),
+        "turn_usage": turn_usage.snapshot(),
+        "intent_latency": intent_latency.snapshot(),
+        "stream_latency": stream_latency.snapshot(),
+        "crew_pool": sys.modules["crew_logic"].crew_pool.stats() if "crew_logic" in sys.modules else None,
+        "prefetch": get_prefetch_stats(),
+        "tool_memo": get_tool_memo_stats(),
+        "whatsapp_mailbox": whatsapp_mailbox.stats(),
+        "crew_executor": crew_executor.stats(),
+        "inbound_queue": inbound_queue.stats() if inbound_queue is not None else None,
+        "whatsapp_sender": whatsapp_sender.stats(),
+        "outbound": outbound_scheduler.stats(),
+    }
+
 # ==========================================
 # ENDPOINT DE CHAT GENÉRICO (Pruebas Web)
 # ==========================================
@@ -195,37 +313,116 @@ class ChatRequest(BaseModel):
             raise ValueError("Falta el mensaje")
         return clean
 
-@app.post("/api/chat")
-async def chat(request: Request):
+async def _chat_preflight(request: Request) -> Union[ChatRequest, JSONResponse]:
+    """Autenticación, rate limiting y validación comunes a /api/chat y /api/chat/stream."""
     # --- Autenticación ---
     if not _check_bearer_token(request):
         return JSONResponse(status_code=401, content={"error": "No autorizado"})
     
     # --- Rate Limiting ---
     client_ip = request.client.host if request.client else "unknown"
-    if not rate_limiter.is_allowed(client_ip):
+    api_key = request.headers.get("Authorization", "").removeprefix("Bearer ")
+    if not await rate_limiter.is_allowed_async(client_ip, route=request.url.path, api_key=api_key):
         log.warning(f"Rate limit exceeded for IP {client_ip[:8]}***")
         return JSONResponse(status_code=429, content={"error": "Demasiadas peticiones. Intenta en un minuto."})
     
+    data = await request.json()
     try:
-        data = await request.json()
-        try:
-            chat_req = ChatRequest(**data)
-        except ValidationError as ve:
-            error_msgs = [err.get("msg") for err in ve.errors()]
-            return JSONResponse(status_code=400, content={"error": " | ".join(error_msgs)})
+        return ChatRequest(**data)
+    except ValidationError as ve:
+        error_msgs = [err.get("msg") for err in ve.errors()]
+        return JSONResponse(status_code=400, content={"error": " | ".join(error_msgs)})
+
+@app.post("/api/chat")
+async def chat(request: Request):
+    try:
+        chat_req = await _chat_preflight(request)
+        if isinstance(chat_req, JSONResponse):
+            return chat_req
             
         session_id = chat_req.session_id
         message = chat_req.message
         
-        # Ejecutar en hilo separado para no bloquear el event loop
-        result = await asyncio.to_thread(run_odoo_crew, session_id, message)
+        # Ejecutar en el ejecutor acotado para no bloquear el event loop
+        try:
+            future = crew_executor.submit(run_odoo_crew, session_id, message)
+        except ExecutorSaturated:
+            return JSONResponse(status_code=503, content={"error": BUSY_MESSAGE}, headers={"Retry-After": "30"})
+        result = await asyncio.wrap_future(future)
         
         return {"reply": str(result), "session_id": session_id}
     except Exception as e:
         log.error(f"/api/chat error: {type(e).__name__}", exc_info=True)
         return JSONResponse(status_code=500, content={"error": "Error interno del servidor."})
 
+def _sse(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/api/chat/stream")
+async def chat_stream(request: Request):
+    """
+    Variante de /api/chat con Server-Sent Events. Eventos:
+    - status: {"stage": "received" | "thinking"} (el primero sale al instante)
+    - tool:   {"status": "started" | "finished" | "error", "label", "tool"}
+    - token:  {"text"} fragmentos de la respuesta según se generan (provisionales)
+    - done:   {"reply", "session_id"} respuesta final completa (la que se guarda en el historial)
+    """
+    try:
+        chat_req = await _chat_preflight(request)
+        if isinstance(chat_req, JSONResponse):
+            return chat_req
+    except Exception as e:
+        log.error(f"/api/chat/stream error: {type(e).__name__}", exc_info=True)
+        return JSONResponse(status_code=500, content={"error": "Error interno del servidor."})
+
+    session_id = chat_req.session_id
+    message = chat_req.message
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+
+    def emit(event: Dict) -> None:
+        # Llamado desde el hilo del crew (y del pool del bus de eventos)
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    try:
+        future = crew_executor.submit(run_odoo_crew, session_id, message, emit)
+    except ExecutorSaturated:
+        return JSONResponse(status_code=503, content={"error": BUSY_MESSAGE}, headers={"Retry-After": "30"})
+
+    async def run_turn() -> None:
+        try:
+            reply = await asyncio.wrap_future(future)
+            events.put_nowait({"type": "done", "reply": str(reply), "session_id": session_id})
+        except Exception as e:
+            log.error(f"/api/chat/stream turn error: {type(e).__name__}", exc_info=True)
+            events.put_nowait({"type": "error", "error": "Error interno del servidor."})
+
+    async def event_stream():
+        started = time.perf_counter()
+        first_token: Optional[float] = None
+        yield _sse("status", {"stage": "received"})
+        turn = asyncio.create_task(run_turn())
+        while True:
+            event = await events.get()
+            kind = event.pop("type")
+            if kind == "token" and first_token is None:
+                first_token = time.perf_counter() - started
+                stream_latency.record("first_token", first_token)
+            yield _sse(kind, event)
+            if kind in ("done", "error"):
+                break
+        await turn
+        total = time.perf_counter() - started
+        stream_latency.record("turn", total)
+        ttft = f"{first_token * 1000:.0f} ms" if first_token is not None else "n/a"
+        log.info(f"/api/chat/stream completed: first token {ttft}, total {total * 1000:.0f} ms")
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # ==========================================
 # ENDPOINTS WHATSAPP CLOUD API
 # ==========================================
@@ -246,54 +443,31 @@ async def verify_webhook(request: Request):
     return Response(content="OK", status_code=200)
 
 
-async def send_whatsapp_message(phone_number: str, message_text: str) -> None:
-    """Envía una respuesta de texto usando la Graph API de WhatsApp."""
-    if not WHATSAPP_API_TOKEN or not WHATSAPP_PHONE_NUMBER_ID:
-        log.warning("WhatsApp credentials missing")
-        return
+async def run_on_crew_executor(fn, *args):
+    """Ejecuta una función bloqueante en el ejecutor acotado del crew y la espera sin ocupar el loop."""
+    return await asyncio.wrap_future(crew_executor.submit(fn, *args))
 
-    url = f"https://graph.facebook.com/v19.0/{WHATSAPP_PHONE_NUMBER_ID}/messages"
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_API_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "messaging_product": "whatsapp",
-        "recipient_type": "individual",
-        "to": phone_number.replace("+", ""), 
-        "type": "text",
-        "text": {"body": message_text}
-    }
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.post(url, headers=headers, json=payload)
-            if response.status_code in [200, 201]:
-                log.info(f"WhatsApp message sent to {_mask_phone(phone_number)}")
-            else:
-                log.error(f"WhatsApp send failed: HTTP {response.status_code}")
-        except Exception as e:
-            log.error(f"WhatsApp HTTP error: {type(e).__name__}")
+async def run_whatsapp_turn(phone_number: str, user_message: str) -> None:
+    """
+    Turno del buzón como corrutina en el event loop: historial, resumen y contacto (Supabase/Odoo
+    asíncronos), guardados y envío de la respuesta no ocupan hilos. Solo crew.kickoff() pasa por el
+    ejecutor acotado, porque CrewAI ejecuta las herramientas de forma síncrona incluso en akickoff():
+    en el event loop bloquearían a todo el servidor. Si el ejecutor está saturado se avisa al usuario.
+    """
+    await process_whatsapp_message(phone_number, user_message, run_on_crew_executor)
 
 
-def process_whatsapp_message(phone_number: str, user_message: str) -> None:
-    """Función síncrona que ejecuta CrewAI y envía la respuesta. Corre en BackgroundTasks."""
-    log.info(f"Processing message from {_mask_phone(phone_number)}")
-    
-    try:
-        result = run_odoo_crew(session_id=phone_number, user_message=user_message)
-        final_text = str(result)
-        asyncio.run(send_whatsapp_message(phone_number, final_text))
-    except Exception as e:
-        log.error(f"CrewAI error: {type(e).__name__}", exc_info=True)
-        error_msg = ("Disculpa, estoy experimentando dificultades técnicas. "
-                     "Por favor, inténtalo de nuevo en unos minutos. 🙏")
-        asyncio.run(send_whatsapp_message(phone_number, error_msg))
+# Un turno a la vez por teléfono; las ráfagas se agrupan en un solo turno
+whatsapp_mailbox = PhoneMailbox(run_whatsapp_turn, WHATSAPP_DEBOUNCE_SECONDS, WHATSAPP_DEBOUNCE_MAX_SECONDS)
+
+# Con JOB_QUEUE_BACKEND el webhook solo encola (duradero) y los turnos los ejecuta queue_worker.py
+inbound_queue = build_job_queue()
 
 
 @app.post("/api/whatsapp")
-async def receive_whatsapp(request: Request, background_tasks: BackgroundTasks):
-    """Recibe mensajes POST desde Meta. Valida firma, deduplica, y procesa en background."""
+async def receive_whatsapp(request: Request):
+    """Recibe mensajes POST desde Meta. Valida firma, deduplica y encola (cola duradera o buzón del teléfono)."""
     try:
         body_bytes = await request.body()
         
@@ -340,7 +514,7 @@ async def receive_whatsapp(request: Request, background_tasks: BackgroundTasks):
                                 continue
                             
                             # --- Deduplicación en memoria ---
-                            if message_id and message_dedup.is_duplicate(message_id):
+                            if message_id and await message_dedup.is_duplicate_async(message_id):
                                 log.info(f"Duplicate message {message_id[:8]}*** skipped")
                                 continue
                             
@@ -349,7 +523,19 @@ async def receive_whatsapp(request: Request, background_tasks: BackgroundTasks):
                                 if not msg_text:
                                     log.warning("Received text message without body. Skipping.")
                                     continue
-                                background_tasks.add_task(process_whatsapp_message, phone_number, msg_text)
+                                if inbound_queue is None:
+                                    whatsapp_mailbox.post(phone_number, msg_text)
+                                    continue
+                                try:
+                                    # SQLite (BEGIN IMMEDIATE con espera) o Redis (red): fuera del event loop
+                                    await asyncio.to_thread(inbound_queue.enqueue, phone_number,
+                                                            {"text": msg_text, "message_id": message_id})
+                                except Exception as e:
+                                    # Sin 200, Meta reintenta el webhook: el mensaje no se pierde
+                                    log.error(f"Inbound queue enqueue failed: {type(e).__name__}: {e}")
+                                    if message_id:
+                                        await message_dedup.forget_async(message_id)
+                                    return Response(status_code=503)
                             
         return Response(status_code=200)
 
@@ -0,0 +1,193 @@
+"""
+Benchmark del camino webhook → turno → respuesta: conversaciones concurrentes que aguanta un worker.
+Ejecutar con: python bench_async_pipeline.py [--conversations 10,100,1000] [--crew-seconds 2.0]
+
+Ejecuta el turno real de la API (api.index.run_whatsapp_turn detrás de un PhoneMailbox): contexto,
+guardados y envío como corrutinas y solo crew.kickoff() en el ejecutor acotado. Lo único simulado es
+la red, con la latencia de cada servicio:
+- Supabase: cliente asíncrono falso cuyas consultas esperan --db-ms (asyncio.sleep, como un socket).
+- Odoo: XML-RPC real de OdooClient sobre un transporte httpx que responde tras --odoo-ms.
+- Graph API: WhatsAppSender real sobre un transporte httpx que responde tras --graph-ms.
+- Crew: _kickoff bloquea su hilo del ejecutor --crew-seconds, como un crew dominado por la espera
+  al LLM (las llamadas de CrewAI a OpenAI son síncronas).
+La caché de respuestas y la actualización del resumen (LLM en segundo plano) se desactivan.
+
+Para cada nivel de concurrencia cada conversación escribe una ráfaga de --messages mensajes y mide:
+- Turnos completados, respuestas "estamos ocupados" y turnos por segundo
+- Latencia del primer mensaje hasta la entrega de la respuesta (p50 / p99)
+- Hilos vivos como máximo (ni el buzón ni el contexto añaden hilos por conversación)
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Configuración mínima para importar la API sin credenciales reales; no se abre ninguna conexión
+for _key, _value in {"OPENAI_API_KEY": "bench", "SUPABASE_URL": "http://127.0.0.1:9", "SUPABASE_KEY": "bench",
+                     "ODOO_URL": "http://127.0.0.1:9", "ODOO_DB": "bench", "ODOO_USERNAME": "bench",
+                     "ANSWER_CACHE_ENABLED": "false"}.items():
+    os.environ.setdefault(_key, _value)
+
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import threading
+import time
+import xmlrpc.client
+from typing import Dict, List
+from unittest.mock import patch
+
+import httpx
+
+import api.index as api_index
+import crew_logic
+import tools_supabase
+import whatsapp_turn
+from crew_executor import BoundedExecutor, BUSY_MESSAGE
+from outbound_scheduler import OutboundScheduler
+from phone_mailbox import PhoneMailbox
+from whatsapp_sender import WhatsAppSender
+
+MESSAGE = "¿Me preparáis un pedido de 3 cajas de tortillas de maíz para el viernes?"
+
+
+class FakeSupabaseQuery:
+    """Consulta encadenable de supabase-py; execute() espera la latencia de la base de datos."""
+
+    def __init__(self, table: str, latency: float) -> None:
+        self.table = table
+        self.latency = latency
+        self.op = "select"
+
+    def insert(self, row):
+        self.op = "insert"
+        return self
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    async def execute(self):
+        await asyncio.sleep(self.latency)
+        if self.op == "insert" or self.table in ("organizations", "leads"):
+            return type("Response", (), {"data": [{"id": f"{self.table}-1"}]})
+        return type("Response", (), {"data": []})
+
+
+class FakeSupabase:
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+
+    def table(self, name: str) -> FakeSupabaseQuery:
+        return FakeSupabaseQuery(name, self.latency)
+
+
+def odoo_transport(latency: float) -> httpx.AsyncBaseTransport:
+    """Odoo simulado: autentica y encuentra un cliente por teléfono tras 'latency' segundos."""
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(latency)
+        params, method = xmlrpc.client.loads(request.content)
+        if method == "authenticate":
+            result = 2
+        elif params[4] == "search":
+            result = [7]
+        else:
+            result = [{"id": 7, "name": "Bar La Taquería", "email": "", "phone": "", "street": "C/ Mayor 1"}]
+        return httpx.Response(200, content=xmlrpc.client.dumps((result,), methodresponse=True))
+    return httpx.MockTransport(handler)
+
+
+def graph_transport(latency: float, delivered: Dict[str, List]) -> httpx.AsyncBaseTransport:
+    """Graph API simulada: acepta todo y anota cuándo llegó cada respuesta."""
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(latency)
+        payload = json.loads(request.content)
+        delivered.setdefault(payload["to"], []).append((time.perf_counter(), payload["text"]["body"]))
+        return httpx.Response(200, json={"messages": [{"id": f"wamid.{len(delivered)}"}]})
+    return httpx.MockTransport(handler)
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)] if values else 0.0
+
+
+async def run_level(conversations: int, args) -> Dict:
+    delivered: Dict[str, List] = {}
+    sender = WhatsAppSender(token="bench", phone_number_id="bench",
+                            transport=graph_transport(args.graph_ms / 1000, delivered))
+    scheduler = OutboundScheduler(sender, rate=10_000, burst=10_000, recipient_rate=100, recipient_burst=100)
+    executor = BoundedExecutor(max_workers=args.workers, max_queue=args.queue, name="bench-crew")
+    odoo_http = httpx.AsyncClient(transport=odoo_transport(args.odoo_ms / 1000))
+    crew_odoo = crew_logic.odoo
+    kickoffs = {"count": 0}
+
+    def kickoff(*_args, **_kwargs) -> str:
+        kickoffs["count"] += 1
+        time.sleep(args.crew_seconds)
+        return "¡Hecho! Te preparo el pedido para el viernes."
+
+    with patch.object(tools_supabase, "get_async_supabase", return_value=FakeSupabase(args.db_ms / 1000)), \
+            patch.object(crew_odoo, "_async_client", return_value=odoo_http), \
+            patch.object(crew_odoo, "uid", None), \
+            patch.object(crew_logic, "_kickoff", kickoff), \
+            patch.object(crew_logic, "schedule_summary_update", lambda *a: None), \
+            patch.object(whatsapp_turn, "outbound_scheduler", scheduler), \
+            patch.object(api_index, "crew_executor", executor), \
+            patch.dict(tools_supabase._tenant_id_cache, clear=True), \
+            patch.dict(tools_supabase._lead_id_cache, clear=True):
+        mailbox = PhoneMailbox(api_index.run_whatsapp_turn, debounce_seconds=args.debounce,
+                               max_wait_seconds=args.debounce * 4)
+        peak_threads = threading.active_count()
+        started: Dict[str, float] = {}
+        t0 = time.perf_counter()
+        for i in range(conversations):
+            phone = f"+34600{i:06d}"
+            started[phone] = time.perf_counter()
+            for m in range(args.messages):
+                mailbox.post(phone, f"{MESSAGE} ({m})")
+        while len(delivered) < conversations:
+            peak_threads = max(peak_threads, threading.active_count())
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - t0
+    await odoo_http.aclose()
+    latencies = [delivered[phone.lstrip("+")][0][0] - t for phone, t in started.items()]
+    busy = sum(1 for replies in delivered.values() if replies[0][1] == BUSY_MESSAGE)
+    return {
+        "conversations": conversations,
+        "turns": kickoffs["count"],
+        "busy": busy,
+        "turns_per_s": kickoffs["count"] / elapsed,
+        "p50": statistics.median(latencies),
+        "p99": _percentile(latencies, 99),
+        "peak_threads": peak_threads,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Conversaciones concurrentes por worker (turno real, red simulada)")
+    parser.add_argument("--conversations", default="10,100,1000", help="niveles de concurrencia, separados por comas")
+    parser.add_argument("--messages", type=int, default=3, help="mensajes por ráfaga de cada conversación")
+    parser.add_argument("--crew-seconds", type=float, default=2.0, help="espera al LLM de un crew.kickoff()")
+    parser.add_argument("--db-ms", type=float, default=40.0, help="latencia de cada consulta a Supabase")
+    parser.add_argument("--odoo-ms", type=float, default=150.0, help="latencia de cada llamada XML-RPC a Odoo")
+    parser.add_argument("--graph-ms", type=float, default=120.0, help="latencia de la Graph API de WhatsApp")
+    parser.add_argument("--workers", type=int, default=8, help="turnos del crew en paralelo (CREW_MAX_CONCURRENCY)")
+    parser.add_argument("--queue", type=int, default=1000, help="turnos en espera (CREW_MAX_QUEUE)")
+    parser.add_argument("--debounce", type=float, default=0.2, help="ventana de debounce del buzón")
+    args = parser.parse_args()
+
+    # El primer turno importaría el crew (varios segundos): se carga antes de medir. Sin logs por paso
+    whatsapp_turn._crew_logic()
+    logging.disable(logging.INFO)
+    print(f"crew={args.crew_seconds}s db={args.db_ms:.0f}ms odoo={args.odoo_ms:.0f}ms graph={args.graph_ms:.0f}ms "
+          f"workers={args.workers} queue={args.queue} messages/burst={args.messages}")
+    print(f"{'convs':>6} {'turns':>6} {'busy':>5} {'turns/s':>8} {'p50 s':>7} {'p99 s':>7} {'threads':>8}")
+    for level in (int(x) for x in args.conversations.split(",")):
+        r = asyncio.run(run_level(level, args))
+        print(f"{r['conversations']:>6} {r['turns']:>6} {r['busy']:>5} {r['turns_per_s']:>8.1f} "
+              f"{r['p50']:>7.2f} {r['p99']:>7.2f} {r['peak_threads']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Benchmark A/B de los modos del crew (two_task vs single_task).
+Ejecutar con: python bench_crew_modes.py [--runs 3] [--phone +34600000000]
+
+Para cada mensaje de muestra y cada modo lanza el crew real (mismas credenciales que producción)
+y mide:
+- Latencia de crew.kickoff()
+- Tokens (prompt / completion / total) y llamadas LLM, como delta del contador de cada LLM
+- Llamadas a herramientas (eventos ToolUsageFinished / ToolUsageError)
+
+No guarda mensajes en Supabase ni toca el resumen; las herramientas de acción (pedidos, reuniones)
+SÍ se ejecutan si el modelo decide usarlas, así que usa mensajes de consulta o un Odoo de pruebas.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import argparse
+import statistics
+import threading
+import time
+from typing import Dict, List
+
+from crewai import Crew, Process
+from crewai.events import crewai_event_bus, ToolUsageFinishedEvent, ToolUsageErrorEvent
+
+from crew_logic import create_tasks, crew_pool
+
+MODES = ("two_task", "single_task")
+
+SAMPLE_MESSAGES = [
+    "hola",
+    "¿Qué precio tienen las tortillas de maíz?",
+    "¿Tenéis totopos y salsa verde?",
+    "Quiero hacer un pedido de tortillas de trigo",
+    "¿Podemos agendar una reunión la semana que viene?",
+]
+
+CRM_CONTEXT = (
+    "IDENTIDAD DEL USUARIO: Es un usuario NUEVO (no está en el CRM). "
+    "NO TIENES su nombre, ni su email, ni su dirección. SOLO su teléfono actual."
+)
+
+_tool_calls = {"count": 0}
+_tool_lock = threading.Lock()
+
+
+@crewai_event_bus.on(ToolUsageFinishedEvent)
+def _on_tool_finished(source, event):
+    with _tool_lock:
+        _tool_calls["count"] += 1
+
+
+@crewai_event_bus.on(ToolUsageErrorEvent)
+def _on_tool_error(source, event):
+    with _tool_lock:
+        _tool_calls["count"] += 1
+
+
+def _usage(agents) -> Dict[str, int]:
+    """Suma de los contadores acumulados de los LLM de los agentes."""
+    totals = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "successful_requests": 0}
+    seen = set()
+    for agent in agents:
+        if id(agent.llm) in seen or not hasattr(agent.llm, "get_token_usage_summary"):
+            continue
+        seen.add(id(agent.llm))
+        summary = agent.llm.get_token_usage_summary()
+        for key in totals:
+            totals[key] += getattr(summary, key, 0)
+    return totals
+
+
+def run_once(mode: str, phone: str, message: str) -> Dict[str, float]:
+    with crew_pool.lease() as bundle:
+        agents = bundle.agents
+        tasks = create_tasks(phone, message, "No hay historial previo de conversación.", CRM_CONTEXT,
+                             mode=mode, agent=bundle.secretary_agent)
+        crew = Crew(agents=agents, tasks=tasks, process=Process.sequential, verbose=False)
+
+        usage_before = _usage(agents)
+        with _tool_lock:
+            tools_before = _tool_calls["count"]
+        started = time.perf_counter()
+        crew.kickoff()
+        elapsed = time.perf_counter() - started
+        # Los handlers síncronos del bus corren en un pool: margen para que terminen
+        time.sleep(0.2)
+        usage_after = _usage(agents)
+    with _tool_lock:
+        tool_calls = _tool_calls["count"] - tools_before
+
+    result = {key: usage_after[key] - usage_before[key] for key in usage_after}
+    result.update(latency_s=elapsed, tool_calls=tool_calls)
+    return result
+
+
+def summarize(samples: List[Dict[str, float]]) -> Dict[str, float]:
+    latencies = sorted(s["latency_s"] for s in samples)
+    return {
+        "runs": len(samples),
+        "latency_p50_s": round(statistics.median(latencies), 2),
+        "latency_max_s": round(latencies[-1], 2),
+        "llm_calls_avg": round(statistics.mean(s["successful_requests"] for s in samples), 2),
+        "prompt_tokens_avg": round(statistics.mean(s["prompt_tokens"] for s in samples)),
+        "completion_tokens_avg": round(statistics.mean(s["completion_tokens"] for s in samples)),
+        "total_tokens_avg": round(statistics.mean(s["total_tokens"] for s in samples)),
+        "tool_calls_avg": round(statistics.mean(s["tool_calls"] for s in samples), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="A/B benchmark de CREW_MODE")
+    parser.add_argument("--runs", type=int, default=3, help="repeticiones por mensaje y modo")
+    parser.add_argument("--phone", default="+34600000000", help="teléfono de sesión para las herramientas")
+    args = parser.parse_args()
+
+    samples: Dict[str, List[Dict[str, float]]] = {mode: [] for mode in MODES}
+    for run in range(args.runs):
+        for message in SAMPLE_MESSAGES:
+            # Alternar el orden evita favorecer siempre al segundo modo (cachés calientes)
+            order = MODES if run % 2 == 0 else tuple(reversed(MODES))
+            for mode in order:
+                sample = run_once(mode, args.phone, message)
+                samples[mode].append(sample)
+                print(f"  [{mode:<11}] {sample['latency_s']:6.2f}s  {sample['total_tokens']:6d} tok  "
+                      f"{sample['tool_calls']} tools  | {message}")
+
+    print("\n" + "=" * 60)
+    print("  RESULTADOS")
+    print("=" * 60)
+    results = {mode: summarize(samples[mode]) for mode in MODES}
+    for key in results[MODES[0]]:
+        a, b = results["two_task"][key], results["single_task"][key]
+        delta = f"{(b - a) / a * 100:+.0f}%" if a and key != "runs" else ""
+        print(f"  {key:<22} two_task={a:<10} single_task={b:<10} {delta}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Micro-benchmark de la deduplicación de webhooks con un día de tráfico.
+Ejecutar con: python bench_message_dedup.py [--ids 150000] [--legacy-ids 20000]
+
+Compara, con un TTL de 24 h (nada caduca durante la prueba) y un 10 % de reintentos de Meta:
+- legacy-dict: el MessageDedup original (reconstruye todo el dict en cada llamada a partir de 1000 IDs).
+  Es O(n) por mensaje, así que se mide sobre un prefijo (--legacy-ids).
+- ordered-expiry: MessageDedup sobre MemoryStateBackend (OrderedDict por caducidad, tope duro).
+- bloom+ordered: el anterior con un filtro de Bloom delante, candidato a pre-filtro probabilístico.
+
+Mide el tiempo medio por mensaje (µs), la memoria retenida (tracemalloc, segunda pasada) y
+comprueba que todas las variantes detectan exactamente los mismos duplicados.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import argparse
+import gc
+import hashlib
+import random
+import time
+import tracemalloc
+from typing import Dict, List
+
+from state_backend import MemoryStateBackend
+
+TTL = 86400
+
+
+class LegacyMessageDedup:
+    """El MessageDedup original de api/index.py (referencia)."""
+
+    def __init__(self, ttl_seconds: int = 300):
+        self.ttl = ttl_seconds
+        self._seen: Dict[str, float] = {}
+
+    def is_duplicate(self, message_id: str) -> bool:
+        now = time.time()
+        if len(self._seen) > 1000:
+            self._seen = {k: v for k, v in self._seen.items() if now - v < self.ttl}
+        if message_id in self._seen:
+            return True
+        self._seen[message_id] = now
+        return False
+
+
+class OrderedDedup:
+    """Misma lógica que api.index.MessageDedup sobre el backend en memoria (sin importar la app)."""
+
+    def __init__(self, max_claims: int):
+        self._backend = MemoryStateBackend(max_claims=max_claims)
+
+    def is_duplicate(self, message_id: str) -> bool:
+        return not self._backend.claim(f"wamid:{message_id}", TTL)
+
+
+class BloomDedup(OrderedDedup):
+    """Filtro de Bloom delante: si dice "nunca visto" se evita la consulta del dict (no la inserción)."""
+
+    def __init__(self, max_claims: int, bits: int = 1 << 21, hashes: int = 4):
+        super().__init__(max_claims)
+        self._bits = bytearray(bits // 8)
+        self._size = bits
+        self._hashes = hashes
+
+    def _positions(self, message_id: str) -> List[int]:
+        digest = hashlib.blake2b(message_id.encode(), digest_size=8).digest()
+        h1, h2 = int.from_bytes(digest[:4], "little"), int.from_bytes(digest[4:], "little") | 1
+        return [(h1 + i * h2) % self._size for i in range(self._hashes)]
+
+    def is_duplicate(self, message_id: str) -> bool:
+        positions = self._positions(message_id)
+        maybe_seen = all(self._bits[p >> 3] & (1 << (p & 7)) for p in positions)
+        for p in positions:
+            self._bits[p >> 3] |= 1 << (p & 7)
+        if not maybe_seen:
+            self._backend.claim(f"wamid:{message_id}", TTL)
+            return False
+        return super().is_duplicate(message_id)
+
+
+def _traffic(count: int, retry_rate: float = 0.1) -> List[str]:
+    """IDs con el formato de Meta; un 10 % se reenvía poco después (reintento del webhook)."""
+    rng = random.Random(42)
+    ids: List[str] = []
+    for i in range(count):
+        ids.append(f"wamid.HBgLMzQ2NjYwMDAxMTEVAgASGBQz{i:012d}QUE2RjdCMDg0AA==")
+        if rng.random() < retry_rate:
+            ids.append(ids[rng.randrange(max(0, len(ids) - 50), len(ids))])
+    return ids
+
+
+def run(name: str, factory, ids: List[str]) -> List[bool]:
+    gc.collect()
+    dedup = factory()
+    started = time.perf_counter()
+    results = [dedup.is_duplicate(message_id) for message_id in ids]
+    elapsed = time.perf_counter() - started
+    del dedup
+    gc.collect()
+    tracemalloc.start()
+    dedup = factory()
+    for message_id in ids:
+        dedup.is_duplicate(message_id)
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<15} {len(ids):>9,} msgs  {elapsed / len(ids) * 1e6:8.2f} µs/msg  "
+          f"{retained / 2**20:7.1f} MiB retained  {sum(results):,} duplicates")
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark de la deduplicación de webhooks")
+    parser.add_argument("--ids", type=int, default=150_000, help="message_ids distintos (un día)")
+    parser.add_argument("--legacy-ids", type=int, default=20_000, help="prefijo medido con el dedup original")
+    parser.add_argument("--max-claims", type=int, default=200_000, help="tope del backend en memoria")
+    args = parser.parse_args()
+
+    ids = _traffic(args.ids)
+    ordered = run("ordered-expiry", lambda: OrderedDedup(args.max_claims), ids)
+    bloom = run("bloom+ordered", lambda: BloomDedup(args.max_claims), ids)
+    assert bloom == ordered, "bloom pre-filter changed the dedup result"
+    if args.legacy_ids:
+        prefix = ids[:args.legacy_ids]
+        legacy = run("legacy-dict", lambda: LegacyMessageDedup(TTL), prefix)
+        assert legacy == ordered[:len(prefix)], "legacy dedup disagrees"
+
+
+if __name__ == "__main__":
+    main()
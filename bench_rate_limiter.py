@@ -0,0 +1,102 @@
+"""
+Micro-benchmark del rate limiter con millones de IPs distintas.
+Ejecutar con: python bench_rate_limiter.py [--ips 2000000] [--max-keys 100000]
+
+Compara el limitador anterior (lista de timestamps por IP en un dict que nunca olvida) con el
+contador de ventana deslizante de MemoryStateBackend, y mide:
+- Tiempo medio por llamada (µs) y llamadas por segundo (pasada sin tracemalloc)
+- Memoria retenida al final (segunda pasada con tracemalloc) y claves vivas
+
+Cada IP hace una petición y, cada 10 IPs nuevas, una IP "caliente" repite (tráfico mixto).
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import argparse
+import gc
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Dict, List
+
+from state_backend import MemoryStateBackend
+
+
+class LegacyRateLimiter:
+    """El RateLimiter original de api/index.py (referencia)."""
+
+    def __init__(self, max_requests: int = 10, window_seconds: int = 60):
+        self.max_requests = max_requests
+        self.window_seconds = window_seconds
+        self._requests: Dict[str, list] = defaultdict(list)
+
+    def is_allowed(self, client_ip: str) -> bool:
+        now = time.time()
+        self._requests[client_ip] = [t for t in self._requests[client_ip] if now - t < self.window_seconds]
+        if len(self._requests[client_ip]) >= self.max_requests:
+            return False
+        self._requests[client_ip].append(now)
+        return True
+
+    def __len__(self) -> int:
+        return len(self._requests)
+
+
+def _ips(count: int) -> List[str]:
+    ips = []
+    for i in range(count):
+        ips.append(f"{10 + (i >> 24)}.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}")
+        if i % 10 == 0:
+            ips.append("192.168.0.1")
+    return ips
+
+
+def run(name: str, factory, ips: List[str]) -> None:
+    """Una pasada cronometrada y otra con tracemalloc (instancias nuevas en cada una)."""
+    gc.collect()
+    is_allowed, size = factory()
+    started = time.perf_counter()
+    allowed = sum(1 for ip in ips if is_allowed(ip))
+    elapsed = time.perf_counter() - started
+    keys = size()
+    del is_allowed, size
+    gc.collect()
+    tracemalloc.start()
+    is_allowed, size = factory()
+    for ip in ips:
+        is_allowed(ip)
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<16} {elapsed / len(ips) * 1e6:6.2f} µs/call  {len(ips) / elapsed:10,.0f} calls/s  "
+          f"{retained / 2**20:7.1f} MiB retained  {keys:>10,} keys  {allowed:,} allowed")
+
+
+def _legacy():
+    limiter = LegacyRateLimiter()
+    return limiter.is_allowed, lambda: len(limiter)
+
+
+def _sliding_counter(max_keys: int):
+    def factory():
+        backend = MemoryStateBackend(max_keys=max_keys)
+        return (lambda ip: backend.hit(f"rate::ip:{ip}", 10, 60)), (lambda: len(backend))
+    return factory
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark del rate limiter con muchas IPs distintas")
+    parser.add_argument("--ips", type=int, default=2_000_000, help="IPs distintas")
+    parser.add_argument("--max-keys", type=int, default=100_000, help="tope de claves del backend en memoria")
+    parser.add_argument("--skip-legacy", action="store_true", help="no medir el limitador anterior")
+    args = parser.parse_args()
+
+    ips = _ips(args.ips)
+    print(f"{len(ips):,} calls, {args.ips:,} distinct IPs")
+    if not args.skip_legacy:
+        run("legacy-list", _legacy, ips)
+    run("sliding-counter", _sliding_counter(args.max_keys), ips)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Streaming de un turno del crew (tokens + progreso de herramientas) para /api/chat/stream.
+Un único juego de handlers en el bus de eventos de CrewAI reparte cada evento al turno que lo
+generó usando el id del agente: los agentes de un bundle del pool son exclusivos del turno.
+(El streaming nativo de Crew(stream=True) registra un handler global que mezclaría turnos concurrentes.)
+"""
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from crewai.events import (
+    crewai_event_bus, LLMStreamChunkEvent,
+    ToolUsageStartedEvent, ToolUsageFinishedEvent, ToolUsageErrorEvent
+)
+from crewai.utilities.string_utils import sanitize_tool_name
+from logger import get_logger
+
+log = get_logger("chat_stream")
+
+Emit = Callable[[Dict], None]
+
+# Texto de progreso para el cliente (nunca se exponen nombres de sistemas internos)
+TOOL_LABELS = {
+    sanitize_tool_name(name): label for name, label in [
+        ("Knowledge Base Search", "Consultando el catálogo"),
+        ("Search Products", "Buscando productos"),
+        ("Check Inventory", "Comprobando disponibilidad"),
+        ("Create Sale Order", "Preparando tu pedido"),
+        ("Create Invoice", "Generando la factura"),
+        ("Create Manufacturing Order", "Programando la fabricación"),
+        ("Search Odoo Customer", "Buscando tus datos"),
+        ("Check Calendar Availability", "Revisando la agenda"),
+        ("Create Full Booking (Lead & Meeting)", "Reservando la reunión"),
+        ("Send Email", "Enviando la confirmación"),
+        ("Save Conversation", "Guardando la conversación"),
+    ]
+}
+
+# agent_id -> (emit, id de la tarea cuya salida se retransmite)
+_routes: Dict[str, Tuple[Emit, str]] = {}
+_routes_lock = threading.Lock()
+_handlers_registered = False
+
+
+def _route(agent_id) -> Optional[Tuple[Emit, str]]:
+    with _routes_lock:
+        return _routes.get(str(agent_id)) if agent_id else None
+
+
+def _on_stream_chunk(source, event: LLMStreamChunkEvent) -> None:
+    route = _route(event.agent_id)
+    if route is None or event.tool_call or not event.chunk:
+        return
+    emit, final_task_id = route
+    if event.task_id == final_task_id:
+        emit({"type": "token", "text": event.chunk})
+
+
+def _on_tool_event(source, event) -> None:
+    route = _route(event.agent_id)
+    if route is None:
+        return
+    emit, _ = route
+    tool = sanitize_tool_name(event.tool_name)
+    status = {
+        ToolUsageStartedEvent: "started",
+        ToolUsageFinishedEvent: "finished",
+        ToolUsageErrorEvent: "error",
+    }[type(event)]
+    emit({"type": "tool", "status": status, "label": TOOL_LABELS.get(tool, "Consultando"), "tool": tool})
+
+
+def _ensure_handlers() -> None:
+    global _handlers_registered
+    with _routes_lock:
+        if _handlers_registered:
+            return
+        crewai_event_bus.register_handler(LLMStreamChunkEvent, _on_stream_chunk)
+        for event_type in (ToolUsageStartedEvent, ToolUsageFinishedEvent, ToolUsageErrorEvent):
+            crewai_event_bus.register_handler(event_type, _on_tool_event)
+        _handlers_registered = True
+
+
+@contextmanager
+def stream_turn(agents: List, final_task, emit: Emit) -> Iterator[None]:
+    """
+    Durante el bloque, los tokens de 'final_task' y los eventos de herramientas de 'agents' se
+    envían a 'emit'. Activa el streaming en los LLM de los agentes (el bundle lo desactiva al volver al pool).
+    """
+    _ensure_handlers()
+    agent_ids = [str(agent.id) for agent in agents]
+    with _routes_lock:
+        for agent_id in agent_ids:
+            _routes[agent_id] = (emit, str(final_task.id))
+    for agent in agents:
+        agent.llm.stream = True
+    try:
+        yield
+    finally:
+        with _routes_lock:
+            for agent_id in agent_ids:
+                _routes.pop(agent_id, None)
@@ -37,3 +37,102 @@ WHATSAPP_APP_SECRET = os.getenv("WHATSAPP_APP_SECRET", "")
 
 # API Authentication
 API_SECRET_KEY = os.getenv("API_SECRET_KEY", "")
+
+# Memoria conversacional (resumen incremental + últimos turnos literales)
+HISTORY_VERBATIM_MESSAGES = int(os.getenv("HISTORY_VERBATIM_MESSAGES", "4"))
+SUMMARY_MODEL_NAME = os.getenv("SUMMARY_MODEL_NAME", OPENAI_MODEL_NAME)
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "800"))
+SUMMARY_MAX_AGE_HOURS = int(os.getenv("SUMMARY_MAX_AGE_HOURS", "24"))
+
+# Embeddings (caché en memoria LRU + SQLite en disco; ruta vacía desactiva el disco)
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite3")
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "2048"))
+
+# Índice vectorial local de kb_items (réplica mapeada en memoria de match_kb_items)
+KB_LOCAL_SEARCH = os.getenv("KB_LOCAL_SEARCH", "true").lower() == "true"
+KB_INDEX_DIR = os.getenv("KB_INDEX_DIR", ".cache/kb_index")
+KB_INDEX_REFRESH_SECONDS = int(os.getenv("KB_INDEX_REFRESH_SECONDS", "300"))
+
+# Caché semántica de respuestas (solo consultas de catálogo/FAQ no personalizadas)
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "500"))
+ANSWER_CACHE_VERSION_CHECK_SECONDS = int(os.getenv("ANSWER_CACHE_VERSION_CHECK_SECONDS", "60"))
+
+# Recuperación híbrida: BM25 primero y embeddings solo si el resultado léxico no es concluyente
+KB_LEXICAL_FIRST = os.getenv("KB_LEXICAL_FIRST", "true").lower() == "true"
+LEXICAL_MIN_COVERAGE = float(os.getenv("LEXICAL_MIN_COVERAGE", "0.8"))
+LEXICAL_MIN_MARGIN = float(os.getenv("LEXICAL_MIN_MARGIN", "1.5"))
+# Con un acierto léxico claro, solo acompañan al primero los resultados con al menos esta fracción de su score
+LEXICAL_CO_HIT_RATIO = float(os.getenv("LEXICAL_CO_HIT_RATIO", "0.5"))
+
+# Modo del crew: "two_task" (clasificar + actuar) o "single_task" (una sola tarea con razonamiento por pasos)
+CREW_MODE = os.getenv("CREW_MODE", "two_task")
+
+# Pool de crews pre-construidos (agentes + herramientas + LLM aislados por turno concurrente)
+CREW_POOL_SIZE = int(os.getenv("CREW_POOL_SIZE", "4"))
+CREW_POOL_WARM = int(os.getenv("CREW_POOL_WARM", "1"))
+# Cargar el crew en segundo plano al arrancar la API (si no, se carga en el primer turno)
+CREW_PRELOAD = os.getenv("CREW_PRELOAD", "true").lower() == "true"
+CREW_POOL_CHECKOUT_TIMEOUT = float(os.getenv("CREW_POOL_CHECKOUT_TIMEOUT", "30"))
+
+# Contexto del turno en paralelo (guardar mensaje, historial, contacto de Odoo): timeouts en segundos
+CONTEXT_WORKERS = int(os.getenv("CONTEXT_WORKERS", "16"))
+CONTEXT_SAVE_TIMEOUT = float(os.getenv("CONTEXT_SAVE_TIMEOUT", "3"))
+CONTEXT_HISTORY_TIMEOUT = float(os.getenv("CONTEXT_HISTORY_TIMEOUT", "3"))
+CONTEXT_ODOO_TIMEOUT = float(os.getenv("CONTEXT_ODOO_TIMEOUT", "5"))
+
+# Prefetch especulativo de herramientas (productos / base de conocimientos) durante la primera llamada LLM
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() == "true"
+PREFETCH_WAIT_SECONDS = float(os.getenv("PREFETCH_WAIT_SECONDS", "5"))
+
+# Registro por turno (turn_metrics): espera máxima a los handlers del bus de eventos antes de cerrar el turno
+TURN_METRICS_FLUSH_SECONDS = float(os.getenv("TURN_METRICS_FLUSH_SECONDS", "1"))
+
+# Memoización de herramientas dentro de un turno (lecturas repetidas con los mismos argumentos)
+TOOL_MEMO_ENABLED = os.getenv("TOOL_MEMO_ENABLED", "true").lower() == "true"
+
+# Buzón por teléfono de WhatsApp: ráfagas dentro de la ventana de debounce se unen en un solo turno
+WHATSAPP_DEBOUNCE_SECONDS = float(os.getenv("WHATSAPP_DEBOUNCE_SECONDS", "2"))
+WHATSAPP_DEBOUNCE_MAX_SECONDS = float(os.getenv("WHATSAPP_DEBOUNCE_MAX_SECONDS", "8"))
+
+# Envío por la Graph API: versión, intentos ante 429/5xx/throttling y timeout por petición
+WHATSAPP_API_VERSION = os.getenv("WHATSAPP_API_VERSION", "v19.0")
+WHATSAPP_SEND_MAX_ATTEMPTS = int(os.getenv("WHATSAPP_SEND_MAX_ATTEMPTS", "4"))
+WHATSAPP_SEND_TIMEOUT = float(os.getenv("WHATSAPP_SEND_TIMEOUT", "30"))
+
+# Planificador de salida: mensajes/segundo del número (global) y por destinatario (pair rate limit de Meta)
+WHATSAPP_SEND_RATE = float(os.getenv("WHATSAPP_SEND_RATE", "80"))
+WHATSAPP_SEND_BURST = float(os.getenv("WHATSAPP_SEND_BURST", "80"))
+WHATSAPP_RECIPIENT_RATE = float(os.getenv("WHATSAPP_RECIPIENT_RATE", "0.17"))
+WHATSAPP_RECIPIENT_BURST = float(os.getenv("WHATSAPP_RECIPIENT_BURST", "10"))
+WHATSAPP_SEND_WORKERS = int(os.getenv("WHATSAPP_SEND_WORKERS", "4"))
+
+# Ejecutor acotado de turnos del crew: concurrencia máxima y turnos en espera antes de responder "ocupados"
+CREW_MAX_CONCURRENCY = int(os.getenv("CREW_MAX_CONCURRENCY", str(CREW_POOL_SIZE)))
+CREW_MAX_QUEUE = int(os.getenv("CREW_MAX_QUEUE", "20"))
+
+# Redis (backends compartidos entre procesos/hosts); vacío = no se usa
+REDIS_URL = os.getenv("REDIS_URL", "")
+
+# Cola duradera de entrada de WhatsApp: "" (buzón en proceso), "sqlite" o "redis"; la drena queue_worker.py
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "").lower()
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", ".cache/jobs.sqlite3")
+JOB_VISIBILITY_TIMEOUT = float(os.getenv("JOB_VISIBILITY_TIMEOUT", "300"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_WORKER_THREADS = int(os.getenv("JOB_WORKER_THREADS", str(CREW_MAX_CONCURRENCY)))
+
+# Estado compartido de la API (rate limit y dedup de webhooks): "memory" (un proceso), "sqlite" (un host) o "redis"
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", ".cache/state.sqlite3")
+# Tope de message_ids recordados por el backend en memoria (holgura sobre ~100k mensajes/día con TTL de 24 h)
+STATE_MAX_CLAIMS = int(os.getenv("STATE_MAX_CLAIMS", "200000"))
+
+# Rate limiting: "peticiones/segundos" por defecto, por ruta ("/api/chat=10/60,/api/chat/stream=5/60")
+# y por API key ("clave=100/60", una cuota compartida por todas las IPs que la usan)
+RATE_LIMIT_DEFAULT = os.getenv("RATE_LIMIT_DEFAULT", "10/60")
+RATE_LIMIT_ROUTES = os.getenv("RATE_LIMIT_ROUTES", "")
+RATE_LIMIT_API_KEYS = os.getenv("RATE_LIMIT_API_KEYS", "")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
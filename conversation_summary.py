@@ -0,0 +1,100 @@
+"""
+Resumen incremental de conversación por sesión.
+Mantiene un resumen compacto en Supabase (junto a los mensajes) que se actualiza en segundo
+plano tras cada respuesta, de modo que el prompt lleva "resumen + últimos turnos literales"
+y su tamaño no crece con la longitud de la conversación.
+
+Requiere en Supabase la tabla conversation_summaries con lead_id único (save_conversation_summary
+hace upsert con on_conflict="lead_id"; sin la restricción cada actualización falla):
+
+    create table if not exists conversation_summaries (
+        lead_id uuid primary key references leads (id) on delete cascade,
+        tenant_id uuid not null references organizations (id),
+        summary text not null,
+        updated_at timestamptz not null default now()
+    );
+
+(lead_id y tenant_id del mismo tipo que leads.id y organizations.id.)
+"""
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from openai import OpenAI
+from config import OPENAI_API_KEY, SUMMARY_MODEL_NAME, SUMMARY_MAX_CHARS, SUMMARY_MAX_AGE_HOURS
+from logger import get_logger
+
+log = get_logger("conversation_summary")
+
+# Cliente OpenAI para los resúmenes (llamadas cortas, fuera del camino crítico)
+_openai_client = OpenAI(api_key=OPENAI_API_KEY)
+
+# Pocos hilos: el resumen nunca bloquea la respuesta al usuario
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+
+# Un lock por sesión para que dos turnos seguidos no se pisen el resumen. Referencias débiles: la
+# entrada desaparece cuando ninguna actualización de esa sesión lo está usando o esperando.
+_session_locks: "weakref.WeakValueDictionary[str, threading.Lock]" = weakref.WeakValueDictionary()
+_session_locks_guard = threading.Lock()
+
+SUMMARY_PROMPT = (
+    "Eres un asistente que mantiene el resumen de una conversación de WhatsApp entre un cliente "
+    "y la secretaria virtual de una empresa de tortillas.\n"
+    "Actualiza el RESUMEN ANTERIOR incorporando el NUEVO TURNO. Conserva solo datos útiles para "
+    "continuar la conversación: nombre, productos, cantidades, precios, dirección, fechas propuestas, "
+    "pedidos o reuniones confirmados y preguntas pendientes. Omite saludos y cortesías.\n"
+    "Responde SOLO con el resumen, en español, en frases cortas y con un máximo de {max_chars} caracteres."
+)
+
+
+def _get_session_lock(session_id: str) -> threading.Lock:
+    with _session_locks_guard:
+        lock = _session_locks.get(session_id)
+        if lock is None:
+            lock = threading.Lock()
+            _session_locks[session_id] = lock
+        return lock
+
+
+def build_history_context(summary: str, recent_messages: str) -> str:
+    """Combina el resumen acumulado con los últimos mensajes literales para el prompt."""
+    if not summary:
+        return recent_messages
+    return f"Resumen de la conversación hasta ahora:\n{summary}\n\n{recent_messages}"
+
+
+def summarize_turn(previous_summary: str, user_message: str, agent_reply: str) -> str:
+    """Pide al LLM el resumen actualizado a partir del anterior y del último turno."""
+    response = _openai_client.chat.completions.create(
+        model=SUMMARY_MODEL_NAME,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT.format(max_chars=SUMMARY_MAX_CHARS)},
+            {"role": "user", "content": (
+                f"RESUMEN ANTERIOR:\n{previous_summary or '(vacío)'}\n\n"
+                f"NUEVO TURNO:\n[USUARIO]: {user_message}\n[AGENTE]: {agent_reply}"
+            )},
+        ],
+        temperature=0,
+        max_tokens=300,
+    )
+    summary = (response.choices[0].message.content or "").strip()
+    # El límite es duro: el prompt del crew nunca debe crecer por culpa del resumen
+    return summary[:SUMMARY_MAX_CHARS]
+
+
+def update_summary(session_id: str, user_message: str, agent_reply: str) -> None:
+    """Actualiza de forma síncrona el resumen persistido de la sesión."""
+    from tools_supabase import get_conversation_summary, save_conversation_summary
+
+    with _get_session_lock(session_id):
+        try:
+            previous = get_conversation_summary(session_id, max_age_hours=SUMMARY_MAX_AGE_HOURS)
+            summary = summarize_turn(previous, user_message, agent_reply)
+            if summary:
+                save_conversation_summary(session_id, summary)
+        except Exception as e:
+            log.error(f"Summary update failed: {type(e).__name__}: {e}")
+
+
+def schedule_summary_update(session_id: str, user_message: str, agent_reply: str) -> None:
+    """Encola la actualización del resumen en segundo plano (no bloquea la respuesta)."""
+    _executor.submit(update_summary, session_id, user_message, agent_reply)
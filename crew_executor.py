@@ -0,0 +1,82 @@
+"""
+Ejecutor acotado para los turnos del crew (WhatsApp, /api/chat y /api/chat/stream).
+Como mucho 'max_workers' turnos a la vez y 'max_queue' esperando; por encima, submit() rechaza
+con ExecutorSaturated para que el llamante conteste "estamos ocupados" en lugar de acumular crews
+que compiten por CPU, el rate limit de OpenAI y el de Odoo.
+"""
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict
+from metrics import LatencyTracker
+from logger import get_logger
+
+log = get_logger("crew_executor")
+
+BUSY_MESSAGE = ("Ahora mismo estamos atendiendo muchas consultas 🙏 "
+                "Dame un par de minutos y vuelve a escribirme, por favor.")
+
+
+class ExecutorSaturated(RuntimeError):
+    """Todos los hilos ocupados y la cola llena."""
+
+
+class BoundedExecutor:
+    """ThreadPoolExecutor con cola acotada, métricas de espera y rechazo explícito."""
+
+    def __init__(self, max_workers: int = 4, max_queue: int = 20, name: str = "crew") -> None:
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self._running = 0
+        self._queued = 0
+        self._counts = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0}
+        self.latency = LatencyTracker()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._counts["rejected"] += 1
+                queued = self._queued
+            log.warning(f"Crew executor saturated ({self.max_workers} running, {queued} queued). Rejecting turn")
+            raise ExecutorSaturated(f"{self.max_workers} running and {self.max_queue} queued")
+        with self._lock:
+            self._counts["submitted"] += 1
+            self._queued += 1
+        submitted = time.perf_counter()
+        try:
+            return self._pool.submit(self._run, submitted, fn, *args, **kwargs)
+        except BaseException:
+            with self._lock:
+                self._queued -= 1
+            self._slots.release()
+            raise
+
+    def _run(self, submitted: float, fn: Callable, *args, **kwargs):
+        started = time.perf_counter()
+        self.latency.record("queue_wait", started - submitted)
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        outcome = "completed"
+        try:
+            return fn(*args, **kwargs)
+        except BaseException:
+            outcome = "failed"
+            raise
+        finally:
+            self.latency.record("run", time.perf_counter() - started)
+            with self._lock:
+                self._running -= 1
+                self._counts[outcome] += 1
+            self._slots.release()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats: Dict = dict(self._counts)
+            stats.update(max_workers=self.max_workers, max_queue=self.max_queue,
+                         running=self._running, queued=self._queued)
+        stats["latency"] = self.latency.snapshot()
+        return stats
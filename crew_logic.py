@@ -4,11 +4,34 @@ from tools_orders import ProductSearchTool, InventoryCheckTool, CreateSaleOrderT
 from tools_invoicing import CreateInvoiceTool, CreateManufacturingOrderTool
 from tools_email import SendEmailTool
 from tools_rag import OdooRAGTool
-from tools_supabase import SupabaseMemoryTool, save_message, get_recent_messages
-from langchain_openai import ChatOpenAI
+from tools_supabase import (
+    SupabaseMemoryTool, save_message, get_recent_messages, get_conversation_summary, HISTORY_UNAVAILABLE,
+    asave_message, aget_recent_messages, aget_conversation_summary
+)
+from conversation_summary import build_history_context, schedule_summary_update
+from answer_cache import lookup_answer, store_answer
+from intent_router import classify_intent, render_fast_reply
+from metrics import intent_latency
+from crew_pool import CrewBundle, CrewPool
+from chat_stream import stream_turn
+from prefetch import start_prefetch, use_prefetch
+from tool_memo import use_tool_memo
+from turn_journal import TurnJournal, USER_MESSAGE_KEY, current_journal
+from turn_metrics import TurnRecord, track_turn, record_step
+from openai_llm import build_llm, log_prompt_cache_usage
+from crew_executor import ExecutorSaturated
 from logger import get_logger
+import asyncio
+import contextvars
 import os
-from config import OPENAI_API_KEY, OPENAI_MODEL_NAME
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from typing import Awaitable, Callable, Optional
+from config import (
+    OPENAI_API_KEY, OPENAI_MODEL_NAME, HISTORY_VERBATIM_MESSAGES, SUMMARY_MAX_AGE_HOURS, CREW_MODE,
+    CREW_POOL_SIZE, CREW_POOL_WARM, CREW_POOL_CHECKOUT_TIMEOUT,
+    CONTEXT_WORKERS, CONTEXT_SAVE_TIMEOUT, CONTEXT_HISTORY_TIMEOUT, CONTEXT_ODOO_TIMEOUT
+)
 from datetime import datetime
 import pytz
 from utils import normalize_phone
@@ -16,7 +39,6 @@ from utils import normalize_phone
 os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
 
 log = get_logger("crew_logic")
-llm = ChatOpenAI(model=OPENAI_MODEL_NAME, api_key=OPENAI_API_KEY)
 
 AGENT_NAME = os.getenv("AGENT_NAME", "Sofía")
 TENANT_NAME = os.getenv("TENANT_NAME", "Tortillas Mejicanas")
@@ -34,61 +56,81 @@ REGLAS_WHATSAPP = (
 
 # --- Agentes ---
 
-support_agent = Agent(
-    role=f'Especialista en Soporte y Catálogo de {TENANT_NAME}',
-    goal='Responder dudas sobre productos, precios y disponibilidad basándose ÚNICAMENTE en la documentación y el catálogo.',
-    backstory=f'Eres el experto en productos de {TENANT_NAME}. Conoces toda la carta de productos, precios y disponibilidad.\n' + REGLAS_WHATSAPP,
-    tools=[OdooRAGTool(), SupabaseMemoryTool(), ProductSearchTool(), InventoryCheckTool()],
-    llm=llm,
-    verbose=True
-)
+def build_support_agent(llm):
+    return Agent(
+        role=f'Especialista en Soporte y Catálogo de {TENANT_NAME}',
+        goal='Responder dudas sobre productos, precios y disponibilidad basándose ÚNICAMENTE en la documentación y el catálogo.',
+        backstory=f'Eres el experto en productos de {TENANT_NAME}. Conoces toda la carta de productos, precios y disponibilidad.\n' + REGLAS_WHATSAPP,
+        tools=[OdooRAGTool(), SupabaseMemoryTool(), ProductSearchTool(), InventoryCheckTool()],
+        llm=llm,
+        # Sin la caché de herramientas de CrewAI: vive en el agente (que el pool reutiliza entre turnos)
+        # y no se invalida tras escrituras. La memoización por turno está en tool_memo.
+        cache=False,
+        verbose=True
+    )
 
-secretary_agent = Agent(
-    role=f'Secretaria Comercial de {TENANT_NAME}',
-    goal=(
-        'Atender a los clientes de forma amigable y eficiente. Gestionar tres flujos principales: '
-        '(1) Resolver consultas generales, '
-        '(2) Agendar reuniones cuando el cliente lo pide explícitamente, '
-        '(3) Tomar pedidos de productos: buscar producto, verificar stock, crear pedido, generar factura, '
-        'y si no hay stock suficiente, crear orden de fabricación.'
-    ),
-    backstory=(
-        f'Te llamas {AGENT_NAME} y eres la secretaria virtual de {TENANT_NAME}.\n'
-        f'REGLA 1 (SALUDO): SOLO preséntate con tu nombre la PRIMERA VEZ que hablas con un usuario NUEVO '
-        f'("Hola soy {AGENT_NAME}, tu asistente de {TENANT_NAME}"). '
-        f'Si el historial de conversación ya tiene mensajes previos, NO te presentes de nuevo, '
-        f'simplemente responde de forma natural. Si el CRM dice que el usuario ya existe, salúdalo por su nombre directamente.\n'
-        'REGLA 2 (NATURALIDAD): Resuelve primero la consulta del cliente. Mantén un tono muy cálido y humano.\n'
-        'REGLA 3 (AGENDAR): Solo cuando el usuario PIDA EXPLÍCITAMENTE una reunión, empieza a recabar datos. Si ya tienes su nombre, email y teléfono del CRM, NO los pidas de nuevo.\n'
-        'REGLA 4 (ODOO UTC): Odoo requiere la hora en UTC. Para España (CET/CEST), resta 1h en invierno o 2h en verano.\n'
-        'REGLA 5 (HERRAMIENTAS): NUNCA asumas que una acción está hecha si no has ejecutado la herramienta con éxito.\n'
-        'REGLA 6 (PEDIDOS): Cuando el cliente quiera hacer un pedido:\n'
-        '  a) Busca el producto con "Search Products" para encontrar el ID y precio.\n'
-        '  b) NO uses "Check Inventory" — nuestros productos son siempre disponibles.\n'
-        '  c) OBLIGATORIO: Pregunta siempre al cliente cuántas unidades desea y su dirección de entrega exacta ANTES de intentar crear el pedido.\n'
-        '  d) Una vez tengas TODOS los datos (nombre, teléfono, producto, cantidad, dirección), usa "Create Sale Order" (esta herramienta genera factura y email automáticamente).\n'
-        '  e) SOLO usa "Create Manufacturing Order" si el cliente pide una cantidad MUY grande (más de 1000 unidades).\n'
-        'REGLA 7 (EMAIL): Después de agendar UNA REUNIÓN CON ÉXITO, envía un email de confirmación usando SendEmailTool. (Para PEDIDOS no es necesario, ya se envía automático).\n'
-        'REGLA 8 (ANTI-ALUCINACIÓN): NUNCA inventes reuniones, pedidos, precios o cantidades que NO existan. '
-        'NUNCA asumas lo que el usuario quiere. Si dice "hola", simplemente responde al saludo. '
-        'NO menciones pedidos o reuniones anteriores a menos que el usuario los mencione PRIMERO.\n'
-        + REGLAS_WHATSAPP
-    ),
-    tools=[
-        OdooSearchTool(), OdooCheckAvailabilityTool(), OdooFullBookingTool(),
-        ProductSearchTool(), InventoryCheckTool(), CreateSaleOrderTool(),
-        CreateInvoiceTool(), CreateManufacturingOrderTool(),
-        SendEmailTool()
-    ],
-    llm=llm,
-    verbose=True
-)
+def build_secretary_agent(llm):
+    return Agent(
+        role=f'Secretaria Comercial de {TENANT_NAME}',
+        goal=(
+            'Atender a los clientes de forma amigable y eficiente. Gestionar tres flujos principales: '
+            '(1) Resolver consultas generales, '
+            '(2) Agendar reuniones cuando el cliente lo pide explícitamente, '
+            '(3) Tomar pedidos de productos: buscar producto, verificar stock, crear pedido, generar factura, '
+            'y si no hay stock suficiente, crear orden de fabricación.'
+        ),
+        backstory=(
+            f'Te llamas {AGENT_NAME} y eres la secretaria virtual de {TENANT_NAME}.\n'
+            f'REGLA 1 (SALUDO): SOLO preséntate con tu nombre la PRIMERA VEZ que hablas con un usuario NUEVO '
+            f'("Hola soy {AGENT_NAME}, tu asistente de {TENANT_NAME}"). '
+            f'Si el historial de conversación ya tiene mensajes previos, NO te presentes de nuevo, '
+            f'simplemente responde de forma natural. Si el CRM dice que el usuario ya existe, salúdalo por su nombre directamente.\n'
+            'REGLA 2 (NATURALIDAD): Resuelve primero la consulta del cliente. Mantén un tono muy cálido y humano.\n'
+            'REGLA 3 (AGENDAR): Solo cuando el usuario PIDA EXPLÍCITAMENTE una reunión, empieza a recabar datos. Si ya tienes su nombre, email y teléfono del CRM, NO los pidas de nuevo.\n'
+            'REGLA 4 (ODOO UTC): Odoo requiere la hora en UTC. Para España (CET/CEST), resta 1h en invierno o 2h en verano.\n'
+            'REGLA 5 (HERRAMIENTAS): NUNCA asumas que una acción está hecha si no has ejecutado la herramienta con éxito.\n'
+            'REGLA 6 (PEDIDOS): Cuando el cliente quiera hacer un pedido:\n'
+            '  a) Busca el producto con "Search Products" para encontrar el ID y precio.\n'
+            '  b) NO uses "Check Inventory" — nuestros productos son siempre disponibles.\n'
+            '  c) OBLIGATORIO: Pregunta siempre al cliente cuántas unidades desea y su dirección de entrega exacta ANTES de intentar crear el pedido.\n'
+            '  d) Una vez tengas TODOS los datos (nombre, teléfono, producto, cantidad, dirección), usa "Create Sale Order" (esta herramienta genera factura y email automáticamente).\n'
+            '  e) SOLO usa "Create Manufacturing Order" si el cliente pide una cantidad MUY grande (más de 1000 unidades).\n'
+            'REGLA 7 (EMAIL): Después de agendar UNA REUNIÓN CON ÉXITO, envía un email de confirmación usando SendEmailTool. (Para PEDIDOS no es necesario, ya se envía automático).\n'
+            'REGLA 8 (ANTI-ALUCINACIÓN): NUNCA inventes reuniones, pedidos, precios o cantidades que NO existan. '
+            'NUNCA asumas lo que el usuario quiere. Si dice "hola", simplemente responde al saludo. '
+            'NO menciones pedidos o reuniones anteriores a menos que el usuario los mencione PRIMERO.\n'
+            + REGLAS_WHATSAPP
+        ),
+        tools=[
+            OdooSearchTool(), OdooCheckAvailabilityTool(), OdooFullBookingTool(),
+            ProductSearchTool(), InventoryCheckTool(), CreateSaleOrderTool(),
+            CreateInvoiceTool(), CreateManufacturingOrderTool(),
+            SendEmailTool()
+        ],
+        llm=llm,
+        cache=False,
+        verbose=True
+    )
+
+def build_crew_bundle() -> CrewBundle:
+    """Agentes, herramientas y clientes LLM nuevos y exclusivos de un bundle del pool."""
+    # Un LLM por agente: crew.usage_metrics suma por agente y no debe contar dos veces el mismo
+    return CrewBundle(
+        support_agent=build_support_agent(build_llm(OPENAI_MODEL_NAME, OPENAI_API_KEY)),
+        secretary_agent=build_secretary_agent(build_llm(OPENAI_MODEL_NAME, OPENAI_API_KEY)),
+    )
+
+
+crew_pool = CrewPool(build_crew_bundle, size=CREW_POOL_SIZE, checkout_timeout=CREW_POOL_CHECKOUT_TIMEOUT)
+crew_pool.warm(CREW_POOL_WARM)
 
 # --- Tareas ---
+# Caché de prompts de OpenAI: solo se reutiliza el PREFIJO idéntico entre llamadas. Por eso cada
+# descripción empieza con las instrucciones estáticas (mismo texto byte a byte en todos los turnos)
+# y deja al final, en el bloque "DATOS DEL TURNO", todo lo que cambia: fecha, CRM, historial y mensaje.
 
-def create_tasks(session_id, user_message, chat_history="", crm_context=""):
-    
-    # Contexto Temporal con soporte UTC
+def _date_context():
+    """Contexto temporal con soporte UTC y desfase horario de Madrid."""
     tz = pytz.timezone('Europe/Madrid')
     now = datetime.now(tz)
     offset_hours = int(now.utcoffset().total_seconds() / 3600)
@@ -96,46 +138,108 @@ def create_tasks(session_id, user_message, chat_history="", crm_context=""):
                     f"IMPORTANTE: Odoo exige que envíes las horas a sus herramientas en formato UTC. "
                     f"Madrid tiene un desfase horario de +{offset_hours} horas. "
                     f"Por lo tanto, la hora que envíes a la herramienta debe restarle {offset_hours} horas a la hora acordada con el cliente (Ej. si el cliente dice 11:00 am, envía a las {11 - offset_hours:02d}:00:00).")
+    return date_context, offset_hours
+
+
+HISTORIAL_REGLAS = (
+    "IMPORTANTE SOBRE EL HISTORIAL: El historial es SOLO para saber qué datos ya tienes. "
+    "NO asumas que el usuario quiere continuar una conversación anterior. "
+    "NO menciones reuniones, citas, pedidos o temas del historial a menos que el usuario los mencione PRIMERO.\n"
+)
+
+INTENCIONES = (
+    "- SALUDO: El usuario saluda o se presenta\n"
+    "- CONSULTA: El usuario pregunta algo sobre productos, precios, servicios\n"
+    "- REUNIÓN: El usuario pide EXPLÍCITAMENTE agendar una reunión\n"
+    "- PEDIDO: El usuario quiere hacer un pedido de productos (ej: 'quiero 4 cajas de tortillas')\n"
+    "- OTRO: Cualquier otra cosa\n"
+)
+
+INSTRUCCIONES_ACCION = (
+    "- Si dice 'hola' o un saludo → respóndele con un saludo cálido. Si ya lo conoces, salúdalo por nombre. NADA MÁS.\n"
+    "- Si pregunta algo → resuelve su consulta, busca en el catálogo si es sobre productos.\n"
+    "- Si PIDE EXPLÍCITAMENTE una reunión → recaba datos faltantes y agenda.\n"
+    "- Si quiere hacer un PEDIDO:\n"
+    "    a) OBLIGATORIO: Pide al usuario su cantidad de unidades. Si NO TIENES su dirección de entrega (o es usuario NUEVO), pídesela TAMBIÉN ANTES de procesar nada. NUNCA pidas datos que ya tengas en la Identidad del Cliente.\n"
+    "    b) Busca el producto con 'Search Products' para obtener ID y precio.\n"
+    "    c) NO compruebes inventario (nuestros productos siempre están disponibles).\n"
+    "    d) Crea pedido usando 'Create Sale Order' enviando TODOS los parámetros requeridos.\n"
+    "    e) (Ya no es necesario usar 'Create Invoice' o 'Send Email', 'Create Sale Order' lo hace automáticamente).\n"
+    "- Si ya tienes los datos y propone una fecha/hora para reunión:\n"
+    "    a) Valida con OdooCheckAvailabilityTool (RESTA a la hora acordada el desfase UTC indicado en la NOTA TEMPORAL).\n"
+    "    b) Si está ocupado, proponle otro horario.\n"
+    "    c) Si está libre, cierra con OdooFullBookingTool (restando también el desfase UTC).\n"
+    "    d) Tras booking exitoso, envía email con SendEmailTool.\n\n"
+    "PROHIBIDO: NO menciones pedidos o reuniones anteriores. NO asumas intenciones. Responde SOLO a lo que dice este mensaje.\n"
+)
+
+# Prefijos estáticos de cada tarea (sin ningún dato del turno)
+PREFIJO_TAREA_UNICA = (
+    f"Eres {AGENT_NAME}. Atiende el mensaje ACTUAL del usuario (al final, en DATOS DEL TURNO).\n"
+    f"PROCEDIMIENTO (razona en este orden antes de responder):\n"
+    f"PASO 1 - Identidad: usa los datos del CRM; no pidas lo que ya tienes.\n"
+    f"PASO 2 - Intención: clasifica el MENSAJE ACTUAL en una de estas intenciones:\n"
+    f"{INTENCIONES}"
+    f"PASO 3 - Acción según la intención:\n"
+    f"{INSTRUCCIONES_ACCION}"
+    f"{HISTORIAL_REGLAS}\n"
+)
+
+PREFIJO_IDENTIFICAR = (
+    "Analiza el mensaje ACTUAL del usuario (al final, en DATOS DEL TURNO) y determina su intención REAL.\n"
+    "Las intenciones posibles son:\n"
+    f"{INTENCIONES}"
+    f"{HISTORIAL_REGLAS}\n"
+)
+
+PREFIJO_ACCION = (
+    f"Responde AL MENSAJE ACTUAL del usuario (Tú eres {AGENT_NAME}):\n"
+    f"{INSTRUCCIONES_ACCION}\n"
+)
+
+
+def _turn_data(user_message, date_context=None, chat_history=None, crm_context=None):
+    """Bloque final con los datos que cambian en cada turno."""
+    parts = ["=== DATOS DEL TURNO ===\n"]
+    if date_context is not None:
+        parts.append(f"NOTA TEMPORAL: {date_context}\n\n")
+    if crm_context is not None:
+        parts.append(f"--- IDENTIDAD DEL CLIENTE (CRM) ---\n{crm_context}\n\n")
+    if chat_history is not None:
+        parts.append(f"--- HISTORIAL RECIENTE (solo referencia, NO actúes sobre él) ---\n{chat_history}\n\n")
+    parts.append(f"--- MENSAJE ACTUAL DEL USUARIO (esto es lo ÚNICO que debes responder) ---\n'{user_message}'")
+    return "".join(parts)
+
+
+def create_tasks(session_id, user_message, chat_history="", crm_context="", mode=None, agent=None):
+    """
+    Tareas del crew según CREW_MODE:
+    - two_task: identify_task clasifica y action_task responde con esa clasificación como contexto.
+    - single_task: una sola tarea que clasifica y actúa (una llamada LLM menos, el contexto va una vez).
+    'agent' es la secretaria del bundle del pool que ejecuta el turno.
+    """
+    mode = mode or CREW_MODE
+    date_context, _ = _date_context()
+
+    if mode == "single_task":
+        turn_task = Task(
+            description=PREFIJO_TAREA_UNICA + _turn_data(user_message, date_context, chat_history, crm_context),
+            expected_output="SOLO la respuesta final al usuario: directa, cálida y corta. Sin mostrar la intención ni los pasos. Sin inventar contexto.",
+            agent=agent
+        )
+        return [turn_task]
 
     identify_task = Task(
-        description=f"Analiza el mensaje ACTUAL del usuario y determina su intención REAL.\n"
-                    f"NOTA TEMPORAL: {date_context}\n\n"
-                    f"--- IDENTIDAD DEL CLIENTE (CRM) ---\n{crm_context}\n\n"
-                    f"--- HISTORIAL RECIENTE (solo referencia, NO actúes sobre él) ---\n{chat_history}\n"
-                    f"IMPORTANTE: El historial es SOLO para saber qué datos ya tienes. "
-                    f"NO asumas que el usuario quiere continuar una conversación anterior. "
-                    f"NO menciones reuniones, citas, pedidos o temas del historial a menos que el usuario los mencione PRIMERO.\n\n"
-                    f"Las intenciones posibles son:\n"
-                    f"- SALUDO: El usuario saluda o se presenta\n"
-                    f"- CONSULTA: El usuario pregunta algo sobre productos, precios, servicios\n"
-                    f"- REUNIÓN: El usuario pide EXPLÍCITAMENTE agendar una reunión\n"
-                    f"- PEDIDO: El usuario quiere hacer un pedido de productos (ej: 'quiero 4 cajas de tortillas')\n"
-                    f"- OTRO: Cualquier otra cosa\n\n"
-                    f"--- MENSAJE ACTUAL DEL USUARIO (esto es lo ÚNICO que debes responder) ---\n'{user_message}'",
+        description=PREFIJO_IDENTIFICAR + _turn_data(user_message, date_context, chat_history, crm_context),
         expected_output="Identidad del cliente (nombre/email si están en CRM), y la intención del MENSAJE ACTUAL clasificada como: SALUDO, CONSULTA, REUNIÓN, PEDIDO u OTRO.",
-        agent=secretary_agent
+        agent=agent
     )
 
+    # La fecha va también aquí: la acción puede necesitar el desfase UTC para agendar
     action_task = Task(
-        description=f"Responde AL MENSAJE ACTUAL del usuario (Tú eres {AGENT_NAME}):\n"
-                    f"- Si dice 'hola' o un saludo → respóndele con un saludo cálido. Si ya lo conoces, salúdalo por nombre. NADA MÁS.\n"
-                    f"- Si pregunta algo → resuelve su consulta, busca en el catálogo si es sobre productos.\n"
-                    f"- Si PIDE EXPLÍCITAMENTE una reunión → recaba datos faltantes y agenda.\n"
-                    f"- Si quiere hacer un PEDIDO:\n"
-                    f"    a) OBLIGATORIO: Pide al usuario su cantidad de unidades. Si NO TIENES su dirección de entrega (o es usuario NUEVO), pídesela TAMBIÉN ANTES de procesar nada. NUNCA pidas datos que ya tengas en la Identidad del Cliente.\n"
-                    f"    b) Busca el producto con 'Search Products' para obtener ID y precio.\n"
-                    f"    c) NO compruebes inventario (nuestros productos siempre están disponibles).\n"
-                    f"    d) Crea pedido usando 'Create Sale Order' enviando TODOS los parámetros requeridos.\n"
-                    f"    e) (Ya no es necesario usar 'Create Invoice' o 'Send Email', 'Create Sale Order' lo hace automáticamente).\n"
-                    f"- Si ya tienes los datos y propone una fecha/hora para reunión:\n"
-                    f"    a) Valida con OdooCheckAvailabilityTool (RESTA {offset_hours}h para UTC).\n"
-                    f"    b) Si está ocupado, proponle otro horario.\n"
-                    f"    c) Si está libre, cierra con OdooFullBookingTool (restando {offset_hours}h para UTC).\n"
-                    f"    d) Tras booking exitoso, envía email con SendEmailTool.\n\n"
-                    f"PROHIBIDO: NO menciones pedidos o reuniones anteriores. NO asumas intenciones. Responde SOLO a lo que dice este mensaje.\n"
-                    f"Mensaje: '{user_message}'",
+        description=PREFIJO_ACCION + _turn_data(user_message, date_context),
         expected_output="Respuesta directa, cálida y corta al mensaje actual del usuario. Sin inventar contexto.",
-        agent=secretary_agent,
+        agent=agent,
         context=[identify_task]
     )
     
@@ -143,72 +247,339 @@ def create_tasks(session_id, user_message, chat_history="", crm_context=""):
 
 # --- Crew ---
 
-def run_odoo_crew(session_id: str, user_message: str) -> str:
+def _record_latency(turn: TurnRecord, intent: str, path: str) -> None:
+    elapsed = time.perf_counter() - turn.started
+    turn.intent, turn.path = intent, path
+    intent_latency.record(f"{intent}:{path}", elapsed)
+    log.info(f"Turn latency intent={intent} path={path}: {elapsed * 1000:.0f} ms")
+
+
+# Hilos para reunir el contexto del turno (pasos 1-3); un paso colgado solo ocupa su hilo
+_context_executor = ThreadPoolExecutor(max_workers=CONTEXT_WORKERS, thread_name_prefix="turn-context")
+
+
+def _timed(func, *args, **kwargs):
+    """Ejecuta func y devuelve (resultado, segundos)."""
+    step_started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - step_started
+
+
+def _step_result(future, gather_started, timeout, fallback, name):
+    """Resultado de un paso con timeout contado desde el inicio del turno; si falla, valor degradado."""
+    remaining = max(timeout - (time.perf_counter() - gather_started), 0)
     try:
-        try:
-            session_id = normalize_phone(session_id)
-        except ValueError as e:
-            log.error(f"crew_logic received invalid session_id {session_id[:8]}***: {e}")
-            raise e
-            
-        log.info(f"[STEP 1/6] Saving user message for session {session_id[:8]}***")
-        save_message(session_id, "usuario", user_message)
+        result, elapsed = future.result(timeout=remaining)
+        record_step(name, elapsed)
+        return result, f"{elapsed * 1000:.0f} ms"
+    except FuturesTimeout:
+        log.warning(f"{name} timed out after {timeout}s, continuing with fallback")
+        record_step(name, timeout)
+        return fallback, f"timeout {timeout}s"
+    except Exception as e:
+        log.warning(f"{name} failed (non-fatal): {type(e).__name__}: {e}")
+        return fallback, "failed"
+
+
+def _crm_context(partner, session_id):
+    """Bloque de identidad del usuario para las tareas: datos del CRM o instrucciones para un usuario nuevo."""
+    if partner:
+        p_name = partner['name']
+        p_email = partner.get('email', '')
+        p_phone = partner.get('phone', '')
+        p_street = partner.get('street', '')
         
-        log.info("[STEP 2/6] Fetching chat history")
-        chat_history = get_recent_messages(session_id, limit=6)
+        street_info = f"- Dirección de entrega: {p_street}" if p_street else "- Dirección de entrega: NO DISPONIBLE (Debes pedírsela si hace un pedido)"
         
-        log.info("[STEP 3/6] Searching partner in Odoo")
-        try:
-            partner = odoo.search_contact_by_phone(session_id)
-        except Exception as odoo_err:
-            log.warning(f"Odoo search_partner failed (non-fatal): {type(odoo_err).__name__}: {odoo_err}")
-            partner = None
-            
-        if partner:
-            p_name = partner['name']
-            p_email = partner.get('email', '')
-            p_phone = partner.get('phone', '')
-            p_street = partner.get('street', '')
-            
-            street_info = f"- Dirección de entrega: {p_street}" if p_street else "- Dirección de entrega: NO DISPONIBLE (Debes pedírsela si hace un pedido)"
-            
-            crm_context = (
-                f"IDENTIDAD CONFIRMADA DEL USUARIO (datos del CRM, son 100% fiables):\n"
-                f"- Nombre: {p_name}\n"
-                f"- Email: {p_email}\n"
-                f"- Teléfono: {p_phone}\n"
-                f"{street_info}\n"
-                f"INSTRUCCIÓN: Este usuario es un CLIENTE CONOCIDO. Llámalo '{p_name}' con total seguridad. "
-                f"NO le preguntes su nombre, NO le preguntes su email. "
-                f"Si hace un pedido y YA tienes su dirección de entrega, NO se la pidas de nuevo. "
-                f"Usa directamente estos datos en las herramientas."
-            )
-        else:
-            crm_context = (
-                f"IDENTIDAD DEL USUARIO: Es un usuario NUEVO (no está en el CRM). "
-                f"NO TIENES su nombre, ni su email, ni su dirección. SOLO su teléfono actual ({session_id}).\n"
-                f"INSTRUCCIÓN: Si el usuario quiere hacer un PEDIDO o AGENDAR REUNIÓN, es OBLIGATORIO que le pidas su nombre, email (o al menos nombre) y su dirección de entrega (si es pedido) de forma amable ANTES de intentar usar las herramientas."
-            )
-
-        log.info("[STEP 4/6] Creating CrewAI tasks")
-        tasks = create_tasks(session_id, user_message, chat_history, crm_context)
+        return (
+            f"IDENTIDAD CONFIRMADA DEL USUARIO (datos del CRM, son 100% fiables):\n"
+            f"- Nombre: {p_name}\n"
+            f"- Email: {p_email}\n"
+            f"- Teléfono: {p_phone}\n"
+            f"{street_info}\n"
+            f"INSTRUCCIÓN: Este usuario es un CLIENTE CONOCIDO. Llámalo '{p_name}' con total seguridad. "
+            f"NO le preguntes su nombre, NO le preguntes su email. "
+            f"Si hace un pedido y YA tienes su dirección de entrega, NO se la pidas de nuevo. "
+            f"Usa directamente estos datos en las herramientas."
+        )
+    return (
+        f"IDENTIDAD DEL USUARIO: Es un usuario NUEVO (no está en el CRM). "
+        f"NO TIENES su nombre, ni su email, ni su dirección. SOLO su teléfono actual ({session_id}).\n"
+        f"INSTRUCCIÓN: Si el usuario quiere hacer un PEDIDO o AGENDAR REUNIÓN, es OBLIGATORIO que le pidas su nombre, email (o al menos nombre) y su dirección de entrega (si es pedido) de forma amable ANTES de intentar usar las herramientas."
+    )
+
+
+def _kickoff(turn: TurnRecord, session_id: str, user_message: str, chat_history: str, crm_context: str,
+             emit=None) -> str:
+    """Pasos 4-5: tareas y crew.kickoff() con un bundle del pool. Bloqueante (LLM y herramientas síncronas)."""
+    log.info(f"[STEP 4/6] Creating CrewAI tasks (mode={CREW_MODE})")
+    if emit:
+        emit({"type": "status", "stage": "thinking"})
+    checkout_started = time.perf_counter()
+    with crew_pool.lease() as bundle:
+        turn.step("crew_checkout", time.perf_counter() - checkout_started)
+        tasks = create_tasks(session_id, user_message, chat_history, crm_context, agent=bundle.secretary_agent)
         crew = Crew(
-            agents=[support_agent, secretary_agent],
+            agents=bundle.agents,
             tasks=tasks,
             process=Process.sequential,
             verbose=True
         )
         
         log.info("[STEP 5/6] Executing crew.kickoff()")
-        result = crew.kickoff()
+        # Búsquedas probables en paralelo con la primera llamada LLM
+        with turn.timed("kickoff"), use_prefetch(start_prefetch(user_message)), use_tool_memo():
+            if emit:
+                with stream_turn(bundle.agents, tasks[-1], emit):
+                    result = crew.kickoff()
+            else:
+                result = crew.kickoff()
         final_text = str(result)
-        
-        log.info("[STEP 6/6] Saving agent response")
-        save_message(session_id, "agente", final_text)
-        
-        log.info(f"Crew completed. Response length: {len(final_text)} chars")
-        return final_text
+        log_prompt_cache_usage(crew.usage_metrics)
+    return final_text
+
+
+def _save_user_message(session_id: str, user_message: str, journal: Optional[TurnJournal] = None) -> None:
+    """save_message del usuario; en el reintento de un lote (con diario) solo se guarda lo que faltaba."""
+    text = journal.unsaved_user_text(user_message) if journal else user_message
+    if text is None:
+        log.info("User message already saved by a previous attempt of this turn")
+        return
+    if save_message(session_id, "usuario", text) and journal:
+        journal.record(USER_MESSAGE_KEY, user_message)
+
+
+def _search_partner(session_id):
+    try:
+        return odoo.search_contact_by_phone(session_id)
+    except Exception as odoo_err:
+        log.warning(f"Odoo search_partner failed (non-fatal): {type(odoo_err).__name__}: {odoo_err}")
+        return None
+
+
+def run_odoo_crew(session_id: str, user_message: str, emit=None, raise_errors: bool = False) -> str:
+    """
+    Ejecuta un turno completo y devuelve la respuesta final.
+    Con 'emit' (callback de eventos dict) el turno se retransmite: progreso de herramientas y
+    tokens de la tarea final según se generan (ver chat_stream).
+    Si el turno falla devuelve una disculpa; con 'raise_errors' propaga la excepción (queue_worker
+    reintenta el lote en lugar de confirmarlo).
+    Cada turno emite un registro estructurado con el desglose de tiempos, tokens y coste (ver turn_metrics).
+    """
+    with track_turn(session_id) as turn:
+        return _run_turn(turn, session_id, user_message, emit, raise_errors)
+
+
+TURN_ERROR_MESSAGE = ("Disculpa, estoy experimentando dificultades técnicas. "
+                      "Por favor, inténtalo de nuevo en unos minutos. 🙏")
+
+
+def _turn_failed(turn: TurnRecord, raise_errors: bool) -> str:
+    import traceback
+    log.error(f"run_odoo_crew crash: {traceback.format_exc()}")
+    turn.path = "error"
+    if raise_errors:
+        raise
+    return TURN_ERROR_MESSAGE
+
+
+def _turn_flow(turn: TurnRecord, session_id: str, user_message: str, emit=None):
+    """
+    Turno sin E/S: cede cada operación (nombre, *args) y recibe su resultado. Lo ejecutan _run_turn
+    (hilos) y run_odoo_crew_async (event loop), cada uno con su forma de hacer la E/S:
+    - ("gather", session_id, user_message): lanza en paralelo los pasos 1-3 (guardar, resumen, historial, contacto)
+    - ("step", clave, inicio, timeout, valor_degradado, nombre): espera uno de esos pasos → (resultado, detalle)
+    - ("save", session_id, rol, texto), ("lookup_answer", mensaje), ("store_answer", mensaje, respuesta, partner)
+    - ("kickoff", turn, session_id, mensaje, historial, crm_context, emit): pasos 4-5 → texto final
+    """
+    try:
+        session_id = normalize_phone(session_id)
+    except ValueError as e:
+        log.error(f"crew_logic received invalid session_id {session_id[:8]}***: {e}")
+        raise e
+
+    # Pasos 1-3 en paralelo: guardar el mensaje, leer historial/resumen y buscar el contacto
+    # son independientes; la latencia previa al LLM pasa a ser la del más lento (con timeout).
+    gather_started = time.perf_counter()
+    yield ("gather", session_id, user_message)
+    intent = classify_intent(user_message)
+
+    _, save_ms = yield ("step", "save", gather_started, CONTEXT_SAVE_TIMEOUT, None, "save_message")
+    log.info(f"[STEP 1/6] Saved user message for session {session_id[:8]}*** ({save_ms})")
+
+    summary, summary_ms = yield ("step", "summary", gather_started, CONTEXT_HISTORY_TIMEOUT, "",
+                                 "get_conversation_summary")
+    recent_messages, recent_ms = yield ("step", "recent", gather_started, CONTEXT_HISTORY_TIMEOUT,
+                                        HISTORY_UNAVAILABLE, "get_recent_messages")
+    chat_history = build_history_context(summary, recent_messages)
+    log.info(f"[STEP 2/6] Fetched chat history (summary {summary_ms}, recent {recent_ms})")
+    has_previous_turns = "[AGENTE]:" in recent_messages or bool(summary)
+
+    # Atajo: pregunta FAQ ya respondida con el mismo catálogo → sin crew. Solo en conversaciones
+    # sin turnos previos: con historial la pregunta puede ser una continuación ("¿y la grande?").
+    # Sin historial fiable no se sabe si el mensaje depende de turnos anteriores.
+    standalone_turn = recent_messages != HISTORY_UNAVAILABLE and not has_previous_turns
+    cached_reply = (yield ("lookup_answer", user_message)) if standalone_turn else None
+    if cached_reply:
+        log.info("Answer cache hit. Skipping crew.kickoff()")
+        yield ("save", session_id, "agente", cached_reply)
+        schedule_summary_update(session_id, user_message, cached_reply)
+        if emit:
+            emit({"type": "token", "text": cached_reply})
+        _record_latency(turn, intent.intent, "cache")
+        return cached_reply
+
+    partner, partner_ms = yield ("step", "partner", gather_started, CONTEXT_ODOO_TIMEOUT, None,
+                                 "search_contact_by_phone")
+    context_elapsed = time.perf_counter() - gather_started
+    turn.step("context", context_elapsed)
+    log.info(f"[STEP 3/6] Searched partner in Odoo ({partner_ms}); "
+             f"context ready in {context_elapsed * 1000:.0f} ms")
+
+    # Atajo: saludo / agradecimiento / despedida → plantilla, sin LLM (no cambia el resumen)
+    fast_reply = render_fast_reply(intent, partner, has_previous_turns)
+    if fast_reply:
+        log.info(f"Intent fast path ({intent.intent}). Skipping crew.kickoff()")
+        yield ("save", session_id, "agente", fast_reply)
+        if emit:
+            emit({"type": "token", "text": fast_reply})
+        _record_latency(turn, intent.intent, "fast")
+        return fast_reply
+
+    crm_context = _crm_context(partner, session_id)
+    final_text = yield ("kickoff", turn, session_id, user_message, chat_history, crm_context, emit)
+
+    log.info("[STEP 6/6] Saving agent response")
+    with turn.timed("save_response"):
+        yield ("save", session_id, "agente", final_text)
+        schedule_summary_update(session_id, user_message, final_text)
+        if standalone_turn:
+            yield ("store_answer", user_message, final_text, partner)
+    _record_latency(turn, intent.intent, "crew")
+
+    log.info(f"Crew completed. Response length: {len(final_text)} chars")
+    return final_text
+
+
+def _run_turn(turn: TurnRecord, session_id: str, user_message: str, emit=None, raise_errors: bool = False) -> str:
+    futures = {}
+    # El diario (reintentos de queue_worker) es un contextvar: los hilos del contexto no lo heredan
+    journal = current_journal()
+
+    def gather(session_id, user_message):
+        futures.update(
+            save=_context_executor.submit(_timed, _save_user_message, session_id, user_message, journal),
+            summary=_context_executor.submit(
+                _timed, get_conversation_summary, session_id, max_age_hours=SUMMARY_MAX_AGE_HOURS),
+            recent=_context_executor.submit(
+                _timed, get_recent_messages, session_id, limit=HISTORY_VERBATIM_MESSAGES,
+                pending_user_message=user_message),
+            partner=_context_executor.submit(_timed, _search_partner, session_id),
+        )
+
+    operations = {
+        "gather": gather,
+        "step": lambda key, *args: _step_result(futures[key], *args),
+        "save": save_message,
+        "lookup_answer": lookup_answer,
+        "store_answer": store_answer,
+        "kickoff": _kickoff,
+    }
+    try:
+        flow = _turn_flow(turn, session_id, user_message, emit)
+        try:
+            operation = next(flow)
+            while True:
+                name, *args = operation
+                operation = flow.send(operations[name](*args))
+        except StopIteration as done:
+            return done.value
+    except Exception:
+        return _turn_failed(turn, raise_errors)
+
+
+# ==========================================
+# TURNO ASÍNCRONO (WhatsApp en el event loop)
+# ==========================================
+# El mismo _turn_flow, pero el contexto (Supabase y Odoo) y los guardados corren como corrutinas en el
+# event loop del servidor. Solo crew.kickoff() sale del loop: CrewAI ejecuta las herramientas de forma
+# síncrona incluso en akickoff(), y en el loop bloquearían a todo el servidor.
+
+async def _atimed(coro):
+    step_started = time.perf_counter()
+    result = await coro
+    return result, time.perf_counter() - step_started
+
+
+async def _astep_result(task, gather_started, timeout, fallback, name):
+    """_step_result para tareas asyncio; un paso que vence su timeout sigue en segundo plano."""
+    remaining = max(timeout - (time.perf_counter() - gather_started), 0)
+    try:
+        result, elapsed = await asyncio.wait_for(asyncio.shield(task), remaining)
+        record_step(name, elapsed)
+        return result, f"{elapsed * 1000:.0f} ms"
+    except asyncio.TimeoutError:
+        log.warning(f"{name} timed out after {timeout}s, continuing with fallback")
+        record_step(name, timeout)
+        return fallback, f"timeout {timeout}s"
     except Exception as e:
-        import traceback
-        log.error(f"run_odoo_crew crash: {traceback.format_exc()}")
-        return "Disculpa, estoy experimentando dificultades técnicas. Por favor, inténtalo de nuevo en unos minutos. 🙏"
+        log.warning(f"{name} failed (non-fatal): {type(e).__name__}: {e}")
+        return fallback, "failed"
+
+
+async def _asearch_partner(session_id):
+    try:
+        return await odoo.search_contact_by_phone_async(session_id)
+    except Exception as odoo_err:
+        log.warning(f"Odoo search_partner failed (non-fatal): {type(odoo_err).__name__}: {odoo_err}")
+        return None
+
+
+async def run_odoo_crew_async(session_id: str, user_message: str,
+                              run_blocking: Callable[..., Awaitable], raise_errors: bool = False) -> str:
+    """
+    run_odoo_crew como corrutina. 'run_blocking(fn, *args)' ejecuta el crew fuera del loop (el ejecutor
+    acotado del servidor) y lo espera; si lanza ExecutorSaturated se propaga siempre, para que el llamante
+    conteste "estamos ocupados".
+    """
+    tasks = {}
+
+    async def gather(session_id, user_message):
+        tasks.update(
+            save=asyncio.ensure_future(_atimed(asave_message(session_id, "usuario", user_message))),
+            summary=asyncio.ensure_future(_atimed(
+                aget_conversation_summary(session_id, max_age_hours=SUMMARY_MAX_AGE_HOURS))),
+            recent=asyncio.ensure_future(_atimed(
+                aget_recent_messages(session_id, limit=HISTORY_VERBATIM_MESSAGES,
+                                     pending_user_message=user_message))),
+            partner=asyncio.ensure_future(_atimed(_asearch_partner(session_id))),
+        )
+
+    def kickoff(*args):
+        # El hilo del crew necesita el registro del turno (contextvar) para anotar LLM y herramientas
+        return run_blocking(contextvars.copy_context().run, _kickoff, *args)
+
+    # La caché de respuestas calcula un embedding (cliente OpenAI síncrono): en un hilo
+    operations = {
+        "gather": gather,
+        "step": lambda key, *args: _astep_result(tasks[key], *args),
+        "save": asave_message,
+        "lookup_answer": lambda *args: asyncio.to_thread(lookup_answer, *args),
+        "store_answer": lambda *args: asyncio.to_thread(store_answer, *args),
+        "kickoff": kickoff,
+    }
+    with track_turn(session_id) as turn:
+        try:
+            flow = _turn_flow(turn, session_id, user_message)
+            try:
+                operation = next(flow)
+                while True:
+                    name, *args = operation
+                    operation = flow.send(await operations[name](*args))
+            except StopIteration as done:
+                return done.value
+        except ExecutorSaturated:
+            turn.path = "busy"
+            raise
+        except Exception:
+            return _turn_failed(turn, raise_errors)
@@ -0,0 +1,116 @@
+"""
+Pool de "bundles" de crew pre-construidos (agentes + herramientas + cliente LLM propios).
+Cada turno toma un bundle en exclusiva y lo devuelve limpio al terminar: ningún agente se comparte
+entre hilos concurrentes y el coste de construir agentes/herramientas/LLM se paga una sola vez.
+El objeto Crew en sí es barato y se crea por turno con las tareas del mensaje.
+"""
+import queue
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional
+from logger import get_logger
+
+log = get_logger("crew_pool")
+
+
+@dataclass
+class CrewBundle:
+    """Agentes aislados de un turno, cada uno con su propio cliente LLM."""
+    support_agent: object
+    secretary_agent: object
+    turns: int = 0
+
+    @property
+    def agents(self) -> List:
+        return [self.support_agent, self.secretary_agent]
+
+    def reset(self) -> None:
+        """Deja el bundle como recién construido (sin resultados, reintentos, streaming ni uso de tokens del turno)."""
+        for agent in self.agents:
+            agent.tools_results = []
+            agent.crew = None
+            if hasattr(agent.llm, "stream"):
+                agent.llm.stream = False
+            if hasattr(agent, "_times_executed"):
+                agent._times_executed = 0
+            usage = getattr(agent.llm, "_token_usage", None)
+            if isinstance(usage, dict):
+                for key in usage:
+                    usage[key] = 0
+
+
+class CrewPool:
+    """Pool acotado: crea bundles bajo demanda hasta 'size' y después espera a que se libere uno."""
+
+    def __init__(self, factory: Callable[[], CrewBundle], size: int = 2, checkout_timeout: float = 30.0) -> None:
+        self._factory = factory
+        self.size = size
+        self.checkout_timeout = checkout_timeout
+        self._idle: "queue.LifoQueue[CrewBundle]" = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _create(self) -> Optional[CrewBundle]:
+        with self._lock:
+            if self._created >= self.size:
+                return None
+            self._created += 1
+        try:
+            bundle = self._factory()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+        log.info(f"Crew bundle built ({self._created}/{self.size})")
+        return bundle
+
+    def warm(self, count: int = 1) -> None:
+        """Construye por adelantado hasta 'count' bundles (arranque del proceso)."""
+        for _ in range(count):
+            bundle = self._create()
+            if bundle is None:
+                break
+            self._idle.put(bundle)
+
+    def checkout(self, timeout: Optional[float] = None) -> CrewBundle:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        bundle = self._create()
+        if bundle is not None:
+            return bundle
+        try:
+            return self._idle.get(timeout=self.checkout_timeout if timeout is None else timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No crew bundle available after {self.checkout_timeout}s (pool size {self.size})")
+
+    def checkin(self, bundle: CrewBundle) -> None:
+        bundle.turns += 1
+        bundle.reset()
+        self._idle.put(bundle)
+
+    def discard(self, bundle: CrewBundle) -> None:
+        """Retira un bundle (p. ej. tras un error a mitad de turno); se reconstruirá bajo demanda."""
+        with self._lock:
+            self._created -= 1
+        log.warning(f"Crew bundle discarded after {bundle.turns} turns")
+
+    @contextmanager
+    def lease(self, timeout: Optional[float] = None) -> Iterator[CrewBundle]:
+        """Bundle en exclusiva durante el bloque; se limpia y devuelve al salir (o se descarta si falla)."""
+        bundle = self.checkout(timeout)
+        try:
+            yield bundle
+        except BaseException:
+            self.discard(bundle)
+            raise
+        else:
+            self.checkin(bundle)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            created = self._created
+        idle = self._idle.qsize()
+        return {"size": self.size, "created": created, "idle": idle, "in_use": created - idle}
@@ -0,0 +1,165 @@
+"""
+Caché de embeddings en dos niveles: LRU en memoria + SQLite en disco.
+La clave es un hash del texto normalizado y del modelo, así las preguntas repetidas
+("precio tortillas de maíz", "horario") no vuelven a pagar la llamada a OpenAI.
+La normalización solo da forma a la clave: a OpenAI se le envía el texto original.
+El fichero SQLite se abre en el primer uso, no al importar el módulo.
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from openai import OpenAI
+from config import OPENAI_API_KEY, EMBEDDING_MODEL, EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_SIZE
+from logger import get_logger
+
+log = get_logger("embedding_cache")
+
+# Cliente OpenAI para embeddings
+_openai_client = OpenAI(api_key=OPENAI_API_KEY)
+
+
+def normalize_text(text: str) -> str:
+    """Normaliza una consulta: Unicode NFKC, minúsculas y espacios colapsados."""
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def cache_key(text: str, model: str) -> str:
+    """Clave estable de la caché: sha256 del modelo + texto normalizado."""
+    return hashlib.sha256(f"{model}\n{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Caché de vectores con LRU en memoria y almacén persistente SQLite (float32)."""
+
+    def __init__(self, path: str = "", max_memory_items: int = 2048) -> None:
+        self.max_memory_items = max_memory_items
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._stats: Dict[str, int] = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        # Ruta pendiente de abrir; se vacía tras el primer intento (con éxito o no)
+        self._pending_path = path
+
+    def _disk(self) -> Optional[sqlite3.Connection]:
+        """Conexión SQLite, abierta en el primer uso. Llamar con el lock tomado."""
+        if self._pending_path:
+            path, self._pending_path = self._pending_path, ""
+            self._open_disk_store(path)
+        return self._db
+
+    def _open_disk_store(self, path: str) -> None:
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(path, check_same_thread=False, timeout=5.0)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " key TEXT PRIMARY KEY, model TEXT NOT NULL, dims INTEGER NOT NULL,"
+                " vector BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+            db.commit()
+            self._db = db
+        except sqlite3.Error as e:
+            # Sin disco seguimos funcionando solo con la LRU en memoria
+            log.warning(f"Embedding disk cache disabled: {type(e).__name__}: {e}")
+            self._db = None
+
+    def _remember(self, key: str, embedding: List[float]) -> None:
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[List[float]]:
+        """Devuelve el vector cacheado o None (memoria primero, luego disco)."""
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return embedding
+
+            db = self._disk()
+            if db is not None:
+                try:
+                    row = db.execute(
+                        "SELECT vector FROM embeddings WHERE key = ?", (key,)
+                    ).fetchone()
+                except sqlite3.Error as e:
+                    log.warning(f"Embedding disk cache read failed: {type(e).__name__}")
+                    row = None
+                if row:
+                    embedding = array("f", row[0]).tolist()
+                    self._remember(key, embedding)
+                    self._stats["disk_hits"] += 1
+                    return embedding
+
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, key: str, model: str, embedding: List[float]) -> None:
+        """Guarda un vector en ambos niveles."""
+        with self._lock:
+            self._remember(key, embedding)
+            db = self._disk()
+            if db is None:
+                return
+            try:
+                db.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, model, dims, vector, created_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, model, len(embedding), array("f", embedding).tobytes(), time.time()),
+                )
+                db.commit()
+            except sqlite3.Error as e:
+                log.warning(f"Embedding disk cache write failed: {type(e).__name__}")
+
+    def stats(self) -> Dict[str, int]:
+        """Contadores de aciertos/fallos para observabilidad."""
+        with self._lock:
+            return dict(self._stats, memory_items=len(self._memory))
+
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_SIZE)
+
+
+def request_embeddings(texts: List[str], model: str = EMBEDDING_MODEL) -> List[List[float]]:
+    """Llamada directa (sin caché) a OpenAI con muchos textos en una sola petición."""
+    response = _openai_client.embeddings.create(input=texts, model=model)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+def embed_texts(texts: List[str], model: str = EMBEDDING_MODEL) -> List[List[float]]:
+    """Devuelve los embeddings de varios textos, pidiendo a OpenAI solo los que faltan (en un único lote)."""
+    keys = [cache_key(t, model) for t in texts]
+    results: List[Optional[List[float]]] = [embedding_cache.get(k) for k in keys]
+
+    # Textos pendientes (tal cual los escribió el usuario), sin repetir claves dentro del mismo lote
+    pending: Dict[str, str] = {}
+    for key, text, cached in zip(keys, texts, results):
+        if cached is None and key not in pending:
+            pending[key] = text
+
+    if pending:
+        vectors = request_embeddings(list(pending.values()), model)
+        fresh = dict(zip(pending.keys(), vectors))
+        for key, embedding in fresh.items():
+            embedding_cache.put(key, model, embedding)
+        results = [r if r is not None else fresh[k] for k, r in zip(keys, results)]
+
+    return results
+
+
+def embed_query(text: str, model: str = EMBEDDING_MODEL) -> List[float]:
+    """Embedding de una sola consulta con caché."""
+    return embed_texts([text], model)[0]
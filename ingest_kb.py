@@ -0,0 +1,265 @@
+"""
+Ingesta por lotes de la base de conocimientos (tabla kb_items que consulta match_kb_items).
+Ejecutar con: python ingest_kb.py docs/catalogo.md docs/faq/ [--prune]
+
+Flujo en streaming (no carga todos los documentos en memoria):
+- Lee ficheros .txt / .md (un documento por fichero) y .jsonl (una línea = {"content": ...}).
+- Trocea por párrafos hasta --chunk-size caracteres, con solape en párrafos muy largos.
+- Deduplica por hash de contenido (sha256 del texto normalizado), dentro del lote y contra kb_items.
+- Pide embeddings en lotes de --batch-size entradas por llamada, con --concurrency llamadas en vuelo.
+- Hace upsert masivo en kb_items por content_hash (requiere índice único en kb_items.content_hash).
+
+Al re-ejecutar solo se embeben los trozos nuevos o modificados. Cada fila guarda en metadata.sources
+todas las fuentes que contienen el trozo; --prune quita de esa lista las fuentes procesadas que ya no
+lo contienen y solo borra la fila cuando no queda ninguna.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import argparse
+import hashlib
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, wait
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from embedding_cache import normalize_text, request_embeddings
+from logger import get_logger
+
+log = get_logger("ingest_kb")
+
+SUPPORTED_EXTENSIONS = (".txt", ".md", ".jsonl")
+PAGE_SIZE = 1000
+DELETE_BATCH = 100
+
+
+# ==========================================
+# 1. LECTURA Y TROCEADO
+# ==========================================
+
+def iter_documents(paths: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """Genera (source, texto) recorriendo ficheros y directorios."""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if name.endswith(SUPPORTED_EXTENSIONS):
+                        yield from iter_documents([os.path.join(root, name)])
+            continue
+
+        if path.endswith(".jsonl"):
+            with open(path, encoding="utf-8") as f:
+                for line_no, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    text = record.get("content") or record.get("text") or ""
+                    if text:
+                        yield record.get("source") or f"{path}#{line_no}", text
+        else:
+            with open(path, encoding="utf-8") as f:
+                yield path, f.read()
+
+
+def chunk_text(text: str, chunk_size: int = 800, overlap: int = 100) -> List[str]:
+    """Agrupa párrafos hasta chunk_size caracteres; los párrafos más largos se cortan con solape."""
+    paragraphs = [p.strip() for p in re.split(r"\n\s*\n", text) if p.strip()]
+    chunks: List[str] = []
+    current = ""
+    for paragraph in paragraphs:
+        paragraph = re.sub(r"[ \t]+", " ", paragraph)
+        if len(paragraph) > chunk_size:
+            if current:
+                chunks.append(current)
+                current = ""
+            step = max(chunk_size - overlap, 1)
+            for start in range(0, len(paragraph), step):
+                chunks.append(paragraph[start:start + chunk_size])
+                if start + chunk_size >= len(paragraph):
+                    break
+        elif current and len(current) + 2 + len(paragraph) > chunk_size:
+            chunks.append(current)
+            current = paragraph
+        else:
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def content_hash(text: str) -> str:
+    """Hash del contenido normalizado: dos trozos iguales salvo espacios/mayúsculas son el mismo."""
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def _sources_of(metadata: Dict) -> List[str]:
+    """Fuentes de una fila; las filas antiguas solo tienen metadata.source."""
+    if metadata.get("sources"):
+        return list(metadata["sources"])
+    return [metadata["source"]] if metadata.get("source") else []
+
+
+def iter_batches(items: Iterable, size: int) -> Iterator[List]:
+    """Agrupa un iterable en listas de 'size' elementos sin materializarlo entero."""
+    batch: List = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# ==========================================
+# 2. ESCRITURA EN SUPABASE
+# ==========================================
+
+class KBWriter:
+    """Acceso a kb_items para la ingesta: hashes existentes, upsert masivo, re-etiquetado y poda."""
+
+    def __init__(self, table: str = "kb_items") -> None:
+        from tools_supabase import supabase
+        self.supabase = supabase
+        self.table = table
+
+    def existing_metadata(self) -> Dict[str, Dict]:
+        """Devuelve {content_hash: metadata} de las filas ya ingestadas."""
+        existing: Dict[str, Dict] = {}
+        start = 0
+        while True:
+            res = (self.supabase.table(self.table).select("content_hash,metadata")
+                   .order("content_hash").range(start, start + PAGE_SIZE - 1).execute())
+            rows = res.data or []
+            existing.update((r["content_hash"], r.get("metadata") or {}) for r in rows if r.get("content_hash"))
+            if len(rows) < PAGE_SIZE:
+                return existing
+            start += PAGE_SIZE
+
+    def upsert(self, rows: List[Dict]) -> None:
+        self.supabase.table(self.table).upsert(rows, on_conflict="content_hash").execute()
+
+    def relabel(self, digest: str, metadata: Dict) -> None:
+        """Actualiza metadata de un trozo existente sin tocar su embedding."""
+        self.supabase.table(self.table).update({"metadata": metadata}).eq("content_hash", digest).execute()
+
+    def delete(self, hashes: List[str]) -> None:
+        for start in range(0, len(hashes), DELETE_BATCH):
+            chunk = hashes[start:start + DELETE_BATCH]
+            self.supabase.table(self.table).delete().in_("content_hash", chunk).execute()
+
+
+# ==========================================
+# 3. PIPELINE
+# ==========================================
+
+def ingest(
+    paths: Iterable[str],
+    writer: KBWriter,
+    embed: Callable[[List[str]], List[List[float]]] = request_embeddings,
+    batch_size: int = 96,
+    concurrency: int = 4,
+    chunk_size: int = 800,
+    overlap: int = 100,
+    agent_id: Optional[str] = None,
+    prune: bool = False,
+) -> Dict[str, int]:
+    """Ejecuta la ingesta completa y devuelve contadores del proceso."""
+    stats = {"documents": 0, "chunks": 0, "duplicates": 0, "unchanged": 0, "relabeled": 0,
+             "embedded": 0, "batches": 0, "pruned": 0}
+    known = writer.existing_metadata()
+    # Fuentes en las que aparece cada hash en esta ejecución y metadata con la que se insertó
+    found: Dict[str, Set[str]] = {}
+    written: Dict[str, Dict] = {}
+    processed: Set[str] = set()
+
+    def pending_chunks() -> Iterator[Dict]:
+        for source, text in iter_documents(paths):
+            stats["documents"] += 1
+            processed.add(source)
+            for position, chunk in enumerate(chunk_text(text, chunk_size, overlap)):
+                stats["chunks"] += 1
+                digest = content_hash(chunk)
+                if digest in found:
+                    stats["duplicates"] += 1
+                    found[digest].add(source)
+                    continue
+                found[digest] = {source}
+                if digest in known:
+                    stats["unchanged"] += 1
+                    continue
+                metadata = {"source": source, "sources": [source], "chunk": position}
+                written[digest] = metadata
+                yield {"content": chunk, "content_hash": digest, "metadata": metadata}
+
+    def process(batch: List[Dict]) -> int:
+        vectors = embed([row["content"] for row in batch])
+        now = datetime.now(timezone.utc).isoformat()
+        rows = [dict(row, embedding=vector, agent_id=agent_id, updated_at=now)
+                for row, vector in zip(batch, vectors)]
+        writer.upsert(rows)
+        return len(rows)
+
+    # Como mucho 'concurrency' lotes en vuelo: la lectura no se adelanta más de lo necesario
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight: Set[Future] = set()
+        for batch in iter_batches(pending_chunks(), batch_size):
+            if len(in_flight) >= concurrency:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stats["embedded"] += future.result()
+            in_flight.add(executor.submit(process, batch))
+            stats["batches"] += 1
+        for future in in_flight:
+            stats["embedded"] += future.result()
+
+    # Un trozo pertenece a todas las fuentes que lo contienen (movido o duplicado entre ficheros);
+    # con --prune solo se borra cuando ya no queda en ninguna
+    stale: List[str] = []
+    for digest, metadata in {**known, **written}.items():
+        previous = set(_sources_of(metadata))
+        current = previous - processed if prune else set(previous)
+        current |= found.get(digest, set())
+        if not current:
+            stale.append(digest)
+        elif current != previous:
+            primary = metadata.get("source") if metadata.get("source") in current else min(current)
+            writer.relabel(digest, dict(metadata, source=primary, sources=sorted(current)))
+            stats["relabeled"] += 1
+    if stale:
+        writer.delete(sorted(stale))
+        stats["pruned"] = len(stale)
+
+    log.info(f"KB ingestion finished: {stats}")
+    return stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Ingesta de documentos en kb_items")
+    parser.add_argument("paths", nargs="+", help="Ficheros o directorios (.txt, .md, .jsonl)")
+    parser.add_argument("--batch-size", type=int, default=96, help="Textos por llamada de embeddings")
+    parser.add_argument("--concurrency", type=int, default=4, help="Llamadas de embeddings en paralelo")
+    parser.add_argument("--chunk-size", type=int, default=800, help="Tamaño máximo de trozo (caracteres)")
+    parser.add_argument("--overlap", type=int, default=100, help="Solape al cortar párrafos largos")
+    parser.add_argument("--agent-id", default=None, help="agent_id a asignar a los trozos")
+    parser.add_argument("--prune", action="store_true",
+                        help="Borra los trozos que ya no aparecen en ninguna fuente")
+    args = parser.parse_args()
+
+    print("\n📚 Ingesta de la base de conocimientos")
+    stats = ingest(
+        args.paths, KBWriter(),
+        batch_size=args.batch_size, concurrency=args.concurrency,
+        chunk_size=args.chunk_size, overlap=args.overlap,
+        agent_id=args.agent_id, prune=args.prune,
+    )
+    print(f"  ✅ {stats['documents']} documentos, {stats['chunks']} trozos")
+    print(f"  ♻️  {stats['unchanged']} sin cambios ({stats['relabeled']} re-etiquetados), "
+          f"{stats['duplicates']} duplicados")
+    print(f"  🧠 {stats['embedded']} embebidos en {stats['batches']} lotes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+Pre-clasificador de intención previo al crew.
+Reglas de palabras clave/regex (y, opcionalmente, un modelo Naive Bayes local entrenado con
+ejemplos) para responder saludos, agradecimientos y despedidas con plantillas personalizadas
+con el nombre del CRM, y mandar al crew solo los turnos de CONSULTA / PEDIDO / REUNIÓN.
+"""
+import json
+import math
+import os
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from logger import get_logger
+
+log = get_logger("intent_router")
+
+AGENT_NAME = os.getenv("AGENT_NAME", "Sofía")
+TENANT_NAME = os.getenv("TENANT_NAME", "Tortillas Mejicanas")
+
+SALUDO = "SALUDO"
+AGRADECIMIENTO = "AGRADECIMIENTO"
+DESPEDIDA = "DESPEDIDA"
+CONSULTA = "CONSULTA"
+PEDIDO = "PEDIDO"
+REUNION = "REUNIÓN"
+OTRO = "OTRO"
+
+# Intenciones que se contestan con plantilla, sin LLM
+TRIVIAL_INTENTS = (SALUDO, AGRADECIMIENTO, DESPEDIDA)
+
+# Mensajes triviales: solo frases de la lista "permitidas" y al menos una "obligatoria".
+# "vale" / "ok" a secas NO son triviales: pueden confirmar un pedido en curso.
+_TRIVIAL_PHRASES: Dict[str, Tuple[List[str], List[str]]] = {
+    SALUDO: (
+        ["hola", "holi", "hey", "buenas", "buenos dias", "buenas tardes", "buenas noches", "saludos",
+         "que tal", "como estas", "hello", "hi"],
+        ["hola", "holi", "hey", "buenas", "buenos dias", "buenas tardes", "buenas noches", "saludos",
+         "hello", "hi"],
+    ),
+    AGRADECIMIENTO: (
+        ["gracias", "muchas gracias", "mil gracias", "muchisimas gracias", "thanks"],
+        ["gracias", "thanks"],
+    ),
+    DESPEDIDA: (
+        ["adios", "hasta luego", "hasta pronto", "hasta manana", "nos vemos", "chao", "chau", "bye",
+         "gracias", "muchas gracias", "buenas noches"],
+        ["adios", "hasta luego", "hasta pronto", "hasta manana", "nos vemos", "chao", "chau", "bye"],
+    ),
+}
+
+
+def _phrase_regex(phrases: List[str], whole: bool) -> "re.Pattern":
+    alternatives = "|".join(sorted((re.escape(p) for p in phrases), key=len, reverse=True))
+    if whole:
+        return re.compile(rf"^(?:\s*(?:{alternatives})\b)+\s*$")
+    return re.compile(rf"\b(?:{alternatives})\b")
+
+
+_TRIVIAL_RULES = [
+    (intent, _phrase_regex(allowed, whole=True), _phrase_regex(required, whole=False))
+    for intent, (allowed, required) in _TRIVIAL_PHRASES.items()
+]
+
+
+def _normalize(text: str) -> str:
+    """Minúsculas sin tildes ni signos/emojis; también se quita el nombre de la agente."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^a-z0-9ñ\s]", " ", text)
+    agent = unicodedata.normalize("NFKD", AGENT_NAME.lower())
+    agent = "".join(c for c in agent if not unicodedata.combining(c))
+    text = re.sub(rf"\b{re.escape(agent)}\b", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+_ROUTING_RULES: List[Tuple[str, "re.Pattern"]] = [
+    (REUNION, re.compile(r"\b(reuni[oó]n|cita|agendar|agenda|quedar|llamada|videollamada|visita|"
+                         r"reservar hora)\b", re.IGNORECASE)),
+    (PEDIDO, re.compile(r"\b(quiero|quisiera|necesito|pedido|pedir|encargar|encargo|comprar|"
+                        r"me pones|ponme|env[ií]ame)\b"
+                        r"|\b\d+\s*(cajas?|packs?|uds?|unidades|bolsas?|botellas?|kg|kilos?)\b", re.IGNORECASE)),
+    (CONSULTA, re.compile(r"\?|\b(precios?|cu[aá]nto|cuesta|horarios?|tienen|ten[eé]is|hay|venden|"
+                          r"productos?|cat[aá]logo|env[ií]os?|entregas?|ingredientes?|info|informaci[oó]n|"
+                          r"tortillas?|totopos|salsas?|masa|nopal)\b", re.IGNORECASE)),
+]
+
+
+@dataclass
+class IntentResult:
+    intent: str
+    confidence: float
+    source: str  # "rules" | "model" | "default"
+
+    @property
+    def trivial(self) -> bool:
+        return self.intent in TRIVIAL_INTENTS and self.confidence >= 0.9
+
+
+class NaiveBayesIntentModel:
+    """Modelo local minúsculo (Naive Bayes multinomial sobre palabras) entrenado con ejemplos JSONL."""
+
+    def __init__(self, examples: List[Dict[str, str]]) -> None:
+        self._word_counts: Dict[str, Counter] = defaultdict(Counter)
+        self._class_counts: Counter = Counter()
+        for example in examples:
+            self._class_counts[example["intent"]] += 1
+            self._word_counts[example["intent"]].update(self._tokens(example["text"]))
+        self._vocabulary = {w for counts in self._word_counts.values() for w in counts}
+        self._totals = {intent: sum(counts.values()) for intent, counts in self._word_counts.items()}
+
+    @staticmethod
+    def _tokens(text: str) -> List[str]:
+        return re.findall(r"\w+", text.lower())
+
+    @classmethod
+    def from_file(cls, path: str) -> "NaiveBayesIntentModel":
+        with open(path, encoding="utf-8") as f:
+            return cls([json.loads(line) for line in f if line.strip()])
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """Intención más probable y su probabilidad a posteriori."""
+        total_examples = sum(self._class_counts.values())
+        vocab_size = len(self._vocabulary) or 1
+        log_probs = {}
+        for intent, class_count in self._class_counts.items():
+            score = math.log(class_count / total_examples)
+            for token in self._tokens(text):
+                score += math.log((self._word_counts[intent][token] + 1) / (self._totals[intent] + vocab_size))
+            log_probs[intent] = score
+        best = max(log_probs, key=log_probs.get)
+        norm = sum(math.exp(v - log_probs[best]) for v in log_probs.values())
+        return best, 1.0 / norm
+
+
+_local_model: Optional[NaiveBayesIntentModel] = None
+_local_model_loaded = False
+
+
+def _get_local_model() -> Optional[NaiveBayesIntentModel]:
+    global _local_model, _local_model_loaded
+    if not _local_model_loaded:
+        _local_model_loaded = True
+        path = os.getenv("INTENT_MODEL_EXAMPLES", "")
+        if path:
+            try:
+                _local_model = NaiveBayesIntentModel.from_file(path)
+                log.info(f"Local intent model loaded from {path}")
+            except Exception as e:
+                log.warning(f"Local intent model disabled: {type(e).__name__}: {e}")
+    return _local_model
+
+
+def classify_intent(message: str) -> IntentResult:
+    """Clasifica el mensaje: reglas primero; el modelo local solo decide si las reglas no lo hacen."""
+    text = (message or "").strip()
+
+    normalized = _normalize(text)
+    for intent, allowed, required in _TRIVIAL_RULES:
+        if normalized and allowed.match(normalized) and required.search(normalized):
+            return IntentResult(intent, 1.0, "rules")
+
+    for intent, pattern in _ROUTING_RULES:
+        if pattern.search(text):
+            return IntentResult(intent, 0.8, "rules")
+
+    model = _get_local_model()
+    if model is not None:
+        intent, probability = model.predict(text)
+        # Un saludo "por modelo" solo es plantilla si el mensaje es realmente corto
+        if intent in TRIVIAL_INTENTS and len(text.split()) > 4:
+            probability = min(probability, 0.5)
+        return IntentResult(intent, probability, "model")
+
+    return IntentResult(OTRO, 0.5, "default")
+
+
+def render_fast_reply(intent: IntentResult, partner: Optional[Dict], has_previous_turns: bool) -> Optional[str]:
+    """Respuesta de plantilla para intenciones triviales (None si el turno debe ir al crew)."""
+    if not intent.trivial:
+        return None
+
+    name = ""
+    if partner and partner.get("name") and partner["name"] != "Lead":
+        name = partner["name"]
+
+    if intent.intent == SALUDO:
+        if name:
+            return f"¡Hola {name}! 😊 ¿En qué puedo ayudarte hoy?"
+        if has_previous_turns:
+            return "¡Hola de nuevo! 😊 ¿En qué más puedo ayudarte?"
+        return f"¡Hola! Soy {AGENT_NAME}, tu asistente de {TENANT_NAME} 🌮 ¿En qué puedo ayudarte?"
+    if intent.intent == AGRADECIMIENTO:
+        return f"¡A ti{', ' + name if name else ''}! 😊 Si necesitas algo más, aquí estoy."
+    if intent.intent == DESPEDIDA:
+        return f"¡Hasta pronto{', ' + name if name else ''}! 👋 Que tengas un buen día."
+    return None
@@ -0,0 +1,375 @@
+"""
+Cola duradera de mensajes entrantes (webhook de WhatsApp → workers).
+El webhook encola antes de responder 200 a Meta y procesos worker independientes (queue_worker.py)
+la drenan, así que un reinicio no pierde mensajes y la ingesta escala aparte de los crews.
+
+Semántica común a los dos backends (SQLite local y Redis):
+- Los trabajos se agrupan por 'group' (el teléfono) y un grupo se entrega entero como un lote:
+  FIFO por grupo y nunca dos lotes del mismo grupo a la vez (equivale al buzón por teléfono).
+- Un grupo está listo cuando lleva 'quiet_seconds' sin mensajes nuevos o su primer mensaje
+  pendiente tiene más de 'max_wait_seconds' (mismo debounce que phone_mailbox).
+- Al reservar, el lote queda invisible 'visibility_timeout' segundos; si el worker no hace ack
+  a tiempo (caída, bloqueo) vuelve a entregarse: entrega al menos una vez.
+- ack/release/dead_letter solo tienen efecto con el recibo de la reserva vigente.
+- save_progress guarda en el primer trabajo del lote un diario del turno (ver turn_journal) que se
+  entrega con el lote en los reintentos, aunque los reserve otro worker.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from config import (
+    JOB_QUEUE_BACKEND, JOB_QUEUE_PATH, WHATSAPP_DEBOUNCE_SECONDS, WHATSAPP_DEBOUNCE_MAX_SECONDS
+)
+from logger import get_logger
+
+log = get_logger("job_queue")
+
+# Máximo de mensajes por lote (una ráfaga muy larga se reparte en varios turnos)
+MAX_BATCH = 20
+
+
+@dataclass
+class JobBatch:
+    """Trabajos pendientes de un grupo, reservados juntos."""
+    group: str
+    ids: List[str]
+    payloads: List[Dict]
+    attempts: int
+    receipt: str
+    progress: Dict[str, str] = field(default_factory=dict)
+
+
+class SQLiteJobQueue:
+    """Cola en un fichero SQLite (WAL); varios procesos del mismo host pueden compartirla."""
+
+    def __init__(self, path: str, quiet_seconds: float = 0.0, max_wait_seconds: float = 0.0) -> None:
+        self.quiet_seconds = quiet_seconds
+        self.max_wait_seconds = max_wait_seconds
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Transacciones explícitas: BEGIN IMMEDIATE serializa las reservas entre procesos
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=10.0, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, grp TEXT NOT NULL, payload TEXT NOT NULL,"
+            " created_at REAL NOT NULL, visible_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0,"
+            " receipt TEXT, progress TEXT)"
+        )
+        # Ficheros creados antes de que existiera el diario del turno
+        if "progress" not in {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}:
+            self._db.execute("ALTER TABLE jobs ADD COLUMN progress TEXT")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_grp ON jobs (grp, id)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS dead_jobs ("
+            " id INTEGER PRIMARY KEY, grp TEXT NOT NULL, payload TEXT NOT NULL, created_at REAL NOT NULL,"
+            " attempts INTEGER NOT NULL, reason TEXT, failed_at REAL NOT NULL)"
+        )
+        self._lock = threading.Lock()
+
+    def _transaction(self, func):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(self._db)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return result
+
+    def enqueue(self, group: str, payload: Dict) -> str:
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO jobs (grp, payload, created_at, visible_at) VALUES (?, ?, ?, ?)",
+                (group, json.dumps(payload, ensure_ascii=False), now, now),
+            )
+        return str(cursor.lastrowid)
+
+    def reserve(self, visibility_timeout: float) -> Optional[JobBatch]:
+        def claim(db: sqlite3.Connection) -> Optional[JobBatch]:
+            now = time.time()
+            # Grupo sin trabajos en vuelo (ni aplazados) y con la ráfaga terminada
+            row = db.execute(
+                "SELECT grp FROM jobs GROUP BY grp"
+                " HAVING MAX(visible_at) <= :now"
+                " AND (MAX(created_at) <= :now - :quiet OR MIN(created_at) <= :now - :max_wait)"
+                " ORDER BY MIN(id) LIMIT 1",
+                {"now": now, "quiet": self.quiet_seconds, "max_wait": self.max_wait_seconds},
+            ).fetchone()
+            if row is None:
+                return None
+            group = row[0]
+            rows = db.execute(
+                "SELECT id, payload, attempts, progress FROM jobs WHERE grp = ? ORDER BY id LIMIT ?",
+                (group, MAX_BATCH)
+            ).fetchall()
+            receipt = uuid.uuid4().hex
+            ids = [r[0] for r in rows]
+            db.execute(
+                f"UPDATE jobs SET visible_at = ?, attempts = attempts + 1, receipt = ?"
+                f" WHERE id IN ({','.join('?' * len(ids))})",
+                (now + visibility_timeout, receipt, *ids),
+            )
+            return JobBatch(group, [str(i) for i in ids], [json.loads(r[1]) for r in rows],
+                            max(r[2] for r in rows) + 1, receipt, json.loads(rows[0][3] or "{}"))
+        return self._transaction(claim)
+
+    def _owned(self, db: sqlite3.Connection, batch: JobBatch) -> bool:
+        placeholders = ",".join("?" * len(batch.ids))
+        count = db.execute(
+            f"SELECT COUNT(*) FROM jobs WHERE receipt = ? AND id IN ({placeholders})", (batch.receipt, *batch.ids)
+        ).fetchone()[0]
+        return count == len(batch.ids)
+
+    def ack(self, batch: JobBatch) -> bool:
+        def delete(db: sqlite3.Connection) -> bool:
+            if not self._owned(db, batch):
+                return False
+            db.execute(f"DELETE FROM jobs WHERE id IN ({','.join('?' * len(batch.ids))})", batch.ids)
+            return True
+        return self._transaction(delete)
+
+    def release(self, batch: JobBatch, delay: float = 0.0) -> bool:
+        """Devuelve el lote a la cola (visible tras 'delay'); el grupo sigue bloqueado hasta entonces."""
+        def requeue(db: sqlite3.Connection) -> bool:
+            if not self._owned(db, batch):
+                return False
+            db.execute(
+                f"UPDATE jobs SET visible_at = ?, receipt = NULL WHERE id IN ({','.join('?' * len(batch.ids))})",
+                (time.time() + delay, *batch.ids),
+            )
+            return True
+        return self._transaction(requeue)
+
+    def save_progress(self, batch: JobBatch, progress: Dict[str, str]) -> bool:
+        def update(db: sqlite3.Connection) -> bool:
+            if not self._owned(db, batch):
+                return False
+            db.execute("UPDATE jobs SET progress = ? WHERE id = ?",
+                       (json.dumps(progress, ensure_ascii=False), batch.ids[0]))
+            return True
+        return self._transaction(update)
+
+    def dead_letter(self, batch: JobBatch, reason: str) -> bool:
+        def move(db: sqlite3.Connection) -> bool:
+            if not self._owned(db, batch):
+                return False
+            placeholders = ",".join("?" * len(batch.ids))
+            db.execute(
+                f"INSERT INTO dead_jobs (id, grp, payload, created_at, attempts, reason, failed_at)"
+                f" SELECT id, grp, payload, created_at, attempts, ?, ? FROM jobs WHERE id IN ({placeholders})",
+                (reason, time.time(), *batch.ids),
+            )
+            db.execute(f"DELETE FROM jobs WHERE id IN ({placeholders})", batch.ids)
+            return True
+        return self._transaction(move)
+
+    def stats(self) -> Dict[str, int]:
+        now = time.time()
+        with self._lock:
+            pending, in_flight = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(receipt IS NOT NULL AND visible_at > ?), 0) FROM jobs", (now,)
+            ).fetchone()
+            dead = self._db.execute("SELECT COUNT(*) FROM dead_jobs").fetchone()[0]
+        return {"pending": pending, "in_flight": in_flight, "dead": dead}
+
+
+class RedisJobQueue:
+    """
+    Misma cola sobre Redis (varios hosts). Claves bajo 'jobq:{name}':
+    jobs (hash id → trabajo), attempts (hash id → entregas), progress (hash id → diario del turno),
+    g:{grupo} (lista FIFO de ids),
+    ready (zset grupo → instante en que está listo), inflight (zset grupo → fin de la visibilidad),
+    receipts (hash grupo → recibo) y dead (lista). Cada cambio de estado es una transacción
+    WATCH/MULTI/EXEC que se reintenta si otro proceso tocó las mismas claves.
+    """
+
+    def __init__(self, client, name: str = "inbound", quiet_seconds: float = 0.0,
+                 max_wait_seconds: float = 0.0) -> None:
+        self._redis = client
+        self.quiet_seconds = quiet_seconds
+        self.max_wait_seconds = max_wait_seconds
+        prefix = f"jobq:{name}"
+        self._seq, self._jobs, self._attempts = f"{prefix}:seq", f"{prefix}:jobs", f"{prefix}:attempts"
+        self._progress = f"{prefix}:progress"
+        self._ready, self._inflight, self._receipts = f"{prefix}:ready", f"{prefix}:inflight", f"{prefix}:receipts"
+        self._dead = f"{prefix}:dead"
+        self._group_prefix = f"{prefix}:g:"
+
+    def _group_key(self, group: str) -> str:
+        return self._group_prefix + group
+
+    def _transact(self, keys: List[str], func):
+        """Ejecuta func(pipe) con WATCH sobre 'keys' hasta que EXEC no se aborte."""
+        from redis import WatchError
+        while True:
+            with self._redis.pipeline() as pipe:
+                try:
+                    pipe.watch(*keys)
+                    return func(pipe)
+                except WatchError:
+                    continue
+
+    def _ready_at(self, pipe, group_key: str, skip: int, now: float) -> Optional[float]:
+        """Instante en que el grupo estará listo con los trabajos a partir de 'skip' (None si no quedan)."""
+        ids = pipe.lrange(group_key, skip, -1)
+        if not ids:
+            return None
+        first, last = (json.loads(raw)["created_at"] for raw in pipe.hmget(self._jobs, [ids[0], ids[-1]]))
+        return min(last + self.quiet_seconds, first + self.max_wait_seconds)
+
+    def enqueue(self, group: str, payload: Dict) -> str:
+        job_id = str(self._redis.incr(self._seq))
+        group_key = self._group_key(group)
+        job = json.dumps({"group": group, "payload": payload, "created_at": time.time()}, ensure_ascii=False)
+
+        def push(pipe) -> str:
+            in_flight = pipe.zscore(self._inflight, group) is not None
+            now = time.time()
+            pending = pipe.lrange(group_key, 0, 0)
+            first_created = json.loads(pipe.hget(self._jobs, pending[0]))["created_at"] if pending else now
+            pipe.multi()
+            pipe.hset(self._jobs, job_id, job)
+            pipe.rpush(group_key, job_id)
+            if not in_flight:
+                # GT: un mensaje nuevo alarga la espera del debounce pero no adelanta un lote aplazado por release()
+                pipe.zadd(self._ready, {group: min(now + self.quiet_seconds, first_created + self.max_wait_seconds)},
+                          gt=True)
+            pipe.execute()
+            return job_id
+        return self._transact([group_key, self._inflight], push)
+
+    def _requeue_expired(self, now: float) -> None:
+        for group in self._redis.zrangebyscore(self._inflight, "-inf", now):
+            def expire(pipe, group=group) -> None:
+                score = pipe.zscore(self._inflight, group)
+                if score is None or score > now:
+                    pipe.unwatch()
+                    return
+                pipe.multi()
+                pipe.zrem(self._inflight, group)
+                pipe.hdel(self._receipts, group)
+                pipe.zadd(self._ready, {group: now})
+                pipe.execute()
+                log.warning(f"Visibility timeout expired for group {group[:6]}***; redelivering")
+            self._transact([self._inflight], expire)
+
+    def reserve(self, visibility_timeout: float) -> Optional[JobBatch]:
+        now = time.time()
+        self._requeue_expired(now)
+        while True:
+            candidates = self._redis.zrangebyscore(self._ready, "-inf", now, start=0, num=1)
+            if not candidates:
+                return None
+            group = candidates[0]
+            group_key = self._group_key(group)
+
+            def claim(pipe) -> Optional[JobBatch]:
+                score = pipe.zscore(self._ready, group)
+                if score is None or score > now:
+                    pipe.unwatch()
+                    return None
+                ids = pipe.lrange(group_key, 0, MAX_BATCH - 1)
+                jobs = [json.loads(raw) for raw in pipe.hmget(self._jobs, ids)] if ids else []
+                attempts = [int(a or 0) for a in pipe.hmget(self._attempts, ids)] if ids else []
+                progress = json.loads(pipe.hget(self._progress, ids[0]) or "{}") if ids else {}
+                receipt = uuid.uuid4().hex
+                pipe.multi()
+                pipe.zrem(self._ready, group)
+                if ids:
+                    pipe.zadd(self._inflight, {group: now + visibility_timeout})
+                    pipe.hset(self._receipts, group, receipt)
+                    for job_id in ids:
+                        pipe.hincrby(self._attempts, job_id, 1)
+                pipe.execute()
+                if not ids:
+                    return None
+                return JobBatch(group, ids, [job["payload"] for job in jobs], max(attempts) + 1, receipt, progress)
+
+            batch = self._transact([self._ready, group_key], claim)
+            if batch is not None:
+                return batch
+
+    def _finish(self, batch: JobBatch, dead_reason: Optional[str] = None) -> bool:
+        group_key = self._group_key(batch.group)
+
+        def remove(pipe) -> bool:
+            if pipe.hget(self._receipts, batch.group) != batch.receipt:
+                pipe.unwatch()
+                return False
+            now = time.time()
+            ready_at = self._ready_at(pipe, group_key, len(batch.ids), now)
+            dead = pipe.hmget(self._jobs, batch.ids) if dead_reason is not None else []
+            pipe.multi()
+            pipe.zrem(self._inflight, batch.group)
+            pipe.hdel(self._receipts, batch.group)
+            pipe.ltrim(group_key, len(batch.ids), -1)
+            pipe.hdel(self._jobs, *batch.ids)
+            pipe.hdel(self._attempts, *batch.ids)
+            pipe.hdel(self._progress, *batch.ids)
+            for raw in dead:
+                job = json.loads(raw)
+                job.update(reason=dead_reason, attempts=batch.attempts, failed_at=now)
+                pipe.rpush(self._dead, json.dumps(job, ensure_ascii=False))
+            if ready_at is not None:
+                pipe.zadd(self._ready, {batch.group: ready_at})
+            pipe.execute()
+            return True
+        return self._transact([self._receipts, group_key], remove)
+
+    def ack(self, batch: JobBatch) -> bool:
+        return self._finish(batch)
+
+    def dead_letter(self, batch: JobBatch, reason: str) -> bool:
+        return self._finish(batch, dead_reason=reason)
+
+    def save_progress(self, batch: JobBatch, progress: Dict[str, str]) -> bool:
+        def update(pipe) -> bool:
+            if pipe.hget(self._receipts, batch.group) != batch.receipt:
+                pipe.unwatch()
+                return False
+            pipe.multi()
+            pipe.hset(self._progress, batch.ids[0], json.dumps(progress, ensure_ascii=False))
+            pipe.execute()
+            return True
+        return self._transact([self._receipts], update)
+
+    def release(self, batch: JobBatch, delay: float = 0.0) -> bool:
+        def requeue(pipe) -> bool:
+            if pipe.hget(self._receipts, batch.group) != batch.receipt:
+                pipe.unwatch()
+                return False
+            pipe.multi()
+            pipe.zrem(self._inflight, batch.group)
+            pipe.hdel(self._receipts, batch.group)
+            pipe.zadd(self._ready, {batch.group: time.time() + delay})
+            pipe.execute()
+            return True
+        return self._transact([self._receipts], requeue)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": self._redis.hlen(self._jobs),
+            "in_flight": self._redis.zcard(self._inflight),
+            "dead": self._redis.llen(self._dead),
+        }
+
+
+def build_job_queue(backend: str = JOB_QUEUE_BACKEND):
+    """Cola configurada (None si el backend está vacío: procesamiento en proceso con phone_mailbox)."""
+    if not backend:
+        return None
+    if backend == "sqlite":
+        return SQLiteJobQueue(JOB_QUEUE_PATH, WHATSAPP_DEBOUNCE_SECONDS, WHATSAPP_DEBOUNCE_MAX_SECONDS)
+    if backend == "redis":
+        from redis_client import get_redis
+        return RedisJobQueue(get_redis(), "inbound", WHATSAPP_DEBOUNCE_SECONDS, WHATSAPP_DEBOUNCE_MAX_SECONDS)
+    raise ValueError(f"Unknown JOB_QUEUE_BACKEND '{backend}' (expected '', 'sqlite' or 'redis')")
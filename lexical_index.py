@@ -0,0 +1,132 @@
+"""
+Índice léxico BM25 en proceso sobre el contenido de kb_items.
+Se consulta antes que la búsqueda vectorial: si la consulta contiene un SKU exacto o el mejor
+documento gana con claridad, se responde sin pedir embedding ni buscar por similitud.
+"""
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+from logger import get_logger
+
+log = get_logger("lexical_index")
+
+# Palabras vacías frecuentes en las consultas de clientes (sin tildes, tras normalizar)
+STOPWORDS = frozenset(
+    "a al algo como con cual cuales de del el en es esta este hay la las lo los me mi o para "
+    "por que se si su sus te tu un una uno unos y ya hola buenas quiero saber tienen teneis".split()
+)
+
+# SKUs del catálogo: TM-MAIZ-10, TM-SALSA-V1L...
+SKU_PATTERN = re.compile(r"\b[a-z]{2,}(?:-[a-z0-9]+)+\b")
+
+
+def _strip_accents(text: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def tokenize(text: str) -> List[str]:
+    """Tokens en minúsculas y sin tildes; los códigos con guiones se indexan enteros y por partes."""
+    text = _strip_accents(text or "").lower()
+    tokens: List[str] = []
+    for token in re.findall(r"[a-z0-9]+(?:-[a-z0-9]+)*", text):
+        if "-" in token:
+            tokens.append(token)
+            tokens.extend(part for part in token.split("-") if part not in STOPWORDS)
+        elif token not in STOPWORDS:
+            tokens.append(token)
+    return tokens
+
+
+def find_skus(text: str) -> List[str]:
+    """Códigos tipo SKU presentes en el texto (con al menos un dígito)."""
+    text = _strip_accents(text or "").lower()
+    return [sku for sku in SKU_PATTERN.findall(text) if any(c.isdigit() for c in sku)]
+
+
+class BM25Index:
+    """Índice invertido BM25 (Okapi) sobre documentos {id, content, ...}."""
+
+    def __init__(self, documents: List[Dict], k1: float = 1.5, b: float = 0.75) -> None:
+        self.documents = documents
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self._lengths: List[int] = []
+        for doc_index, doc in enumerate(documents):
+            terms = Counter(tokenize(doc.get("content", "")))
+            self._lengths.append(sum(terms.values()))
+            for term, tf in terms.items():
+                self._postings[term].append((doc_index, tf))
+        total = len(documents)
+        self._avg_length = (sum(self._lengths) / total) if total else 0.0
+        self._idf = {
+            term: math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self._postings.items()
+        }
+        # Un término que no aparece en el corpus pesa como el más raro posible
+        self._max_idf = math.log(1 + (total + 0.5) / 0.5) if total else 0.0
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def search(self, query: str, limit: int = 5) -> List[Dict]:
+        """Documentos ordenados por puntuación BM25 (solo los que comparten algún término)."""
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for doc_index, tf in self._postings[term]:
+                norm = 1 - self.b + self.b * self._lengths[doc_index] / (self._avg_length or 1)
+                scores[doc_index] += idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [dict(self.documents[i], score=score) for i, score in ranked]
+
+    def coverage(self, query: str, document: Dict) -> float:
+        """Fracción (ponderada por idf) de los términos de la consulta presentes en el documento."""
+        query_terms = set(tokenize(query))
+        if not query_terms:
+            return 0.0
+        doc_terms = set(tokenize(document.get("content", "")))
+        weights = {t: self._idf.get(t, self._max_idf) for t in query_terms}
+        total = sum(weights.values())
+        return sum(w for t, w in weights.items() if t in doc_terms) / total if total else 0.0
+
+    def is_confident(self, query: str, hits: List[Dict], min_coverage: float = 0.8, min_margin: float = 1.5) -> bool:
+        """
+        True si el resultado léxico basta: SKU exacto en el mejor documento, o el mejor documento
+        cubre casi toda la consulta y supera al segundo por un margen claro.
+        """
+        if not hits:
+            return False
+        top = hits[0]
+        skus = find_skus(query)
+        if skus and set(skus) & set(tokenize(top.get("content", ""))):
+            return True
+        if self.coverage(query, top) < min_coverage:
+            return False
+        return len(hits) == 1 or top["score"] >= min_margin * hits[1]["score"]
+
+
+_lexical_state: Dict = {"index": None, "generation": None}
+_lexical_lock = threading.Lock()
+
+
+def get_lexical_index() -> Optional[BM25Index]:
+    """BM25 sobre la réplica local de kb_items; se reconstruye cuando cambia su generación."""
+    from vector_index import get_kb_index
+
+    kb_index = get_kb_index()
+    if kb_index is None:
+        return None
+    generation = kb_index.generation
+    with _lexical_lock:
+        if _lexical_state["generation"] != generation:
+            _lexical_state["index"] = BM25Index(kb_index.documents())
+            _lexical_state["generation"] = generation
+            log.info(f"Lexical index rebuilt: {len(_lexical_state['index'])} documents")
+        return _lexical_state["index"]
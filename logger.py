@@ -18,9 +18,13 @@ class JSONFormatter(logging.Formatter):
             "module": record.module,
             "message": record.getMessage(),
         }
+        # Campos estructurados opcionales: log.info("...", extra={"data": {...}})
+        data = getattr(record, "data", None)
+        if data is not None:
+            log_entry["data"] = data
         if record.exc_info and record.exc_info[0]:
             log_entry["exception"] = self.formatException(record.exc_info)
-        return json.dumps(log_entry, ensure_ascii=False)
+        return json.dumps(log_entry, ensure_ascii=False, default=str)
 
 
 def get_logger(name: str) -> logging.Logger:
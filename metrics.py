@@ -0,0 +1,76 @@
+"""
+Métricas en proceso con percentiles sobre una ventana deslizante.
+"""
+import threading
+from collections import defaultdict, deque
+from typing import Deque, Dict, List
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    """Percentil por rango más cercano sobre una lista ya ordenada."""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class RollingPercentiles:
+    """Guarda las últimas 'window' muestras por clave y calcula p50/p90/p99 bajo demanda."""
+
+    def __init__(self, window: int = 1000) -> None:
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=self.window))
+        self._counts: Dict[str, int] = defaultdict(int)
+        self._totals: Dict[str, float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def record(self, key: str, value: float) -> None:
+        with self._lock:
+            self._samples[key].append(value)
+            self._counts[key] += 1
+            self._totals[key] += value
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """Resumen por clave (count y total son históricos, los percentiles solo de la ventana)."""
+        with self._lock:
+            samples = {key: sorted(values) for key, values in self._samples.items()}
+            counts = dict(self._counts)
+            totals = dict(self._totals)
+        return {
+            key: {
+                "count": counts[key],
+                "total": round(totals[key], 6),
+                "p50": _percentile(values, 50),
+                "p90": _percentile(values, 90),
+                "p99": _percentile(values, 99),
+                "max": values[-1] if values else 0.0,
+            }
+            for key, values in samples.items()
+        }
+
+
+class LatencyTracker(RollingPercentiles):
+    """Percentiles de duraciones registradas en segundos y publicadas en milisegundos."""
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        return {
+            key: {
+                "count": stats["count"],
+                "p50_ms": round(stats["p50"] * 1000, 1),
+                "p90_ms": round(stats["p90"] * 1000, 1),
+                "p99_ms": round(stats["p99"] * 1000, 1),
+                "max_ms": round(stats["max"] * 1000, 1),
+            }
+            for key, stats in super().snapshot().items()
+        }
+
+
+# Latencia total del turno por intención y camino (fast/cache/crew)
+intent_latency = LatencyTracker()
+
+# Streaming de /api/chat/stream: primer token y turno completo
+stream_latency = LatencyTracker()
+
+# Desglose por turno (ver turn_metrics): pasos, llamadas LLM y herramientas; tokens y coste
+turn_latency = LatencyTracker()
+turn_usage = RollingPercentiles()
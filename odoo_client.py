@@ -1,6 +1,9 @@
+import asyncio
+import threading
+import weakref
 import xmlrpc.client
 import time
-from typing import Optional, Dict, List, Any
+from typing import Optional, Dict, Generator, List, Any
 from datetime import datetime, timedelta
 from config import ODOO_URL, ODOO_DB, ODOO_USERNAME, ODOO_PASSWORD, ODOO_API_KEY
 from logger import get_logger
@@ -24,14 +27,11 @@ class OdooClient:
         self.username: str = ODOO_USERNAME
         self.password: str = ODOO_API_KEY if ODOO_API_KEY else ODOO_PASSWORD
         self.uid: Optional[int] = None
+        # Cliente HTTP para las llamadas desde corrutinas, uno por event loop
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any]" = weakref.WeakKeyDictionary()
+        self._async_lock = threading.Lock()
 
-    def _ensure_authenticated(self) -> None:
-        """Autentica contra Odoo probando API Key y luego Password."""
-        if self.uid:
-            return
-            
-        common = xmlrpc.client.ServerProxy(f'{self.url}/xmlrpc/2/common')
-        
+    def _passwords_to_try(self) -> List[str]:
         passwords_to_try: list = []
         if ODOO_API_KEY:
             passwords_to_try.append(ODOO_API_KEY)
@@ -39,8 +39,16 @@ class OdooClient:
             passwords_to_try.append(ODOO_PASSWORD)
         if not passwords_to_try:
             passwords_to_try.append("")
+        return passwords_to_try
+
+    def _ensure_authenticated(self) -> None:
+        """Autentica contra Odoo probando API Key y luego Password."""
+        if self.uid:
+            return
+            
+        common = xmlrpc.client.ServerProxy(f'{self.url}/xmlrpc/2/common')
             
-        for test_pwd in passwords_to_try:
+        for test_pwd in self._passwords_to_try():
             for attempt in range(3):
                 try:
                     uid = common.authenticate(self.db, self.username, test_pwd, {})
@@ -77,6 +85,52 @@ class OdooClient:
                 else:
                     raise
 
+    # --- XML-RPC desde corrutinas (mismo protocolo sobre httpx, sin ocupar un hilo) ---
+
+    def _async_client(self):
+        import httpx
+        loop = asyncio.get_running_loop()
+        with self._async_lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = httpx.AsyncClient(timeout=30.0)
+                self._async_clients[loop] = client
+            return client
+
+    async def _xmlrpc_async(self, service: str, method: str, params: tuple) -> Any:
+        """Llamada XML-RPC con reintento ante 429, como _execute_kw_with_retry."""
+        body = xmlrpc.client.dumps(params, method, allow_none=True).encode("utf-8")
+        url = f'{self.url}/xmlrpc/2/{service}'
+        max_retries = 3
+        for attempt in range(max_retries):
+            response = await self._async_client().post(url, content=body, headers={"Content-Type": "text/xml"})
+            if response.status_code == 429 and attempt < max_retries - 1:
+                wait_time = 2 ** attempt
+                log.warning(f"Odoo rate limited (429). Retry in {wait_time}s...")
+                await asyncio.sleep(wait_time)
+                continue
+            if response.status_code != 200:
+                raise xmlrpc.client.ProtocolError(url, response.status_code, response.reason_phrase,
+                                                  dict(response.headers))
+            result, _ = xmlrpc.client.loads(response.content)
+            return result[0]
+
+    async def _ensure_authenticated_async(self) -> None:
+        if self.uid:
+            return
+        for test_pwd in self._passwords_to_try():
+            uid = await self._xmlrpc_async("common", "authenticate", (self.db, self.username, test_pwd, {}))
+            if uid:
+                self.uid = uid
+                self.password = test_pwd
+                log.info("Odoo authenticated successfully")
+                return
+        raise Exception("Odoo authentication failed.")
+
+    async def _execute_kw_async(self, model: str, method: str, *args: Any) -> Any:
+        await self._ensure_authenticated_async()
+        return await self._xmlrpc_async("object", "execute_kw", (self.db, self.uid, self.password, model, method, *args))
+
     def _safe_delete(self, model: str, record_id: int) -> None:
         """Intenta eliminar un registro para compensar un booking parcial."""
         try:
@@ -85,8 +139,11 @@ class OdooClient:
         except Exception:
             log.error(f"Rollback failed: {model}:{record_id}")
 
-    def search_contact_by_phone(self, phone: str) -> Optional[Dict]:
-        """Busca un contacto por teléfono en res.partner Y crm.lead. Reconoce clientes y leads."""
+    def _contact_lookup(self, phone: str) -> Generator[tuple, Any, Optional[Dict]]:
+        """
+        Búsqueda de contacto sin E/S: cede cada llamada (modelo, método, args) y recibe su resultado.
+        La ejecutan search_contact_by_phone (XML-RPC bloqueante) y search_contact_by_phone_async.
+        """
         clean_phone = ''.join(filter(str.isdigit, phone))
         
         if len(clean_phone) < 6:
@@ -101,9 +158,9 @@ class OdooClient:
         # 1) Buscar en res.partner (clientes/contactos)
         for variant in search_variants:
             domain = [('phone', 'ilike', variant)]
-            partner_ids = self._execute_kw_with_retry('res.partner', 'search', [domain])
+            partner_ids = yield ('res.partner', 'search', [domain])
             if partner_ids:
-                partners = self._execute_kw_with_retry(
+                partners = yield (
                     'res.partner', 'read', [partner_ids],
                     {'fields': ['name', 'email', 'phone', 'street']}
                 )
@@ -113,9 +170,9 @@ class OdooClient:
         # 2) Buscar en crm.lead (leads/oportunidades)
         for variant in search_variants:
             domain = [('phone', 'ilike', variant)]
-            lead_ids = self._execute_kw_with_retry('crm.lead', 'search', [domain])
+            lead_ids = yield ('crm.lead', 'search', [domain])
             if lead_ids:
-                leads = self._execute_kw_with_retry(
+                leads = yield (
                     'crm.lead', 'read', [lead_ids],
                     {'fields': ['contact_name', 'email_from', 'phone', 'partner_name', 'street']}
                 )
@@ -132,6 +189,26 @@ class OdooClient:
         log.info(f"No contact found for phone ***{clean_phone[-4:]}")
         return None
 
+    def search_contact_by_phone(self, phone: str) -> Optional[Dict]:
+        """Busca un contacto por teléfono en res.partner Y crm.lead. Reconoce clientes y leads."""
+        lookup = self._contact_lookup(phone)
+        try:
+            call = next(lookup)
+            while True:
+                call = lookup.send(self._execute_kw_with_retry(*call))
+        except StopIteration as done:
+            return done.value
+
+    async def search_contact_by_phone_async(self, phone: str) -> Optional[Dict]:
+        """search_contact_by_phone desde una corrutina (XML-RPC sobre httpx, sin hilos)."""
+        lookup = self._contact_lookup(phone)
+        try:
+            call = next(lookup)
+            while True:
+                call = lookup.send(await self._execute_kw_async(*call))
+        except StopIteration as done:
+            return done.value
+
     def create_lead(self, name: str, phone: str, email: Optional[str] = None, description: Optional[str] = None) -> int:
         """Crea un lead en el CRM."""
         vals = {
@@ -243,6 +320,20 @@ class OdooClient:
             {'fields': ['name', 'list_price', 'qty_available', 'uom_id', 'default_code']}
         )
 
+    def get_catalog_version(self) -> str:
+        """
+        Huella barata del catálogo vendible (nº de productos + última modificación) para invalidar cachés.
+        No sigue el stock (los movimientos no tocan write_date): la disponibilidad no se cachea.
+        """
+        domain = [('sale_ok', '=', True)]
+        count = self._execute_kw_with_retry('product.product', 'search_count', [domain])
+        latest = self._execute_kw_with_retry(
+            'product.product', 'search_read', [domain],
+            {'fields': ['write_date'], 'order': 'write_date desc', 'limit': 1}
+        )
+        write_date = latest[0]['write_date'] if latest else ''
+        return f"{count}:{write_date}"
+
     def get_product_stock(self, product_id: int) -> Dict:
         """Lee el stock disponible de un producto."""
         products = self._execute_kw_with_retry(
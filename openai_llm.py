@@ -0,0 +1,50 @@
+"""
+LLM de OpenAI para los agentes del crew con contabilidad de tokens cacheados.
+El proveedor nativo de CrewAI descarta usage.prompt_tokens_details.cached_tokens; esta subclase lo
+conserva para que crew.usage_metrics.cached_prompt_tokens refleje la caché de prompts de OpenAI.
+Además cada llamada se anota en el registro del turno en curso (turn_metrics) con sus tokens y latencia.
+Se apoya en hooks privados de OpenAICompletion (_extract_openai_token_usage, _token_usage): por eso
+crewai va fijado a una versión exacta en requirements.txt y un test comprueba que siguen en uso.
+"""
+import time
+from typing import Any, Dict
+from crewai.llms.providers.openai.completion import OpenAICompletion
+from turn_metrics import record_llm_call
+from logger import get_logger
+
+log = get_logger("openai_llm")
+
+
+class CachedUsageOpenAICompletion(OpenAICompletion):
+    """OpenAICompletion que además reporta los tokens de prompt servidos desde la caché."""
+
+    def _extract_openai_token_usage(self, response: Any) -> Dict[str, Any]:
+        usage = super()._extract_openai_token_usage(response)
+        details = getattr(getattr(response, "usage", None), "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None) or 0
+        if cached:
+            usage["cached_prompt_tokens"] = cached
+        return usage
+
+    def call(self, *args: Any, **kwargs: Any) -> Any:
+        before = dict(self._token_usage)
+        call_started = time.perf_counter()
+        try:
+            return super().call(*args, **kwargs)
+        finally:
+            usage = {key: value - before.get(key, 0) for key, value in self._token_usage.items()}
+            agent = getattr(kwargs.get("from_agent"), "role", None)
+            record_llm_call(self.model, usage, time.perf_counter() - call_started, agent)
+
+
+def build_llm(model: str, api_key: str) -> CachedUsageOpenAICompletion:
+    return CachedUsageOpenAICompletion(model=model, api_key=api_key)
+
+
+def log_prompt_cache_usage(usage_metrics: Any) -> float:
+    """Registra la proporción de tokens de prompt cacheados del turno y la devuelve (0..1)."""
+    prompt_tokens = getattr(usage_metrics, "prompt_tokens", 0) or 0
+    cached_tokens = getattr(usage_metrics, "cached_prompt_tokens", 0) or 0
+    ratio = cached_tokens / prompt_tokens if prompt_tokens else 0.0
+    log.info(f"Prompt cache: {cached_tokens}/{prompt_tokens} prompt tokens cached ({ratio:.0%})")
+    return ratio
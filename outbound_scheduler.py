@@ -0,0 +1,342 @@
+"""
+Planificador de envíos salientes de WhatsApp consciente de los límites de la Graph API.
+- Token bucket global (mensajes/segundo del número de empresa) y otro por destinatario (pair rate limit).
+- Prioridades: las respuestas a un usuario (INTERACTIVE) salen antes que los avisos (NOTIFICATION).
+- Los textos largos se trocean en el límite de 4096 caracteres, por párrafos, líneas o palabras.
+- Orden por destinatario: FIFO y como mucho un envío en vuelo por teléfono.
+Un envío rechazado por throttling vuelve a la cabeza de su cola tras una espera en lugar de perderse.
+send_async() entrega desde una corrutina (turno de WhatsApp en el event loop) con los mismos buckets y el
+mismo orden por destinatario, pero sin pasar por el pool de hilos: espera su ficha con asyncio.sleep.
+"""
+import asyncio
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional, Set
+from config import (
+    WHATSAPP_SEND_RATE, WHATSAPP_SEND_BURST,
+    WHATSAPP_RECIPIENT_RATE, WHATSAPP_RECIPIENT_BURST, WHATSAPP_SEND_WORKERS
+)
+from metrics import LatencyTracker
+from odoo_client import _mask_phone
+from whatsapp_sender import DeliveryResult, whatsapp_sender
+from logger import get_logger
+
+log = get_logger("outbound_scheduler")
+
+INTERACTIVE = 0
+NOTIFICATION = 1
+
+# Límite de la Graph API para el cuerpo de un mensaje de texto
+MAX_TEXT_LENGTH = 4096
+
+# Códigos de throttling de Meta que justifican volver a encolar (tras agotar los reintentos del sender)
+THROTTLE_ERROR_CODES = {4, 80007, 130429, 131056}
+
+# Reintento de send_async mientras el destinatario tiene otro envío en vuelo o trozos en cola
+ASYNC_POLL_SECONDS = 0.05
+
+# Cada cuánto se olvidan los destinatarios inactivos (sin pendientes y con el bucket lleno)
+IDLE_SWEEP_SECONDS = 1.0
+
+
+def chunk_text(text: str, limit: int = MAX_TEXT_LENGTH) -> List[str]:
+    """Trocea 'text' en partes de como mucho 'limit' caracteres, cortando en el mejor separador posible."""
+    chunks: List[str] = []
+    rest = text.strip()
+    while len(rest) > limit:
+        window = rest[:limit + 1]
+        cut = -1
+        for separator in ("\n\n", "\n", ". ", " "):
+            cut = window.rfind(separator)
+            if cut > limit // 2:
+                cut += len(separator.rstrip())
+                break
+        if cut <= limit // 2:
+            cut = limit
+        cut = min(cut, limit)
+        chunks.append(rest[:cut].rstrip())
+        rest = rest[cut:].lstrip()
+    if rest:
+        chunks.append(rest)
+    return chunks
+
+
+class TokenBucket:
+    """'rate' fichas por segundo hasta 'burst'; delay() dice cuánto falta para la siguiente."""
+
+    def __init__(self, rate: float, burst: float, now: Optional[float] = None) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+@dataclass
+class _Message:
+    """Mensaje lógico: su Future se resuelve con un DeliveryResult por trozo."""
+    phone: str
+    results: List[Optional[DeliveryResult]]
+    future: Future = field(default_factory=Future)
+
+    def settle(self, index: int, result: DeliveryResult) -> None:
+        self.results[index] = result
+        if all(r is not None for r in self.results) and not self.future.done():
+            self.future.set_result(list(self.results))
+
+
+@dataclass
+class _Chunk:
+    message: _Message
+    index: int
+    text: str
+    priority: int
+    seq: int
+    enqueued: float
+    requeues: int = 0
+    not_before: float = 0.0
+
+
+class OutboundScheduler:
+    """Cola de salida con prioridades y token buckets; los envíos los hace un pool pequeño de hilos."""
+
+    def __init__(self, sender=whatsapp_sender, rate: float = WHATSAPP_SEND_RATE, burst: float = WHATSAPP_SEND_BURST,
+                 recipient_rate: float = WHATSAPP_RECIPIENT_RATE, recipient_burst: float = WHATSAPP_RECIPIENT_BURST,
+                 workers: int = WHATSAPP_SEND_WORKERS, max_requeues: int = 3, requeue_delay: float = 6.0) -> None:
+        self.sender = sender
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self.max_requeues = max_requeues
+        self.requeue_delay = requeue_delay
+        self._global = TokenBucket(rate, burst)
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._queues: Dict[str, Deque[_Chunk]] = {}
+        self._in_flight: Set[str] = set()
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="whatsapp-send")
+        self._dispatcher: Optional[threading.Thread] = None
+        self._last_sweep = 0.0
+        self.latency = LatencyTracker()
+        self._counts = {"messages": 0, "chunks": 0, "sent": 0, "failed": 0, "requeued": 0, "skipped": 0}
+
+    def submit(self, phone_number: str, text: str, priority: int = INTERACTIVE) -> Future:
+        """Encola un mensaje (troceado si hace falta); el Future devuelve la lista de DeliveryResult."""
+        return self.submit_parts(phone_number, chunk_text(text), priority)
+
+    def submit_parts(self, phone_number: str, chunks: List[str], priority: int = INTERACTIVE) -> Future:
+        """Como submit() pero con el mensaje ya troceado (p. ej. para reenviar solo los trozos que fallaron)."""
+        message = _Message(phone_number, [None] * len(chunks))
+        if not chunks:
+            # La Graph API rechaza un text.body vacío: no hay nada que enviar
+            log.warning(f"Empty WhatsApp message to {_mask_phone(phone_number)} not sent")
+            message.future.set_result([])
+            return message.future
+        now = time.monotonic()
+        with self._cond:
+            queue = self._queues.setdefault(phone_number, deque())
+            for index, part in enumerate(chunks):
+                queue.append(_Chunk(message, index, part, priority, next(self._seq), now))
+            self._counts["messages"] += 1
+            self._counts["chunks"] += len(chunks)
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch_forever, name="whatsapp-outbound",
+                                                    daemon=True)
+                self._dispatcher.start()
+            self._cond.notify()
+        return message.future
+
+    async def send_async(self, phone_number: str, text: str) -> List[DeliveryResult]:
+        """Entrega interactiva desde el event loop; devuelve un DeliveryResult por trozo."""
+        chunks = chunk_text(text)
+        if not chunks:
+            log.warning(f"Empty WhatsApp message to {_mask_phone(phone_number)} not sent")
+            return []
+        with self._cond:
+            self._counts["messages"] += 1
+            self._counts["chunks"] += len(chunks)
+        results: List[DeliveryResult] = []
+        for index, part in enumerate(chunks):
+            enqueued = time.monotonic()
+            requeues = 0
+            not_before = 0.0
+            while True:
+                await self._acquire_async(phone_number, not_before)
+                started = time.monotonic()
+                self.latency.record("queue_wait", started - enqueued)
+                try:
+                    result = await self.sender.send_async(phone_number, part)
+                except asyncio.CancelledError:
+                    with self._cond:
+                        self._in_flight.discard(phone_number)
+                        self._cond.notify()
+                    raise
+                except Exception as e:
+                    log.error(f"WhatsApp sender raised {type(e).__name__}", exc_info=True)
+                    result = DeliveryResult(ok=False, error=type(e).__name__, attempts=1)
+                now = time.monotonic()
+                throttled = (not result.ok and result.error_code in THROTTLE_ERROR_CODES
+                             and requeues < self.max_requeues)
+                with self._cond:
+                    self._in_flight.discard(phone_number)
+                    if throttled:
+                        self._counts["requeued"] += 1
+                    else:
+                        self._counts["sent" if result.ok else "failed"] += 1
+                    self._cond.notify()
+                if not throttled:
+                    break
+                requeues += 1
+                not_before = now + self.requeue_delay * requeues
+                log.warning(f"WhatsApp send to {_mask_phone(phone_number)} throttled ({result.error_code}); "
+                            f"requeued #{requeues}")
+            self.latency.record("delivery", now - enqueued)
+            results.append(result)
+            if not result.ok:
+                # Igual que en el despacho por hilos: sin este trozo el resto no tiene sentido
+                skipped = len(chunks) - index - 1
+                results.extend(DeliveryResult(ok=False, error="skipped") for _ in range(skipped))
+                with self._cond:
+                    self._counts["skipped"] += skipped
+                break
+        return results
+
+    async def _acquire_async(self, phone_number: str, not_before: float) -> None:
+        """Espera una ficha global y otra del destinatario, sin adelantar a lo que ya está en su cola."""
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                # El camino asíncrono no encola: sin despachador, la limpieza de inactivos se hace aquí
+                self._sweep_idle(now)
+                if phone_number in self._in_flight or self._queues.get(phone_number):
+                    wait = ASYNC_POLL_SECONDS
+                else:
+                    bucket = self._bucket(phone_number, now)
+                    wait = max(not_before - now, self._global.delay(now), bucket.delay(now))
+                    if wait <= 0:
+                        self._global.consume(now)
+                        bucket.consume(now)
+                        self._in_flight.add(phone_number)
+                        return
+            await asyncio.sleep(wait)
+
+    # --- Despacho ---
+
+    def _bucket(self, phone_number: str, now: float) -> TokenBucket:
+        bucket = self._buckets.get(phone_number)
+        if bucket is None:
+            bucket = self._buckets[phone_number] = TokenBucket(self.recipient_rate, self.recipient_burst, now)
+        return bucket
+
+    def _next_ready(self, now: float):
+        """(teléfono cuyo trozo listo tiene más prioridad o None, segundos hasta que haya uno)."""
+        self._sweep_idle(now)
+        candidates = []
+        wait = None
+        for phone, queue in self._queues.items():
+            if phone in self._in_flight or not queue:
+                continue
+            head = queue[0]
+            delay = max(head.not_before - now, self._bucket(phone, now).delay(now))
+            if delay <= 0:
+                candidates.append((head.priority, head.seq, phone))
+            else:
+                wait = delay if wait is None else min(wait, delay)
+        if not candidates:
+            return None, wait
+        _, _, phone = min(candidates)
+        return phone, 0.0
+
+    def _sweep_idle(self, now: float) -> None:
+        """Destinatarios sin nada pendiente ni en vuelo y con el bucket lleno: no hace falta recordarlos."""
+        if now - self._last_sweep < IDLE_SWEEP_SECONDS:
+            return
+        self._last_sweep = now
+        idle = [phone for phone, bucket in self._buckets.items()
+                if phone not in self._in_flight and not self._queues.get(phone) and bucket.full(now)]
+        for phone in idle:
+            del self._buckets[phone]
+            self._queues.pop(phone, None)
+
+    def _dispatch_forever(self) -> None:
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                phone, wait = self._next_ready(now)
+                if phone is None:
+                    self._cond.wait(timeout=wait)
+                    continue
+                global_wait = self._global.delay(now)
+                if global_wait > 0:
+                    # Al volver se elige de nuevo: puede haber llegado algo más prioritario
+                    self._cond.wait(timeout=global_wait)
+                    continue
+                chunk = self._queues[phone].popleft()
+                self._global.consume(now)
+                self._bucket(phone, now).consume(now)
+                self._in_flight.add(phone)
+            self.latency.record("queue_wait", now - chunk.enqueued)
+            self._pool.submit(self._send, chunk)
+
+    def _send(self, chunk: _Chunk) -> None:
+        phone = chunk.message.phone
+        try:
+            result = self.sender.send(phone, chunk.text)
+        except Exception as e:
+            log.error(f"WhatsApp sender raised {type(e).__name__}", exc_info=True)
+            result = DeliveryResult(ok=False, error=type(e).__name__, attempts=1)
+        now = time.monotonic()
+        with self._cond:
+            self._in_flight.discard(phone)
+            queue = self._queues.setdefault(phone, deque())
+            if not result.ok and result.error_code in THROTTLE_ERROR_CODES and chunk.requeues < self.max_requeues:
+                chunk.requeues += 1
+                chunk.not_before = now + self.requeue_delay * chunk.requeues
+                queue.appendleft(chunk)
+                self._counts["requeued"] += 1
+                log.warning(f"WhatsApp send to {_mask_phone(phone)} throttled ({result.error_code}); "
+                            f"requeued #{chunk.requeues}")
+                self._cond.notify()
+                return
+            self._counts["sent" if result.ok else "failed"] += 1
+            skipped = []
+            if not result.ok:
+                # Sin este trozo el resto del mensaje no tiene sentido: se descarta, pero no los mensajes siguientes
+                while queue and queue[0].message is chunk.message:
+                    skipped.append(queue.popleft())
+                self._counts["skipped"] += len(skipped)
+            self._cond.notify()
+        self.latency.record("delivery", now - chunk.enqueued)
+        chunk.message.settle(chunk.index, result)
+        for other in skipped:
+            other.message.settle(other.index, DeliveryResult(ok=False, error="skipped"))
+
+    def stats(self) -> Dict:
+        with self._cond:
+            stats: Dict = dict(self._counts)
+            stats.update(pending=sum(len(q) for q in self._queues.values()), in_flight=len(self._in_flight),
+                         recipients=len(self._queues.keys() | self._buckets.keys()))
+        stats["latency"] = self.latency.snapshot()
+        return stats
+
+
+outbound_scheduler = OutboundScheduler()
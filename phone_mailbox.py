@@ -0,0 +1,116 @@
+"""
+Buzón por teléfono para los mensajes entrantes de WhatsApp.
+Los usuarios escriben a ráfagas ("hola", "quiero tortillas", "4 cajas"): en lugar de lanzar un crew
+por mensaje (concurrentes, sin orden y compitiendo por el historial), cada sesión tiene un buzón
+que procesa sus turnos de uno en uno y en orden de llegada. Los mensajes que llegan dentro de la
+ventana de debounce se unen en un solo turno: una pasada del LLM y una respuesta coherente.
+El buzón vive en el event loop del servidor: cada sesión activa es una tarea asyncio (no un hilo)
+que espera a que la ráfaga termine y después a que su turno acabe en el ejecutor del crew.
+"""
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional
+from logger import get_logger
+
+log = get_logger("phone_mailbox")
+
+
+def merge_messages(messages: List[str]) -> str:
+    """Une la ráfaga en un solo mensaje, una línea por mensaje y sin repetidos consecutivos."""
+    merged: List[str] = []
+    for text in messages:
+        if not merged or merged[-1] != text:
+            merged.append(text)
+    return "\n".join(merged)
+
+
+@dataclass
+class _Box:
+    pending: List[str] = field(default_factory=list)
+    first_at: float = 0.0
+    last_at: float = 0.0
+
+
+class PhoneMailbox:
+    """
+    Una tarea de drenado por sesión activa (como mucho una): espera 'debounce_seconds' de silencio
+    (o 'max_wait_seconds' desde el primer mensaje pendiente), entrega el lote a 'handler' (corrutina)
+    y repite hasta vaciar el buzón. Mientras un turno se procesa, los mensajes nuevos esperan al siguiente.
+    post() se llama desde el event loop (el handler del webhook); no hace falta ningún lock.
+    """
+
+    def __init__(self, handler: Callable[[str, str], Awaitable[None]], debounce_seconds: float = 2.0,
+                 max_wait_seconds: float = 8.0) -> None:
+        self._handler = handler
+        self.debounce_seconds = debounce_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self._boxes: Dict[str, _Box] = {}
+        # Referencias fuertes: el loop solo guarda referencias débiles a las tareas
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._stats = {"received": 0, "turns": 0, "merged": 0}
+
+    def post(self, phone: str, text: str) -> None:
+        now = time.monotonic()
+        self._stats["received"] += 1
+        task = self._tasks.get(phone)
+        if task is not None and task.done():
+            # Tarea cancelada cuyo callback aún no ha corrido: su buzón ya no lo drena nadie
+            self._forget(phone, task)
+        box = self._boxes.get(phone)
+        start_worker = box is None
+        if box is None:
+            box = self._boxes[phone] = _Box()
+        if not box.pending:
+            box.first_at = now
+        box.pending.append(text)
+        box.last_at = now
+        if start_worker:
+            task = self._tasks[phone] = asyncio.get_running_loop().create_task(self._drain(phone), name="mailbox")
+            task.add_done_callback(lambda done: self._forget(phone, done))
+
+    def _forget(self, phone: str, task: asyncio.Task) -> None:
+        """
+        Quita la tarea terminada y, si se canceló, su buzón: sin esto post() seguiría añadiendo mensajes
+        a un buzón que nadie drena. Solo si siguen siendo los de esa tarea, no los de una posterior.
+        """
+        if self._tasks.get(phone) is not task:
+            return
+        del self._tasks[phone]
+        box = self._boxes.pop(phone, None)
+        if box is not None and box.pending:
+            log.warning(f"Mailbox for {phone[:6]}*** stopped with {len(box.pending)} unprocessed messages")
+
+    async def _next_batch(self, phone: str) -> Optional[List[str]]:
+        """Espera a que la ráfaga termine y devuelve sus mensajes (None si el buzón quedó vacío)."""
+        while True:
+            box = self._boxes[phone]
+            if not box.pending:
+                del self._boxes[phone]
+                return None
+            now = time.monotonic()
+            ready_at = min(box.last_at + self.debounce_seconds, box.first_at + self.max_wait_seconds)
+            if now >= ready_at:
+                batch, box.pending = box.pending, []
+                return batch
+            await asyncio.sleep(ready_at - now)
+
+    async def _drain(self, phone: str) -> None:
+        while True:
+            batch = await self._next_batch(phone)
+            if batch is None:
+                return
+            self._stats["turns"] += 1
+            self._stats["merged"] += len(batch) - 1
+            if len(batch) > 1:
+                log.info(f"Merged {len(batch)} messages from {phone[:6]}*** into one turn")
+            try:
+                await self._handler(phone, merge_messages(batch))
+            except Exception as e:
+                log.error(f"Mailbox handler error: {type(e).__name__}", exc_info=True)
+
+    def stats(self) -> Dict[str, int]:
+        stats = dict(self._stats)
+        stats["active_sessions"] = len(self._boxes)
+        stats["pending"] = sum(len(box.pending) for box in self._boxes.values())
+        return stats
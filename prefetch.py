@@ -0,0 +1,177 @@
+"""
+Prefetch especulativo de herramientas mientras el LLM clasifica el mensaje.
+Un emparejamiento barato de palabras clave decide qué buscar por adelantado (productos de Odoo y
+base de conocimientos); las herramientas consultan primero el prefetch del turno (contextvar) y solo
+llaman al backend si no hay un resultado equivalente.
+"""
+import re
+import threading
+import unicodedata
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Set
+from config import PREFETCH_ENABLED, PREFETCH_WAIT_SECONDS
+from logger import get_logger
+
+log = get_logger("prefetch")
+
+# Palabra del mensaje (sin tildes) → término tal como aparece en los nombres del catálogo.
+# 'ilike' de Odoo no ignora tildes, por eso se busca con la grafía del catálogo.
+PRODUCT_TERMS = {
+    "tortilla": "Tortillas", "tortillas": "Tortillas",
+    "maiz": "Maíz", "trigo": "Trigo", "nopal": "Nopal",
+    "totopo": "Totopos", "totopos": "Totopos",
+    "salsa": "Salsa", "salsas": "Salsa",
+    "masa": "Masa",
+}
+
+# Límite por defecto de OdooClient.search_products: con menos resultados la lista está completa
+SEARCH_LIMIT = 10
+
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="prefetch")
+_current: ContextVar[Optional["TurnPrefetch"]] = ContextVar("turn_prefetch", default=None)
+
+_stats: Dict[str, int] = {"turns": 0, "started": 0, "hits": 0, "misses": 0, "unused": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(key: str, amount: int = 1) -> None:
+    with _stats_lock:
+        _stats[key] += amount
+
+
+def get_prefetch_stats() -> Dict[str, float]:
+    """hit_rate: llamadas a herramienta servidas por el prefetch; precision: prefetches aprovechados."""
+    with _stats_lock:
+        stats: Dict[str, float] = dict(_stats)
+    calls = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / calls, 4) if calls else 0.0
+    used = stats["started"] - stats["unused"]
+    stats["precision"] = round(used / stats["started"], 4) if stats["started"] else 0.0
+    return stats
+
+
+def _fold(text: str) -> str:
+    text = unicodedata.normalize("NFKD", (text or "").lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def product_terms(message: str) -> List[str]:
+    """Términos de catálogo mencionados en el mensaje, sin repetir y en orden de aparición."""
+    terms: List[str] = []
+    for word in re.findall(r"[a-z]+", _fold(message)):
+        term = PRODUCT_TERMS.get(word)
+        if term and term not in terms:
+            terms.append(term)
+    return terms
+
+
+class TurnPrefetch:
+    """Resultados especulativos de un turno; cada uno se sirve como mucho a las consultas equivalentes."""
+
+    def __init__(self, message: str) -> None:
+        self.message = message
+        self._products: Dict[str, Future] = {}
+        self._kb: Optional[Future] = None
+        self._kb_tokens: Set[str] = set()
+        self._used: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def start(self, search_products, retrieve_kb, tokenize) -> "TurnPrefetch":
+        for term in product_terms(self.message):
+            self._products[term] = _executor.submit(search_products, term)
+        if self._products:
+            self._kb_tokens = set(tokenize(self.message))
+            if self._kb_tokens:
+                self._kb = _executor.submit(retrieve_kb, self.message)
+        started = len(self._products) + (1 if self._kb else 0)
+        _count("turns")
+        _count("started", started)
+        if started:
+            log.info(f"Prefetch started: products={list(self._products)} kb={self._kb is not None}")
+        return self
+
+    def _result(self, key: str, future: Future):
+        try:
+            result = future.result(timeout=PREFETCH_WAIT_SECONDS)
+        except Exception as e:
+            log.warning(f"Prefetch {key} unavailable: {type(e).__name__}")
+            return None
+        with self._lock:
+            self._used.add(key)
+        return result
+
+    def products_for(self, query: str) -> Optional[List[Dict]]:
+        """Mismo resultado que search_products(query) si un término prefetcheado lo contiene."""
+        wanted = (query or "").strip().lower()
+        if not wanted:
+            return None
+        for term, future in self._products.items():
+            if term.lower() not in wanted:
+                continue
+            products = self._result(f"products:{term}", future)
+            if products is None:
+                continue
+            if wanted == term.lower():
+                return products
+            # 'name ilike query' ⊂ 'name ilike term' solo si la lista del término no está truncada
+            if len(products) < SEARCH_LIMIT:
+                return [p for p in products if wanted in p.get("name", "").lower()]
+        return None
+
+    def kb_for(self, query: str, tokenize) -> Optional[List[Dict]]:
+        """Resultados del mensaje completo si la consulta de la herramienta no añade términos nuevos."""
+        if self._kb is None:
+            return None
+        tokens = set(tokenize(query))
+        if not tokens or not tokens <= self._kb_tokens:
+            return None
+        return self._result("kb", self._kb)
+
+    def finish(self) -> None:
+        keys = {f"products:{term}" for term in self._products} | ({"kb"} if self._kb else set())
+        with self._lock:
+            unused = len(keys - self._used)
+        _count("unused", unused)
+
+
+def start_prefetch(message: str) -> Optional[TurnPrefetch]:
+    """Lanza el prefetch del turno (None si está desactivado)."""
+    if not PREFETCH_ENABLED:
+        return None
+    from tools_orders import odoo
+    from tools_rag import retrieve
+    from lexical_index import tokenize
+    return TurnPrefetch(message).start(odoo.search_products, retrieve, tokenize)
+
+
+@contextmanager
+def use_prefetch(prefetch: Optional[TurnPrefetch]) -> Iterator[None]:
+    """Hace visible el prefetch a las herramientas durante el bloque (mismo hilo / contexto)."""
+    token = _current.set(prefetch)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+        if prefetch is not None:
+            prefetch.finish()
+
+
+def prefetched_products(query: str) -> Optional[List[Dict]]:
+    prefetch = _current.get()
+    if prefetch is None:
+        return None
+    products = prefetch.products_for(query)
+    _count("hits" if products is not None else "misses")
+    return products
+
+
+def prefetched_kb(query: str) -> Optional[List[Dict]]:
+    prefetch = _current.get()
+    if prefetch is None:
+        return None
+    from lexical_index import tokenize
+    items = prefetch.kb_for(query, tokenize)
+    _count("hits" if items is not None else "misses")
+    return items
@@ -0,0 +1,180 @@
+"""
+Worker de la cola de entrada de WhatsApp (ver job_queue).
+Ejecutar con: python queue_worker.py [--threads 4]
+Requiere JOB_QUEUE_BACKEND=sqlite (mismo host que la API) o redis (REDIS_URL). Se pueden lanzar
+tantos procesos como haga falta: cada lote (los mensajes pendientes de un teléfono) lo procesa
+un único worker y solo se confirma (ack) cuando el turno ha terminado y la respuesta se ha entregado.
+Un reintento repite el turno con el diario del intento anterior (turn_journal): no vuelve a guardar el
+mensaje del usuario ni a ejecutar las herramientas de escritura que ya tuvieron éxito.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import argparse
+import functools
+import signal
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from config import JOB_VISIBILITY_TIMEOUT, JOB_MAX_ATTEMPTS, JOB_WORKER_THREADS
+from job_queue import JobBatch, build_job_queue
+from outbound_scheduler import chunk_text
+from phone_mailbox import merge_messages
+from turn_journal import TurnJournal, use_turn_journal
+from whatsapp_turn import ERROR_MESSAGE, run_odoo_crew, send_whatsapp_parts
+from odoo_client import _mask_phone
+from logger import get_logger
+
+log = get_logger("queue_worker")
+
+POLL_INTERVAL_SECONDS = 0.5
+MAX_RETRY_DELAY_SECONDS = 60
+
+# Respuestas ya generadas cuya entrega falló: el reintento del lote reenvía solo los trozos que faltan
+# sin repetir el turno (repetirlo podría duplicar un pedido o una reunión). La clave es el id del primer
+# trabajo que responden: sigue siendo el primero del grupo aunque lleguen mensajes nuevos entre intentos.
+# Solo dentro de este proceso y acotado.
+MAX_PENDING_REPLIES = 1000
+
+
+@dataclass
+class PendingReply:
+    """Respuesta a los trabajos 'ids' de la que aún faltan por entregar los trozos 'parts'."""
+    ids: List[str]
+    parts: List[str]
+
+
+_pending_replies: "OrderedDict[str, PendingReply]" = OrderedDict()
+_pending_lock = threading.Lock()
+
+
+class DeliveryFailed(Exception):
+    """Algún trozo de la respuesta no llegó a WhatsApp: el lote no se confirma."""
+
+
+def work(queue, handler: Callable[[JobBatch], None], stop: threading.Event,
+         visibility_timeout: float = JOB_VISIBILITY_TIMEOUT, max_attempts: int = JOB_MAX_ATTEMPTS,
+         poll_interval: float = POLL_INTERVAL_SECONDS) -> None:
+    """Bucle de un hilo worker: reservar lote → procesar → ack (o reintento con espera creciente)."""
+    while not stop.is_set():
+        try:
+            batch = queue.reserve(visibility_timeout)
+        except Exception as e:
+            log.error(f"Queue reserve failed: {type(e).__name__}: {e}")
+            stop.wait(poll_interval * 4)
+            continue
+        if batch is None:
+            stop.wait(poll_interval)
+            continue
+        if batch.attempts > max_attempts:
+            log.error(f"Batch for {batch.group[:6]}*** failed {batch.attempts - 1} times; moving to dead letters")
+            queue.dead_letter(batch, "max attempts exceeded")
+            continue
+        try:
+            handler(batch)
+        except Exception as e:
+            delay = min(2 ** batch.attempts, MAX_RETRY_DELAY_SECONDS)
+            log.error(f"Batch handler failed ({type(e).__name__}); retrying in {delay}s", exc_info=True)
+            queue.release(batch, delay)
+            continue
+        if not queue.ack(batch):
+            log.warning(f"Ack rejected for {batch.group[:6]}*** (visibility timeout expired); it may be redelivered")
+
+
+def process_batch(batch: JobBatch, max_attempts: int = JOB_MAX_ATTEMPTS, queue=None) -> None:
+    """
+    Turno del lote y entrega de la respuesta. Lanza excepción si el turno falla o algún trozo no se
+    entrega, para que work() reintente el lote y acabe en dead letters. En el último intento un turno
+    fallido responde con la disculpa: el cliente no se queda sin respuesta.
+
+    Si un intento anterior ya respondió a los primeros trabajos del lote, solo se reenvían sus trozos
+    pendientes y los mensajes llegados después se responden con un turno propio. Con 'queue' el diario
+    de cada turno se guarda en el lote (queue.save_progress) y los reintentos no repiten sus efectos.
+    """
+    ids, payloads = list(batch.ids), list(batch.payloads)
+    answered: List[str] = []
+    while ids:
+        with _pending_lock:
+            pending = _pending_replies.get(ids[0])
+        if pending is None or ids[:len(pending.ids)] != pending.ids:
+            journal = _turn_journal(batch, ids[0], queue)
+            pending = PendingReply(list(ids), chunk_text(_run_turn(batch, payloads, max_attempts, journal)))
+            with _pending_lock:
+                _pending_replies[ids[0]] = pending
+                while len(_pending_replies) > MAX_PENDING_REPLIES:
+                    _pending_replies.popitem(last=False)
+        if pending.parts:
+            results = send_whatsapp_parts(batch.group, pending.parts).result()
+            # El planificador descarta el resto del mensaje tras un fallo: lo entregado es siempre un prefijo
+            delivered = next((i for i, result in enumerate(results) if not result.ok), len(results))
+            pending.parts = pending.parts[delivered:]
+            if pending.parts:
+                raise DeliveryFailed(f"{len(pending.parts)}/{len(results)} chunks not delivered: "
+                                     f"{results[delivered].error}")
+        answered.append(ids[0])
+        ids, payloads = ids[len(pending.ids):], payloads[len(pending.ids):]
+    with _pending_lock:
+        for key in answered:
+            _pending_replies.pop(key, None)
+
+
+def _turn_journal(batch: JobBatch, first_id: str, queue) -> TurnJournal:
+    """Diario del turno que empieza en el trabajo 'first_id', dentro del diario del lote."""
+    prefix = f"{first_id}:"
+    entries = {key[len(prefix):]: value for key, value in batch.progress.items() if key.startswith(prefix)}
+
+    def persist(turn_entries):
+        batch.progress.update({prefix + key: value for key, value in turn_entries.items()})
+        if queue is not None and not queue.save_progress(batch, batch.progress):
+            log.warning(f"Turn journal for {_mask_phone(batch.group)} not saved: the batch is no longer ours")
+    return TurnJournal(entries, persist)
+
+
+def _run_turn(batch: JobBatch, payloads: List[dict], max_attempts: int,
+              journal: Optional[TurnJournal] = None) -> str:
+    text = merge_messages([payload["text"] for payload in payloads])
+    try:
+        with use_turn_journal(journal):
+            reply = run_odoo_crew(batch.group, text, raise_errors=True)
+        if reply.strip():
+            return reply
+        # La Graph API rechaza un mensaje vacío: el cliente recibe la disculpa en su lugar
+        log.warning(f"Turn for {_mask_phone(batch.group)} returned an empty reply; sending apology")
+        return ERROR_MESSAGE
+    except Exception:
+        if batch.attempts < max_attempts:
+            raise
+        log.error(f"Turn for {_mask_phone(batch.group)} failed on its last attempt; sending apology")
+        return ERROR_MESSAGE
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker de la cola de entrada de WhatsApp")
+    parser.add_argument("--threads", type=int, default=JOB_WORKER_THREADS, help="turnos concurrentes en este proceso")
+    args = parser.parse_args()
+
+    queue = build_job_queue()
+    if queue is None:
+        sys.exit("JOB_QUEUE_BACKEND must be 'sqlite' or 'redis' to run the queue worker")
+    # La API carga el crew de forma diferida; el worker no atiende health checks y lo carga antes del primer lote
+    import crew_logic  # noqa: F401
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    handler = functools.partial(process_batch, queue=queue)
+    threads = [threading.Thread(target=work, args=(queue, handler, stop), name=f"queue-worker-{i}")
+               for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    log.info(f"Queue worker started with {args.threads} threads")
+    for thread in threads:
+        thread.join()
+    log.info("Queue worker stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+"""
+Cliente Redis compartido (cola de entrada y, en general, estado entre procesos).
+redis-py se importa solo si se configura un backend Redis: el despliegue de un único proceso no lo necesita.
+"""
+import threading
+from typing import Dict
+from config import REDIS_URL
+from logger import get_logger
+
+log = get_logger("redis_client")
+
+_clients: Dict[str, object] = {}
+_clients_lock = threading.Lock()
+
+
+def get_redis(url: str = ""):
+    """Cliente (con pool de conexiones) por URL, con respuestas decodificadas a str."""
+    url = url or REDIS_URL
+    if not url:
+        raise RuntimeError("REDIS_URL is required for the Redis backend")
+    with _clients_lock:
+        client = _clients.get(url)
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url, decode_responses=True, socket_timeout=5, socket_connect_timeout=5)
+            _clients[url] = client
+            log.info("Redis client created")
+        return client
@@ -0,0 +1,230 @@
+"""
+Estado compartido de la API (rate limiting por IP y deduplicación de webhooks) con backends
+intercambiables: memoria (un proceso), SQLite (varios procesos del mismo host) y Redis (varios hosts).
+Cada operación es atómica en su backend y la caducidad la gestiona el propio backend, así que
+RateLimiter y MessageDedup siguen siendo correctos con varios workers de gunicorn.
+
+El rate limit es un contador de ventana deslizante: por clave solo se guardan la ventana fija actual
+y la anterior, y la anterior pesa en proporción a lo que aún solapa con la ventana deslizante.
+Memoria constante por clave y O(1) por petición, sin listas de timestamps.
+
+'blocking' indica si las operaciones pueden esperar (disco o red): en ese caso la API las llama
+desde un hilo y no desde el event loop.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Tuple
+from config import STATE_BACKEND, STATE_DB_PATH, STATE_MAX_CLAIMS, RATE_LIMIT_MAX_KEYS
+from logger import get_logger
+
+log = get_logger("state_backend")
+
+# Cada cuántas operaciones se purgan las entradas caducadas (SQLite)
+PURGE_EVERY = 500
+
+
+def window_position(now: float, window_seconds: float) -> Tuple[int, float]:
+    """Índice de la ventana fija que contiene 'now' y fracción ya transcurrida de ella."""
+    index, offset = divmod(now, window_seconds)
+    return int(index), offset / window_seconds
+
+
+def sliding_count(previous: int, current: int, elapsed: float) -> float:
+    """Accesos estimados en la ventana deslizante (la ventana anterior pesa lo que aún solapa)."""
+    return previous * (1.0 - elapsed) + current
+
+
+class MemoryStateBackend:
+    """
+    Estado en el proceso, con memoria acotada y limpieza O(1) amortizada:
+    - Marcas de dedup en un OrderedDict por orden de inserción (= orden de caducidad con un TTL fijo):
+      las caducadas se retiran desde el principio y nunca hay más de 'max_claims'.
+    - Contadores de rate limit en otro OrderedDict por orden de uso: las claves inactivas (sin accesos
+      en sus dos últimas ventanas) se desalojan desde el principio y nunca hay más de 'max_keys'.
+    Al llegar a un tope se desaloja la entrada más antigua.
+    """
+
+    blocking = False
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS, max_claims: int = STATE_MAX_CLAIMS) -> None:
+        self.max_keys = max_keys
+        self.max_claims = max_claims
+        # clave -> instante de caducidad
+        self._claims: "OrderedDict[str, float]" = OrderedDict()
+        # clave -> [índice de ventana, accesos ventana anterior, accesos ventana actual, duración ventana]
+        self._counters: "OrderedDict[str, List]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire_claims(self, now: float) -> None:
+        """Retira las marcas caducadas del principio (cada una se retira una sola vez) y respeta el tope."""
+        claims = self._claims
+        while claims and next(iter(claims.values())) <= now:
+            claims.popitem(last=False)
+        while len(claims) >= self.max_claims:
+            claims.popitem(last=False)
+
+    def _evict_counters(self, now: float) -> None:
+        """Antes de insertar una clave: respeta el tope y retira hasta dos inactivas (O(1) amortizado)."""
+        counters = self._counters
+        if len(counters) >= self.max_keys:
+            counters.popitem(last=False)
+        for _ in range(2):
+            if not counters:
+                return
+            index, _, _, window = next(iter(counters.values()))
+            if index >= int(now // window) - 1:
+                return
+            counters.popitem(last=False)
+
+    def claim(self, key: str, ttl_seconds: float) -> bool:
+        """Marca 'key' durante 'ttl_seconds'; True solo para quien la marca primero."""
+        now = time.time()
+        with self._lock:
+            expires = self._claims.get(key)
+            if expires is not None:
+                if expires > now:
+                    return False
+                del self._claims[key]
+            self._expire_claims(now)
+            self._claims[key] = now + ttl_seconds
+            return True
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            self._claims.pop(key, None)
+
+    def hit(self, key: str, limit: int, window_seconds: float) -> bool:
+        """Registra un acceso si en la ventana deslizante hay menos de 'limit'; devuelve si se permitió."""
+        now = time.time()
+        index, elapsed = window_position(now, window_seconds)
+        with self._lock:
+            counter = self._counters.get(key)
+            if counter is None:
+                self._evict_counters(now)
+                counter = self._counters[key] = [index, 0, 0, window_seconds]
+            else:
+                self._counters.move_to_end(key)
+                if counter[0] != index:
+                    counter[1] = counter[2] if counter[0] == index - 1 else 0
+                    counter[0], counter[2] = index, 0
+            if sliding_count(counter[1], counter[2], elapsed) + 1 > limit:
+                return False
+            counter[2] += 1
+            return True
+
+    def __len__(self) -> int:
+        return len(self._counters)
+
+
+class SQLiteStateBackend:
+    """Mismo contrato sobre un fichero SQLite compartido; BEGIN IMMEDIATE hace atómica cada operación."""
+
+    # BEGIN IMMEDIATE espera hasta 10 s si otro proceso tiene el fichero bloqueado
+    blocking = True
+
+    def __init__(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=10.0, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS claims_expires_at ON claims (expires_at)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS rate_counters (key TEXT PRIMARY KEY, window_index INTEGER NOT NULL, "
+                         "previous INTEGER NOT NULL, current INTEGER NOT NULL, expires_at REAL NOT NULL)")
+        self._lock = threading.Lock()
+        self._ops = 0
+
+    def _transaction(self, func):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(self._db, time.time())
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            self._ops += 1
+            if self._ops % PURGE_EVERY == 0:
+                now = time.time()
+                self._db.execute("DELETE FROM claims WHERE expires_at <= ?", (now,))
+                self._db.execute("DELETE FROM rate_counters WHERE expires_at <= ?", (now,))
+            return result
+
+    def claim(self, key: str, ttl_seconds: float) -> bool:
+        def insert(db: sqlite3.Connection, now: float) -> bool:
+            db.execute("DELETE FROM claims WHERE key = ? AND expires_at <= ?", (key, now))
+            cursor = db.execute("INSERT OR IGNORE INTO claims (key, expires_at) VALUES (?, ?)",
+                                (key, now + ttl_seconds))
+            return cursor.rowcount == 1
+        return self._transaction(insert)
+
+    def release(self, key: str) -> None:
+        self._transaction(lambda db, now: db.execute("DELETE FROM claims WHERE key = ?", (key,)))
+
+    def hit(self, key: str, limit: int, window_seconds: float) -> bool:
+        def record(db: sqlite3.Connection, now: float) -> bool:
+            index, elapsed = window_position(now, window_seconds)
+            row = db.execute("SELECT window_index, previous, current FROM rate_counters WHERE key = ?",
+                             (key,)).fetchone()
+            previous, current = 0, 0
+            if row is not None and row[0] == index:
+                previous, current = row[1], row[2]
+            elif row is not None and row[0] == index - 1:
+                previous = row[2]
+            if sliding_count(previous, current, elapsed) + 1 > limit:
+                return False
+            db.execute("INSERT OR REPLACE INTO rate_counters (key, window_index, previous, current, expires_at) "
+                       "VALUES (?, ?, ?, ?, ?)", (key, index, previous, current + 1, (index + 2) * window_seconds))
+            return True
+        return self._transaction(record)
+
+
+class RedisStateBackend:
+    """
+    Mismo contrato sobre Redis: claim es SET NX PX y el rate limit un contador por ventana fija
+    (MULTI/EXEC: leer la anterior, INCR de la actual y caducarla a las dos ventanas). Un acceso
+    rechazado se descuenta después, así que el límite nunca se supera aunque dos hosts compitan
+    por el último hueco.
+    """
+
+    blocking = True
+
+    def __init__(self, client, prefix: str = "state") -> None:
+        self._redis = client
+        self._prefix = prefix
+
+    def claim(self, key: str, ttl_seconds: float) -> bool:
+        return bool(self._redis.set(f"{self._prefix}:claim:{key}", "1", nx=True, px=int(ttl_seconds * 1000)))
+
+    def release(self, key: str) -> None:
+        self._redis.delete(f"{self._prefix}:claim:{key}")
+
+    def hit(self, key: str, limit: int, window_seconds: float) -> bool:
+        index, elapsed = window_position(time.time(), window_seconds)
+        current_key = f"{self._prefix}:rate:{key}:{index}"
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.get(f"{self._prefix}:rate:{key}:{index - 1}")
+        pipe.incr(current_key)
+        pipe.pexpire(current_key, int(window_seconds * 2000))
+        previous, current, _ = pipe.execute()
+        if sliding_count(int(previous or 0), current, elapsed) > limit:
+            self._redis.decr(current_key)
+            return False
+        return True
+
+
+def build_state_backend(backend: str = STATE_BACKEND):
+    """Backend configurado en STATE_BACKEND ("memory", "sqlite" o "redis")."""
+    if backend in ("", "memory"):
+        return MemoryStateBackend()
+    log.info(f"Shared state backend: {backend}")
+    if backend == "sqlite":
+        return SQLiteStateBackend(STATE_DB_PATH)
+    if backend == "redis":
+        from redis_client import get_redis
+        return RedisStateBackend(get_redis())
+    raise ValueError(f"Unknown STATE_BACKEND '{backend}' (expected 'memory', 'sqlite' or 'redis')")
@@ -0,0 +1,156 @@
+"""
+Memoización de herramientas dentro de un turno.
+El agente repite a menudo la misma consulta mientras razona (Search Products, Check Calendar
+Availability, Search Odoo Customer...). Las herramientas de solo lectura se decoran con @memoized:
+dentro del turno, una llamada con los mismos argumentos normalizados devuelve el resultado anterior
+sin ir a Odoo. Las de escritura se decoran con @invalidates y borran las entradas de las etiquetas
+que modifican (p. ej. reservar una reunión invalida "calendar" y "partners").
+La memoria vive en un contextvar (mismo patrón que prefetch): fuera de un turno no se memoiza nada.
+"""
+import functools
+import inspect
+import re
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, FrozenSet, Hashable, Iterator, Optional, Tuple
+from config import TOOL_MEMO_ENABLED
+from logger import get_logger
+
+log = get_logger("tool_memo")
+
+_current: ContextVar[Optional["TurnToolMemo"]] = ContextVar("turn_tool_memo", default=None)
+
+_stats: Dict[str, int] = {"hits": 0, "misses": 0, "invalidated": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(key: str, amount: int = 1) -> None:
+    with _stats_lock:
+        _stats[key] += amount
+
+
+def get_tool_memo_stats() -> Dict[str, float]:
+    with _stats_lock:
+        stats: Dict[str, float] = dict(_stats)
+    calls = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / calls, 4) if calls else 0.0
+    return stats
+
+
+def normalize_arg(value) -> Hashable:
+    """Texto sin mayúsculas ni espacios repetidos; "12", 12 y 12.0 son el mismo número."""
+    if isinstance(value, str):
+        text = " ".join(value.split()).casefold()
+        return int(text) if re.fullmatch(r"-?\d+", text) else text
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(normalize_arg(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, normalize_arg(v)) for k, v in value.items()))
+    return value
+
+
+class TurnToolMemo:
+    """Resultados de herramientas de un turno, etiquetados para poder invalidarlos."""
+
+    def __init__(self) -> None:
+        self._entries: Dict[Tuple, Tuple[str, FrozenSet[str]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry[0] if entry else None
+
+    def put(self, key: Tuple, result: str, tags: FrozenSet[str]) -> None:
+        with self._lock:
+            self._entries[key] = (result, tags)
+
+    def invalidate(self, tags: FrozenSet[str]) -> int:
+        with self._lock:
+            stale = [key for key, (_, entry_tags) in self._entries.items() if entry_tags & tags]
+            for key in stale:
+                del self._entries[key]
+        return len(stale)
+
+
+def _memo_key(tool_name: str, signature: inspect.Signature, args, kwargs,
+              normalizers: Dict[str, Callable]) -> Tuple:
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    items = []
+    for name, value in bound.arguments.items():
+        if name == "self":
+            continue
+        normalizer = normalizers.get(name)
+        if normalizer is not None:
+            try:
+                value = normalizer(value)
+            except (TypeError, ValueError):
+                pass
+        items.append((name, normalize_arg(value)))
+    return (tool_name, tuple(items))
+
+
+def memoized(*tags: str, normalize: Optional[Dict[str, Callable]] = None):
+    """
+    Decorador para _run de herramientas de solo lectura. Los resultados de error (texto que empieza
+    por "Error", convención de las herramientas) no se guardan para que el agente pueda reintentar.
+    """
+    tag_set = frozenset(tags)
+    normalizers = normalize or {}
+
+    def decorator(run):
+        signature = inspect.signature(run)
+
+        @functools.wraps(run)
+        def wrapper(self, *args, **kwargs):
+            memo = _current.get()
+            if memo is None:
+                return run(self, *args, **kwargs)
+            key = _memo_key(self.name, signature, (self,) + args, kwargs, normalizers)
+            cached = memo.get(key)
+            if cached is not None:
+                _count("hits")
+                log.info(f"Tool memo hit: {self.name}")
+                return cached
+            _count("misses")
+            result = run(self, *args, **kwargs)
+            if isinstance(result, str) and not result.startswith("Error"):
+                memo.put(key, result, tag_set)
+            return result
+        return wrapper
+    return decorator
+
+
+def invalidates(*tags: str):
+    """Decorador para _run de herramientas de escritura: tras ejecutarse (con o sin éxito) invalida 'tags'."""
+    tag_set = frozenset(tags)
+
+    def decorator(run):
+        @functools.wraps(run)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return run(self, *args, **kwargs)
+            finally:
+                memo = _current.get()
+                if memo is not None:
+                    removed = memo.invalidate(tag_set)
+                    if removed:
+                        _count("invalidated", removed)
+                        log.info(f"Tool memo: {self.name} invalidated {removed} entries {sorted(tag_set)}")
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def use_tool_memo() -> Iterator[Optional[TurnToolMemo]]:
+    """Memoria de herramientas nueva para el bloque (el turno); no hace nada si está desactivada."""
+    memo = TurnToolMemo() if TOOL_MEMO_ENABLED else None
+    token = _current.set(memo)
+    try:
+        yield memo
+    finally:
+        _current.reset(token)
@@ -4,6 +4,7 @@ Usa el servidor de correo ya configurado en Odoo, y el email queda registrado en
 """
 import os
 from crewai.tools import BaseTool
+from turn_journal import journaled
 from logger import get_logger
 
 log = get_logger("tools_email")
@@ -22,6 +23,7 @@ class SendEmailTool(BaseTool):
         "Use this AFTER successfully booking a meeting with OdooFullBookingTool."
     )
 
+    @journaled
     def _run(self, to_email: str, subject: str, body: str) -> str:
         try:
             # Lazy import para evitar crash al importar el módulo
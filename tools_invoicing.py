@@ -4,6 +4,8 @@ Genera facturas desde pedidos confirmados y crea órdenes de fabricación.
 """
 from crewai.tools import BaseTool
 from odoo_client import OdooClient
+from tool_memo import invalidates
+from turn_journal import journaled
 from logger import get_logger
 
 log = get_logger("tools_invoicing")
@@ -20,6 +22,7 @@ class CreateInvoiceTool(BaseTool):
         "The order must be in 'confirmed' state. Returns invoice reference and total."
     )
 
+    @journaled
     def _run(self, order_id: int) -> str:
         try:
             invoice = odoo.create_invoice_from_order(int(order_id))
@@ -48,6 +51,8 @@ class CreateManufacturingOrderTool(BaseTool):
         "Returns the manufacturing order reference."
     )
 
+    @journaled
+    @invalidates("stock")
     def _run(self, product_id: int, quantity: float) -> str:
         try:
             mo = odoo.create_manufacturing_order(int(product_id), float(quantity))
@@ -1,5 +1,8 @@
 from crewai.tools import BaseTool
 from odoo_client import OdooClient
+from tool_memo import memoized, invalidates
+from turn_journal import journaled
+from utils import normalize_phone
 
 odoo = OdooClient()
 
@@ -7,6 +10,7 @@ class OdooSearchTool(BaseTool):
     name: str = "Search Odoo Customer"
     description: str = "Searches for an existing customer in Odoo using their phone number. Returns customer details if found."
 
+    @memoized("partners", normalize={"phone": normalize_phone})
     def _run(self, phone: str) -> str:
         partner = odoo.search_contact_by_phone(phone)
         if partner:
@@ -20,6 +24,7 @@ class OdooCheckAvailabilityTool(BaseTool):
     name: str = "Check Calendar Availability"
     description: str = "Reads Odoo calendar between date_start and date_end (YYYY-MM-DD HH:MM:SS) to find booked meetings. If it returns an empty list, the slot is free. Always check this before booking."
 
+    @memoized("calendar")
     def _run(self, date_start: str, date_end: str) -> str:
         try:
             events = odoo.check_availability(date_start, date_end)
@@ -33,6 +38,8 @@ class OdooFullBookingTool(BaseTool):
     name: str = "Create Full Booking (Lead & Meeting)"
     description: str = "Creates a Partner, a Lead, and schedules the Meeting all at once. Requires name, phone, email, description, and start_date (YYYY-MM-DD HH:MM:SS)."
 
+    @journaled
+    @invalidates("partners", "calendar")
     def _run(self, name: str, phone: str, email: str, description: str, start_date: str) -> str:
         try:
             res = odoo.create_full_booking(name, phone, email, description, start_date)
@@ -4,6 +4,9 @@ Buscar productos, verificar stock, crear pedidos de venta y confirmarlos.
 """
 from crewai.tools import BaseTool
 from odoo_client import OdooClient
+from prefetch import prefetched_products
+from tool_memo import memoized, invalidates
+from turn_journal import journaled
 from logger import get_logger
 
 log = get_logger("tools_orders")
@@ -20,9 +23,13 @@ class ProductSearchTool(BaseTool):
         "or wants to place an order. Input: query (product name or partial name)."
     )
 
+    @memoized("products", "stock")
     def _run(self, query: str) -> str:
         try:
-            products = odoo.search_products(query)
+            # Resultado especulativo del turno si cubre esta búsqueda; si no, consulta a Odoo
+            products = prefetched_products(query)
+            if products is None:
+                products = odoo.search_products(query)
             if not products:
                 return f"No se encontraron productos con '{query}' en el catálogo."
             
@@ -50,6 +57,7 @@ class InventoryCheckTool(BaseTool):
         "an order to verify product availability. Input: product_id (integer)."
     )
 
+    @memoized("stock")
     def _run(self, product_id: int) -> str:
         try:
             stock = odoo.get_product_stock(int(product_id))
@@ -78,6 +86,9 @@ class CreateSaleOrderTool(BaseTool):
         "Returns the order reference number, total amount, and payment link."
     )
 
+    @journaled
+    # El pedido reserva stock (y la búsqueda de productos muestra el disponible): ambos quedan obsoletos
+    @invalidates("partners", "products", "stock")
     def _run(self, name: str, phone: str, address: str, product_id: int, quantity: float, email: str = "") -> str:
         try:
             # 1. Buscar o crear partner
@@ -1,16 +1,47 @@
 """
 Herramienta RAG para búsqueda semántica en la base de conocimientos de Tortillas Mejicanas.
 Reutiliza el cliente Supabase global de tools_supabase para evitar duplicación.
+Los embeddings de consulta pasan por la caché de embedding_cache (memoria + disco) y la
+búsqueda se resuelve en el índice local (vector_index) cuando está disponible; si no, vía RPC.
+Antes de todo eso se prueba BM25 (lexical_index): con un acierto claro no se pide embedding.
+Si el turno ya tiene un resultado especulativo equivalente (prefetch), se sirve directamente.
 """
-from openai import OpenAI
+import threading
+from typing import Dict, List
 from crewai.tools import BaseTool
-from config import OPENAI_API_KEY
+from config import KB_LEXICAL_FIRST, LEXICAL_CO_HIT_RATIO, LEXICAL_MIN_COVERAGE, LEXICAL_MIN_MARGIN
+from embedding_cache import embed_query
+from lexical_index import get_lexical_index
+from prefetch import prefetched_kb
+from tool_memo import memoized
+from vector_index import get_kb_index
 from logger import get_logger
 
 log = get_logger("tools_rag")
 
-# Cliente OpenAI para embeddings
-_openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# Mismos parámetros para el índice local y para la RPC match_kb_items
+MATCH_THRESHOLD = 0.5
+MATCH_COUNT = 5
+
+# Constante de Reciprocal Rank Fusion (valor estándar de la literatura)
+RRF_K = 60
+
+_rag_stats: Dict[str, int] = {"queries": 0, "lexical_answers": 0, "embedding_calls": 0, "fused": 0}
+_rag_stats_lock = threading.Lock()
+
+
+def _count(key: str) -> None:
+    with _rag_stats_lock:
+        _rag_stats[key] += 1
+
+
+def get_rag_stats() -> Dict[str, float]:
+    """Contadores de recuperación; embedding_calls_saved son las consultas resueltas solo con BM25."""
+    with _rag_stats_lock:
+        stats: Dict[str, float] = dict(_rag_stats)
+    stats["embedding_calls_saved"] = stats["lexical_answers"]
+    stats["lexical_hit_rate"] = round(stats["lexical_answers"] / stats["queries"], 4) if stats["queries"] else 0.0
+    return stats
 
 
 class OdooRAGTool(BaseTool):
@@ -18,36 +49,85 @@ class OdooRAGTool(BaseTool):
     name: str = "Knowledge Base Search"
     description: str = "Searches the company knowledge base for product information, services, and pricing of Tortillas Mejicanas. Use this for ANY question about products, prices, or what the company offers."
 
+    @memoized("kb")
     def _run(self, query: str) -> str:
         try:
-            # Importar el cliente Supabase de tools_supabase (lazy, evita crash al import)
-            from tools_supabase import supabase
-            
-            # 1. Generar embedding para la consulta
-            response = _openai_client.embeddings.create(
-                input=query,
-                model="text-embedding-3-small"
-            )
-            query_embedding = response.data[0].embedding
-
-            # 2. Búsqueda por similitud via RPC
-            rpc_params = {
-                "query_embedding": query_embedding,
-                "match_threshold": 0.5,
-                "match_count": 5,
-                "p_agent_id": None
-            }
-            
-            res = supabase.rpc("match_kb_items", rpc_params).execute()
-            
-            if not res.data:
+            items = prefetched_kb(query)
+            if items is None:
+                items = retrieve(query)
+
+            if not items:
                 return "No se encontró información relevante en la base de conocimientos."
-            
+
             context = "Información encontrada:\n"
-            for item in res.data:
+            for item in items:
                 context += f"- {item['content']}\n"
-            
+
             return context
         except Exception as e:
             log.error(f"RAG search error: {type(e).__name__}")
-            return "No se pudo consultar la base de conocimientos en este momento."
+            # Empieza por "Error" (convención de las herramientas): tool_memo no lo guarda y el agente puede reintentar
+            return "Error consultando la base de conocimientos: no disponible en este momento."
+
+
+def retrieve(query: str) -> List[Dict]:
+    """BM25 primero; si no es concluyente, embedding + búsqueda vectorial fusionadas por RRF."""
+    _count("queries")
+
+    # 1. Búsqueda léxica (SKU exacto o ganador claro → sin embedding)
+    lexical_hits: List[Dict] = []
+    lexical = get_lexical_index() if KB_LEXICAL_FIRST else None
+    if lexical is not None:
+        lexical_hits = lexical.search(query, MATCH_COUNT)
+        if lexical.is_confident(query, lexical_hits, LEXICAL_MIN_COVERAGE, LEXICAL_MIN_MARGIN):
+            _count("lexical_answers")
+            log.info("RAG lexical hit: embedding skipped")
+            # is_confident solo valida el primero: el resto entra solo si puntúa cerca de él
+            floor = lexical_hits[0]["score"] * LEXICAL_CO_HIT_RATIO
+            return [hit for hit in lexical_hits if hit["score"] >= floor]
+
+    # 2. Generar embedding para la consulta (cacheado por texto normalizado + modelo)
+    _count("embedding_calls")
+    query_embedding = embed_query(query)
+
+    # 3. Búsqueda por similitud: índice local y, si no está disponible, RPC
+    vector_hits = search_kb(query_embedding)
+    if not lexical_hits:
+        return vector_hits
+    _count("fused")
+    return fuse_results(lexical_hits, vector_hits, MATCH_COUNT)
+
+
+def fuse_results(lexical_hits: List[Dict], vector_hits: List[Dict], limit: int) -> List[Dict]:
+    """Reciprocal Rank Fusion de ambas listas, deduplicando por id (o por contenido)."""
+    scores: Dict = {}
+    items: Dict = {}
+    for hits in (vector_hits, lexical_hits):
+        for rank, item in enumerate(hits):
+            key = item.get("id", item["content"])
+            scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank + 1)
+            items.setdefault(key, item)
+    ranked = sorted(scores, key=lambda key: scores[key], reverse=True)[:limit]
+    return [items[key] for key in ranked]
+
+
+def search_kb(query_embedding: list) -> list:
+    """Top-k de kb_items por similitud: índice local mapeado en memoria o RPC match_kb_items."""
+    index = get_kb_index()
+    if index is not None:
+        try:
+            return index.search(query_embedding, MATCH_THRESHOLD, MATCH_COUNT)
+        except Exception as e:
+            log.warning(f"Local KB search failed, falling back to RPC: {type(e).__name__}")
+
+    # Importar el cliente Supabase de tools_supabase (lazy, evita crash al import)
+    from tools_supabase import supabase
+
+    rpc_params = {
+        "query_embedding": query_embedding,
+        "match_threshold": MATCH_THRESHOLD,
+        "match_count": MATCH_COUNT,
+        "p_agent_id": None
+    }
+    res = supabase.rpc("match_kb_items", rpc_params).execute()
+    return res.data or []
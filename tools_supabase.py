@@ -1,9 +1,13 @@
-from supabase import create_client, Client
+from supabase import create_client, acreate_client, AsyncClient, Client
 from config import SUPABASE_URL, SUPABASE_KEY
 from crewai.tools import BaseTool
-from typing import Optional
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
 from logger import get_logger
+import asyncio
 import os
+import threading
+import weakref
 
 log = get_logger("supabase_tools")
 
@@ -20,16 +24,30 @@ def _mask_phone(phone: str) -> str:
     return "***"
 
 
+# Los ids no cambian: se cachean y el "buscar o crear" va bajo lock, porque un turno consulta
+# historial, resumen y guarda el mensaje en paralelo y no debe crear dos leads para el mismo teléfono.
+_tenant_id_cache: Dict[str, str] = {}
+_lead_id_cache: Dict[Tuple[str, str], str] = {}
+_ids_lock = threading.Lock()
+
+
 def _get_tenant_id() -> Optional[str]:
     """Busca o crea el tenant_id de la organización configurada."""
+    if TENANT_NAME in _tenant_id_cache:
+        return _tenant_id_cache[TENANT_NAME]
     try:
-        res = supabase.table("organizations").select("id").eq("name", TENANT_NAME).limit(1).execute()
-        if res.data and len(res.data) > 0:
-            return res.data[0]["id"]
-        
-        insert_res = supabase.table("organizations").insert({"name": TENANT_NAME}).execute()
-        log.info(f"Tenant '{TENANT_NAME}' created")
-        return insert_res.data[0]["id"]
+        with _ids_lock:
+            if TENANT_NAME in _tenant_id_cache:
+                return _tenant_id_cache[TENANT_NAME]
+            res = supabase.table("organizations").select("id").eq("name", TENANT_NAME).limit(1).execute()
+            if res.data and len(res.data) > 0:
+                tenant_id = res.data[0]["id"]
+            else:
+                insert_res = supabase.table("organizations").insert({"name": TENANT_NAME}).execute()
+                log.info(f"Tenant '{TENANT_NAME}' created")
+                tenant_id = insert_res.data[0]["id"]
+            _tenant_id_cache[TENANT_NAME] = tenant_id
+            return tenant_id
     except Exception as e:
         log.error(f"tenant_id error: {type(e).__name__}")
         return None
@@ -39,32 +57,44 @@ def _get_or_create_lead_id(phone: str, tenant_id: str) -> Optional[str]:
     """Busca o crea un lead_id real en la tabla leads."""
     if not tenant_id:
         return None
+    key = (tenant_id, phone)
+    if key in _lead_id_cache:
+        return _lead_id_cache[key]
         
     try:
-        res = supabase.table("leads").select("id").eq("phone", phone).eq("tenant_id", tenant_id).limit(1).execute()
-        if res.data and len(res.data) > 0:
-            return res.data[0]["id"]
-            
-        new_lead = {"name": "Cliente de WhatsApp", "phone": phone, "tenant_id": tenant_id}
-        insert_res = supabase.table("leads").insert(new_lead).execute()
-        log.info(f"Lead created for {_mask_phone(phone)}")
-        return insert_res.data[0]["id"]
+        with _ids_lock:
+            if key in _lead_id_cache:
+                return _lead_id_cache[key]
+            res = supabase.table("leads").select("id").eq("phone", phone).eq("tenant_id", tenant_id).limit(1).execute()
+            if res.data and len(res.data) > 0:
+                lead_id = res.data[0]["id"]
+            else:
+                new_lead = {"name": "Cliente de WhatsApp", "phone": phone, "tenant_id": tenant_id}
+                insert_res = supabase.table("leads").insert(new_lead).execute()
+                log.info(f"Lead created for {_mask_phone(phone)}")
+                lead_id = insert_res.data[0]["id"]
+            _lead_id_cache[key] = lead_id
+            return lead_id
     except Exception as e:
         log.error(f"lead_id error: {type(e).__name__}")
         return None
 
 
-def save_message(session_phone: str, role: str, content: str) -> None:
-    """Guarda un mensaje en la tabla 'messages'."""
+def _db_role(role: str) -> str:
+    return 'assistant' if role.lower() in ('agente', 'assistant') else 'user'
+
+
+def save_message(session_phone: str, role: str, content: str) -> bool:
+    """Guarda un mensaje en la tabla 'messages'; devuelve si se guardó."""
     try:
-        db_role = 'assistant' if role.lower() in ('agente', 'assistant') else 'user'
+        db_role = _db_role(role)
         
         tenant_id = _get_tenant_id()
         lead_id = _get_or_create_lead_id(session_phone, tenant_id)
         
         if not tenant_id or not lead_id:
             log.warning("Aborted save: missing tenant/lead")
-            return
+            return False
 
         data = {
             "lead_id": lead_id,
@@ -74,44 +104,268 @@ def save_message(session_phone: str, role: str, content: str) -> None:
         }
         supabase.table("messages").insert(data).execute()
         log.info(f"Message '{db_role}' saved for {_mask_phone(session_phone)}")
+        return True
     except Exception as e:
         log.error(f"save_message error: {type(e).__name__}")
+        return False
+
+
+# Valor de get_recent_messages cuando la consulta falla (distinto de "sin historial")
+HISTORY_UNAVAILABLE = "No se pudo recuperar el historial."
+
+
+NO_HISTORY = "No hay historial previo de conversación."
+
+
+def _recent_cutoff() -> str:
+    """Solo cuentan los mensajes de los últimos 30 minutos (sesión activa real)."""
+    return (datetime.now(timezone.utc) - timedelta(minutes=30)).isoformat()
 
 
-def get_recent_messages(session_phone: str, limit: int = 5) -> str:
-    """Recupera los últimos N mensajes para contexto conversacional."""
+def _format_recent_messages(rows: List[Dict], limit: int, pending_user_message: Optional[str]) -> str:
+    """Texto del historial a partir de las filas (más reciente primero) de la consulta."""
+    rows = list(reversed(rows))
+    if pending_user_message is not None:
+        last = rows[-1] if rows else None
+        if not last or last["role"] != "user" or last["content"] != pending_user_message:
+            rows = (rows + [{"role": "user", "content": pending_user_message}])[-limit:]
+    
+    if not rows:
+        return NO_HISTORY
+        
+    messages_str = "Historial reciente de esta conversación (últimas horas):\n"
+    for msg in rows:
+        display_role = "AGENTE" if msg['role'] == "assistant" else "USUARIO"
+        messages_str += f"[{display_role}]: {msg['content']}\n"
+    return messages_str
+
+
+def get_recent_messages(session_phone: str, limit: int = 5, pending_user_message: Optional[str] = None) -> str:
+    """
+    Recupera los últimos N mensajes para contexto conversacional.
+    'pending_user_message' es el mensaje del turno que se está guardando en paralelo: se añade al
+    final si la consulta aún no lo ve, para que el historial sea el mismo gane quien gane la carrera.
+    """
     try:
         tenant_id = _get_tenant_id()
         lead_id = _get_or_create_lead_id(session_phone, tenant_id)
         
         if not tenant_id or not lead_id:
-            return "No hay historial previo de conversación."
-        
-        # Solo recuperar mensajes de los últimos 30 minutos (sesión activa real)
-        from datetime import datetime, timedelta, timezone
-        cutoff = (datetime.now(timezone.utc) - timedelta(minutes=30)).isoformat()
+            return NO_HISTORY
         
         res = (supabase.table("messages")
                .select("role, content")
                .eq("lead_id", lead_id)
                .eq("tenant_id", tenant_id)
-               .gte("created_at", cutoff)
+               .gte("created_at", _recent_cutoff())
                .order("created_at", desc=True)
                .limit(limit)
                .execute())
-        
+        return _format_recent_messages(res.data or [], limit, pending_user_message)
+    except Exception as e:
+        log.error(f"get_recent_messages error: {type(e).__name__}")
+        return HISTORY_UNAVAILABLE
+
+
+def _summary_cutoff(max_age_hours: int) -> str:
+    """Un resumen antiguo pertenece a otra conversación: se ignora y se empieza de cero."""
+    return (datetime.now(timezone.utc) - timedelta(hours=max_age_hours)).isoformat()
+
+
+def get_conversation_summary(session_phone: str, max_age_hours: int = 24) -> str:
+    """Recupera el resumen acumulado de la conversación (tabla 'conversation_summaries')."""
+    try:
+        tenant_id = _get_tenant_id()
+        lead_id = _get_or_create_lead_id(session_phone, tenant_id)
+
+        if not tenant_id or not lead_id:
+            return ""
+
+        res = (supabase.table("conversation_summaries")
+               .select("summary")
+               .eq("lead_id", lead_id)
+               .eq("tenant_id", tenant_id)
+               .gte("updated_at", _summary_cutoff(max_age_hours))
+               .limit(1)
+               .execute())
+
         if not res.data:
-            return "No hay historial previo de conversación."
-            
-        messages_str = "Historial reciente de esta conversación (últimas horas):\n"
-        for msg in reversed(res.data):
-            display_role = "AGENTE" if msg['role'] == "assistant" else "USUARIO"
-            messages_str += f"[{display_role}]: {msg['content']}\n"
-        
-        return messages_str
+            return ""
+        return res.data[0].get("summary") or ""
+    except Exception as e:
+        log.error(f"get_conversation_summary error: {type(e).__name__}")
+        return ""
+
+
+# Errores de PostgREST/Postgres por tabla ausente o sin la restricción UNIQUE (lead_id) del upsert
+_SUMMARY_SCHEMA_ERRORS = {"42P01", "42P10", "PGRST205"}
+
+
+def save_conversation_summary(session_phone: str, summary: str) -> None:
+    """Guarda (upsert por lead_id) el resumen de la conversación; DDL de la tabla en conversation_summary."""
+    try:
+        tenant_id = _get_tenant_id()
+        lead_id = _get_or_create_lead_id(session_phone, tenant_id)
+
+        if not tenant_id or not lead_id:
+            log.warning("Aborted summary save: missing tenant/lead")
+            return
+
+        data = {
+            "lead_id": lead_id,
+            "tenant_id": tenant_id,
+            "summary": summary,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }
+        supabase.table("conversation_summaries").upsert(data, on_conflict="lead_id").execute()
+        log.info(f"Conversation summary saved for {_mask_phone(session_phone)}")
+    except Exception as e:
+        if getattr(e, "code", None) in _SUMMARY_SCHEMA_ERRORS:
+            log.error("save_conversation_summary error: table conversation_summaries or its UNIQUE (lead_id) "
+                      "constraint is missing (see conversation_summary.py)")
+            return
+        log.error(f"save_conversation_summary error: {type(e).__name__}")
+
+
+# ==========================================
+# VERSIONES ASÍNCRONAS (turno de WhatsApp en el event loop)
+# ==========================================
+# Mismas consultas con el cliente asíncrono de Supabase; comparten las cachés de ids con las síncronas.
+# Un cliente por event loop: sus conexiones pertenecen al loop que las abrió. El "buscar o crear" va bajo
+# un lock por id, no global: en el loop conviven los turnos de todos los teléfonos y no deben esperarse.
+
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncClient]" = weakref.WeakKeyDictionary()
+_async_ids_locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Any, asyncio.Lock]]" = (
+    weakref.WeakKeyDictionary())
+
+
+async def get_async_supabase() -> AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients.setdefault(loop, await acreate_client(SUPABASE_URL, SUPABASE_KEY))
+    return client
+
+
+def _async_ids_lock(key: Any) -> asyncio.Lock:
+    return _async_ids_locks.setdefault(asyncio.get_running_loop(), {}).setdefault(key, asyncio.Lock())
+
+
+def _cache_async_id(cache: Dict, key: Any, value: str) -> str:
+    """Guarda el id y suelta su lock: los turnos siguientes lo leen de la caché sin pasar por él."""
+    cache[key] = value
+    _async_ids_locks.get(asyncio.get_running_loop(), {}).pop(key, None)
+    return value
+
+
+async def _aget_tenant_id() -> Optional[str]:
+    if TENANT_NAME in _tenant_id_cache:
+        return _tenant_id_cache[TENANT_NAME]
+    try:
+        client = await get_async_supabase()
+        async with _async_ids_lock(TENANT_NAME):
+            if TENANT_NAME in _tenant_id_cache:
+                return _tenant_id_cache[TENANT_NAME]
+            res = await client.table("organizations").select("id").eq("name", TENANT_NAME).limit(1).execute()
+            if res.data:
+                tenant_id = res.data[0]["id"]
+            else:
+                insert_res = await client.table("organizations").insert({"name": TENANT_NAME}).execute()
+                log.info(f"Tenant '{TENANT_NAME}' created")
+                tenant_id = insert_res.data[0]["id"]
+            return _cache_async_id(_tenant_id_cache, TENANT_NAME, tenant_id)
+    except Exception as e:
+        log.error(f"tenant_id error: {type(e).__name__}")
+        return None
+
+
+async def _aget_or_create_lead_id(phone: str, tenant_id: Optional[str]) -> Optional[str]:
+    if not tenant_id:
+        return None
+    key = (tenant_id, phone)
+    if key in _lead_id_cache:
+        return _lead_id_cache[key]
+    try:
+        client = await get_async_supabase()
+        async with _async_ids_lock(key):
+            if key in _lead_id_cache:
+                return _lead_id_cache[key]
+            res = await (client.table("leads").select("id").eq("phone", phone).eq("tenant_id", tenant_id)
+                         .limit(1).execute())
+            if res.data:
+                lead_id = res.data[0]["id"]
+            else:
+                new_lead = {"name": "Cliente de WhatsApp", "phone": phone, "tenant_id": tenant_id}
+                insert_res = await client.table("leads").insert(new_lead).execute()
+                log.info(f"Lead created for {_mask_phone(phone)}")
+                lead_id = insert_res.data[0]["id"]
+            return _cache_async_id(_lead_id_cache, key, lead_id)
+    except Exception as e:
+        log.error(f"lead_id error: {type(e).__name__}")
+        return None
+
+
+async def asave_message(session_phone: str, role: str, content: str) -> None:
+    """save_message desde una corrutina."""
+    try:
+        db_role = _db_role(role)
+        tenant_id = await _aget_tenant_id()
+        lead_id = await _aget_or_create_lead_id(session_phone, tenant_id)
+        if not tenant_id or not lead_id:
+            log.warning("Aborted save: missing tenant/lead")
+            return
+        data = {"lead_id": lead_id, "tenant_id": tenant_id, "role": db_role, "content": content}
+        client = await get_async_supabase()
+        await client.table("messages").insert(data).execute()
+        log.info(f"Message '{db_role}' saved for {_mask_phone(session_phone)}")
+    except Exception as e:
+        log.error(f"save_message error: {type(e).__name__}")
+
+
+async def aget_recent_messages(session_phone: str, limit: int = 5,
+                               pending_user_message: Optional[str] = None) -> str:
+    """get_recent_messages desde una corrutina."""
+    try:
+        tenant_id = await _aget_tenant_id()
+        lead_id = await _aget_or_create_lead_id(session_phone, tenant_id)
+        if not tenant_id or not lead_id:
+            return NO_HISTORY
+        client = await get_async_supabase()
+        res = await (client.table("messages")
+                     .select("role, content")
+                     .eq("lead_id", lead_id)
+                     .eq("tenant_id", tenant_id)
+                     .gte("created_at", _recent_cutoff())
+                     .order("created_at", desc=True)
+                     .limit(limit)
+                     .execute())
+        return _format_recent_messages(res.data or [], limit, pending_user_message)
     except Exception as e:
         log.error(f"get_recent_messages error: {type(e).__name__}")
-        return "No se pudo recuperar el historial."
+        return HISTORY_UNAVAILABLE
+
+
+async def aget_conversation_summary(session_phone: str, max_age_hours: int = 24) -> str:
+    """get_conversation_summary desde una corrutina."""
+    try:
+        tenant_id = await _aget_tenant_id()
+        lead_id = await _aget_or_create_lead_id(session_phone, tenant_id)
+        if not tenant_id or not lead_id:
+            return ""
+        client = await get_async_supabase()
+        res = await (client.table("conversation_summaries")
+                     .select("summary")
+                     .eq("lead_id", lead_id)
+                     .eq("tenant_id", tenant_id)
+                     .gte("updated_at", _summary_cutoff(max_age_hours))
+                     .limit(1)
+                     .execute())
+        if not res.data:
+            return ""
+        return res.data[0].get("summary") or ""
+    except Exception as e:
+        log.error(f"get_conversation_summary error: {type(e).__name__}")
+        return ""
 
 
 class SupabaseMemoryTool(BaseTool):
@@ -0,0 +1,106 @@
+"""
+Diario de un turno reintentable (queue_worker).
+Un reintento del lote repite el turno entero. Con el diario no se vuelve a guardar el mensaje del
+usuario ni a ejecutar una herramienta de escritura que ya tuvo éxito en un intento anterior (crear
+el mismo pedido o la misma reunión dos veces): se devuelve el resultado registrado.
+Cada efecto se persiste en el propio trabajo (job_queue.save_progress) en cuanto ocurre, así que el
+diario sobrevive al fallo del intento y a que el reintento lo reserve otro worker.
+Vive en un contextvar (mismo patrón que tool_memo): fuera de queue_worker no hay diario y todo se ejecuta.
+"""
+import functools
+import inspect
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, Optional
+from tool_memo import normalize_arg
+from logger import get_logger
+
+log = get_logger("turn_journal")
+
+# Resultados de herramientas que indican que no se hizo nada (convención de las herramientas): no se registran
+FAILURE_PREFIXES = ("Error", "⚠️", "No se pudo")
+
+USER_MESSAGE_KEY = "user_message"
+
+_current: ContextVar[Optional["TurnJournal"]] = ContextVar("turn_journal", default=None)
+
+
+class TurnJournal:
+    """Efectos ya hechos en el turno (clave → resultado); 'persist' recibe el diario completo tras cada cambio."""
+
+    def __init__(self, entries: Optional[Dict[str, str]] = None,
+                 persist: Optional[Callable[[Dict[str, str]], object]] = None) -> None:
+        self._entries: Dict[str, str] = dict(entries or {})
+        self._persist = persist
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._entries.get(key)
+
+    def record(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = value
+            snapshot = dict(self._entries)
+        if self._persist is None:
+            return
+        try:
+            self._persist(snapshot)
+        except Exception as e:
+            # El efecto ya ocurrió: fallar aquí haría que el reintento lo repitiera igualmente
+            log.error(f"Turn journal could not be saved ({type(e).__name__}); a retry may repeat '{key}'")
+
+    def unsaved_user_text(self, text: str) -> Optional[str]:
+        """
+        Parte de 'text' (mensajes unidos por líneas, ver merge_messages) aún sin guardar: None si ya
+        se guardó entero; solo los mensajes nuevos si el reintento trae más que el intento anterior.
+        """
+        saved = self.get(USER_MESSAGE_KEY)
+        if saved is None:
+            return text
+        if text == saved:
+            return None
+        if text.startswith(saved + "\n"):
+            return text[len(saved) + 1:]
+        return text
+
+
+def current_journal() -> Optional[TurnJournal]:
+    return _current.get()
+
+
+@contextmanager
+def use_turn_journal(journal: Optional[TurnJournal]) -> Iterator[Optional[TurnJournal]]:
+    token = _current.set(journal)
+    try:
+        yield journal
+    finally:
+        _current.reset(token)
+
+
+def journaled(run):
+    """
+    Decorador para _run de herramientas de escritura: con diario, una llamada con los mismos argumentos
+    normalizados que ya tuvo éxito en un intento anterior devuelve su resultado sin repetirse.
+    """
+    signature = inspect.signature(run)
+
+    @functools.wraps(run)
+    def wrapper(self, *args, **kwargs):
+        journal = _current.get()
+        if journal is None:
+            return run(self, *args, **kwargs)
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        key = repr((self.name, tuple((name, normalize_arg(value)) for name, value in bound.arguments.items()
+                                     if name != "self")))
+        done = journal.get(key)
+        if done is not None:
+            log.info(f"Turn journal: {self.name} already done in a previous attempt; not repeating it")
+            return done
+        result = run(self, *args, **kwargs)
+        if isinstance(result, str) and not result.startswith(FAILURE_PREFIXES):
+            journal.record(key, result)
+        return result
+    return wrapper
@@ -0,0 +1,236 @@
+"""
+Registro estructurado por turno: duración de cada paso, cada llamada LLM (tokens y latencia),
+cada herramienta (latencia y resultado) y el coste estimado.
+El registro vive en un contextvar: el LLM (openai_llm) y los handlers del bus de eventos de CrewAI
+(que corren con una copia del contexto del hilo que emite) añaden datos sin pasar referencias.
+Al cerrar el turno se emite una línea JSON y se alimentan los percentiles de metrics.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+from crewai.events import (
+    crewai_event_bus, ToolUsageStartedEvent, ToolUsageFinishedEvent, ToolUsageErrorEvent
+)
+from crewai.utilities.string_utils import sanitize_tool_name
+from config import TURN_METRICS_FLUSH_SECONDS
+from metrics import turn_latency, turn_usage
+from logger import get_logger
+
+log = get_logger("turn_metrics")
+
+# USD por millón de tokens: (prompt, prompt cacheado, completion)
+MODEL_PRICES: Dict[str, Tuple[float, float, float]] = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+}
+
+
+def model_prices(model: str) -> Optional[Tuple[float, float, float]]:
+    """Precios del modelo; las versiones con fecha (gpt-4o-mini-2024-07-18) usan los de su familia."""
+    model = (model or "").lower()
+    for name in sorted(MODEL_PRICES, key=len, reverse=True):
+        if model == name or model.startswith(name + "-"):
+            return MODEL_PRICES[name]
+    return None
+
+
+def llm_cost(model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> Optional[float]:
+    """Coste en USD de una llamada (None si el modelo no tiene precio conocido)."""
+    prices = model_prices(model)
+    if prices is None:
+        return None
+    prompt_price, cached_price, completion_price = prices
+    return ((prompt_tokens - cached_tokens) * prompt_price + cached_tokens * cached_price
+            + completion_tokens * completion_price) / 1_000_000
+
+
+class TurnRecord:
+    """Datos de un turno; los handlers del bus escriben desde otros hilos, de ahí el lock."""
+
+    def __init__(self, session_id: str) -> None:
+        self.session = f"{session_id[:8]}***"
+        self.started = time.perf_counter()
+        self.intent: Optional[str] = None
+        self.path: Optional[str] = None
+        self.steps: Dict[str, float] = {}
+        self.llm_calls: List[Dict] = []
+        self.tool_calls: List[Dict] = []
+        self._tool_starts: Dict[str, List[datetime]] = {}
+        self._lock = threading.Lock()
+
+    def step(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.steps[name] = seconds
+
+    @contextmanager
+    def timed(self, name: str) -> Iterator[None]:
+        step_started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.step(name, time.perf_counter() - step_started)
+
+    def llm_call(self, model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int,
+                 seconds: float, agent: Optional[str] = None) -> None:
+        call = {
+            "model": model,
+            "agent": agent,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cached_prompt_tokens": cached_tokens,
+            "latency_s": seconds,
+            "cost_usd": llm_cost(model, prompt_tokens, cached_tokens, completion_tokens),
+        }
+        with self._lock:
+            self.llm_calls.append(call)
+
+    def tool_started(self, tool: str, at: datetime) -> None:
+        with self._lock:
+            self._tool_starts.setdefault(tool, []).append(at)
+
+    def _pop_start(self, tool: str) -> Optional[datetime]:
+        starts = self._tool_starts.get(tool)
+        return starts.pop(0) if starts else None
+
+    def tool_finished(self, tool: str, seconds: float, outcome: str) -> None:
+        with self._lock:
+            self._pop_start(tool)
+            self.tool_calls.append({"tool": tool, "latency_s": seconds, "outcome": outcome})
+
+    def tool_failed(self, tool: str, at: datetime) -> None:
+        with self._lock:
+            start = self._pop_start(tool)
+            seconds = (at - start).total_seconds() if start else None
+            self.tool_calls.append({"tool": tool, "latency_s": seconds, "outcome": "error"})
+
+    def to_dict(self) -> Dict:
+        """Registro serializable (tiempos en ms, coste en USD)."""
+        def ms(seconds: Optional[float]) -> Optional[float]:
+            return round(seconds * 1000, 1) if seconds is not None else None
+
+        with self._lock:
+            llm_calls = [dict(call) for call in self.llm_calls]
+            tool_calls = [dict(call) for call in self.tool_calls]
+            steps = dict(self.steps)
+        costs = [call["cost_usd"] for call in llm_calls if call["cost_usd"] is not None]
+        record = {
+            "session": self.session,
+            "intent": self.intent,
+            "path": self.path,
+            "total_ms": ms(time.perf_counter() - self.started),
+            "steps_ms": {name: ms(seconds) for name, seconds in steps.items()},
+            "llm_ms": ms(sum(call["latency_s"] for call in llm_calls)),
+            "tool_ms": ms(sum(call["latency_s"] or 0 for call in tool_calls)),
+            "prompt_tokens": sum(call["prompt_tokens"] for call in llm_calls),
+            "completion_tokens": sum(call["completion_tokens"] for call in llm_calls),
+            "cached_prompt_tokens": sum(call["cached_prompt_tokens"] for call in llm_calls),
+            "cost_usd": round(sum(costs), 6),
+            "unpriced_llm_calls": len(llm_calls) - len(costs),
+            "llm_calls": [],
+            "tool_calls": [],
+        }
+        for call in llm_calls:
+            call["latency_ms"] = ms(call.pop("latency_s"))
+            record["llm_calls"].append(call)
+        for call in tool_calls:
+            call["latency_ms"] = ms(call.pop("latency_s"))
+            record["tool_calls"].append(call)
+        return record
+
+    def close(self) -> Dict:
+        """Emite el registro del turno y lo agrega a los percentiles de metrics."""
+        if self.llm_calls:
+            # Los eventos de herramientas se procesan en el pool del bus: esperar a que terminen
+            crewai_event_bus.flush(timeout=TURN_METRICS_FLUSH_SECONDS)
+        path = self.path or "error"
+        self.path = path
+        record = self.to_dict()
+
+        turn_latency.record(f"turn:{path}", record["total_ms"] / 1000)
+        for name, step_ms in record["steps_ms"].items():
+            turn_latency.record(f"step:{name}", step_ms / 1000)
+        for call in record["llm_calls"]:
+            turn_latency.record(f"llm:{call['model']}", call["latency_ms"] / 1000)
+        for call in record["tool_calls"]:
+            if call["latency_ms"] is not None:
+                turn_latency.record(f"tool:{call['tool']}:{call['outcome']}", call["latency_ms"] / 1000)
+        if record["llm_calls"]:
+            turn_latency.record(f"turn_llm:{path}", record["llm_ms"] / 1000)
+            turn_latency.record(f"turn_tools:{path}", record["tool_ms"] / 1000)
+        for key in ("prompt_tokens", "completion_tokens", "cached_prompt_tokens", "cost_usd"):
+            turn_usage.record(f"{key}:{path}", record[key])
+        turn_usage.record(f"llm_calls:{path}", len(record["llm_calls"]))
+        turn_usage.record(f"tool_calls:{path}", len(record["tool_calls"]))
+
+        log.info(f"Turn record path={path} total={record['total_ms']:.0f} ms llm={record['llm_ms']:.0f} ms "
+                 f"tools={record['tool_ms']:.0f} ms cost=${record['cost_usd']:.5f}", extra={"data": record})
+        return record
+
+
+_current: ContextVar[Optional[TurnRecord]] = ContextVar("turn_record", default=None)
+_handlers_lock = threading.Lock()
+_handlers_registered = False
+
+
+def current_turn() -> Optional[TurnRecord]:
+    return _current.get()
+
+
+def record_step(name: str, seconds: float) -> None:
+    turn = _current.get()
+    if turn is not None:
+        turn.step(name, seconds)
+
+
+def record_llm_call(model: str, usage: Dict[str, int], seconds: float, agent: Optional[str] = None) -> None:
+    """Llamada LLM del turno en curso; 'usage' es el delta de los contadores del LLM."""
+    turn = _current.get()
+    if turn is not None:
+        turn.llm_call(model, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0),
+                      usage.get("cached_prompt_tokens", 0), seconds, agent)
+
+
+def _on_tool_event(source, event) -> None:
+    turn = _current.get()
+    if turn is None:
+        return
+    tool = sanitize_tool_name(event.tool_name)
+    if isinstance(event, ToolUsageStartedEvent):
+        turn.tool_started(tool, event.timestamp)
+    elif isinstance(event, ToolUsageFinishedEvent):
+        seconds = (event.finished_at - event.started_at).total_seconds()
+        turn.tool_finished(tool, seconds, "cached" if event.from_cache else "ok")
+    else:
+        turn.tool_failed(tool, event.timestamp)
+
+
+def _ensure_handlers() -> None:
+    global _handlers_registered
+    with _handlers_lock:
+        if _handlers_registered:
+            return
+        for event_type in (ToolUsageStartedEvent, ToolUsageFinishedEvent, ToolUsageErrorEvent):
+            crewai_event_bus.register_handler(event_type, _on_tool_event)
+        _handlers_registered = True
+
+
+@contextmanager
+def track_turn(session_id: str) -> Iterator[TurnRecord]:
+    """Registro del turno visible en el hilo (y sus eventos) durante el bloque; se emite al salir."""
+    _ensure_handlers()
+    turn = TurnRecord(session_id)
+    token = _current.set(turn)
+    try:
+        yield turn
+    finally:
+        _current.reset(token)
+        try:
+            turn.close()
+        except Exception as e:
+            log.warning(f"Turn record failed (non-fatal): {type(e).__name__}: {e}")
@@ -0,0 +1,363 @@
+"""
+Índice vectorial local de la base de conocimientos (réplica de la RPC match_kb_items).
+Sincroniza kb_items en una matriz NumPy float32 mapeada en memoria, con normas precalculadas,
+y resuelve la similitud coseno top-k de forma vectorizada sin viajar a Supabase.
+
+Formato en disco (KB_INDEX_DIR):
+- meta.json: generación, dimensiones, filas (id, content, agent_id, updated_at) y marca de sincronización.
+- vectors-<gen>.f32 / norms-<gen>.f32: matriz N x D y normas N, en float32.
+Cada sincronización escribe una generación nueva y sustituye meta.json de forma atómica, así
+varios workers del mismo host comparten los ficheros mapeados (zero-copy) y solo remapean al cambiar.
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional
+import numpy as np
+from logger import get_logger
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin lock entre procesos, solo entre hilos
+    fcntl = None
+
+log = get_logger("vector_index")
+
+META_FILE = "meta.json"
+LOCK_FILE = ".lock"
+PAGE_SIZE = 1000
+
+# Las filas se piden desde synced_at menos este margen: una fila que se confirma tarde con un
+# updated_at anterior a la marca (lotes de ingesta concurrentes, marcas iguales) no se pierde
+SYNC_OVERLAP_SECONDS = 120
+
+# Tras un fallo de sincronización se reintenta a los 5 s, 10 s, 20 s... hasta refresh_seconds
+RETRY_BASE_SECONDS = 5
+
+
+def _overlap_since(synced_at: Optional[str], overlap_seconds: int) -> Optional[str]:
+    """Marca desde la que pedir cambios: synced_at menos el margen de solape."""
+    if not synced_at:
+        return None
+    try:
+        stamp = datetime.fromisoformat(synced_at.replace("Z", "+00:00"))
+    except ValueError:
+        return synced_at
+    return (stamp - timedelta(seconds=overlap_seconds)).isoformat()
+
+
+def _parse_embedding(value: Any) -> List[float]:
+    """pgvector llega por PostgREST como texto '[0.1,0.2,...]'."""
+    if isinstance(value, str):
+        return json.loads(value)
+    return list(value)
+
+
+class SupabaseKBSource:
+    """Lee kb_items de Supabase paginando (PostgREST limita a 1000 filas por respuesta)."""
+
+    def __init__(self, table: str = "kb_items") -> None:
+        self.table = table
+
+    def _paged(self, columns: str, since: Optional[str] = None) -> Iterable[Dict]:
+        from tools_supabase import supabase
+
+        start = 0
+        while True:
+            query = supabase.table(self.table).select(columns)
+            if since:
+                query = query.gte("updated_at", since)
+            res = query.order("id").range(start, start + PAGE_SIZE - 1).execute()
+            rows = res.data or []
+            yield from rows
+            if len(rows) < PAGE_SIZE:
+                return
+            start += PAGE_SIZE
+
+    def fetch_changed(self, since: Optional[str]) -> List[Dict]:
+        """Filas creadas o modificadas desde 'since', incluida (todas si es None)."""
+        return list(self._paged("id, content, embedding, agent_id, updated_at", since))
+
+    def fetch_ids(self) -> List[Any]:
+        """Todos los ids actuales, para detectar borrados."""
+        return [row["id"] for row in self._paged("id")]
+
+
+class LocalVectorIndex:
+    """Matriz de embeddings mapeada en memoria con búsqueda coseno equivalente a match_kb_items."""
+
+    def __init__(self, directory: str, refresh_seconds: int = 300,
+                 overlap_seconds: int = SYNC_OVERLAP_SECONDS) -> None:
+        self.directory = directory
+        self.refresh_seconds = refresh_seconds
+        self.overlap_seconds = overlap_seconds
+        self._lock = threading.Lock()
+        self._meta_stamp: Optional[tuple] = None
+        self._meta: Dict[str, Any] = {}
+        # (vectors, norms, rows) se sustituye de golpe para que las búsquedas concurrentes
+        # nunca mezclen filas de una generación con vectores de otra
+        self._snapshot: tuple = (None, None, [])
+        self._next_check = 0.0
+        self._failures = 0
+        self._refreshing = False
+        self._refresh_guard = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    # ------------------------------------------
+    # Lectura (compartida entre procesos)
+    # ------------------------------------------
+
+    @property
+    def generation(self) -> int:
+        self._ensure_loaded()
+        return int(self._meta.get("generation", 0))
+
+    @property
+    def ready(self) -> bool:
+        """True si alguna sincronización ha completado (aunque la KB esté vacía)."""
+        self._ensure_loaded()
+        return bool(self._meta)
+
+    def __len__(self) -> int:
+        self._ensure_loaded()
+        return len(self._snapshot[2])
+
+    def documents(self) -> List[Dict]:
+        """Filas actuales (id, content, agent_id, updated_at), sin vectores."""
+        self._ensure_loaded()
+        return list(self._snapshot[2])
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _ensure_loaded(self) -> None:
+        """Remapea los ficheros si otro proceso publicó una generación nueva."""
+        try:
+            st = os.stat(self._path(META_FILE))
+        except FileNotFoundError:
+            return
+        # os.replace crea un inodo nuevo en cada publicación: no dependemos de la resolución de mtime
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if stamp == self._meta_stamp:
+            return
+        with self._lock:
+            if stamp == self._meta_stamp:
+                return
+            try:
+                with open(self._path(META_FILE), encoding="utf-8") as f:
+                    meta = json.load(f)
+                if meta.get("generation") != self._meta.get("generation"):
+                    count, dims = len(meta["rows"]), meta["dims"]
+                    if count and dims:
+                        gen = meta["generation"]
+                        vectors = np.memmap(self._path(f"vectors-{gen}.f32"), dtype=np.float32,
+                                            mode="r", shape=(count, dims))
+                        norms = np.memmap(self._path(f"norms-{gen}.f32"), dtype=np.float32,
+                                          mode="r", shape=(count,))
+                        self._snapshot = (vectors, norms, meta["rows"])
+                    else:
+                        self._snapshot = (None, None, meta["rows"])
+            except FileNotFoundError:
+                # Otro worker publicó una generación más nueva y borró esta entre el stat y el mapeo:
+                # se sigue con la ya mapeada y se reintenta en la próxima lectura
+                log.debug("KB index generation replaced while loading, keeping current snapshot")
+                return
+            self._meta = meta
+            self._meta_stamp = stamp
+
+    def search(
+        self, query_embedding: List[float], match_threshold: float = 0.5,
+        match_count: int = 5, agent_id: Optional[str] = None
+    ) -> List[Dict]:
+        """
+        Top-k por similitud coseno con la semántica de match_kb_items:
+        similarity = 1 - distancia coseno, se filtra similarity > match_threshold,
+        y si agent_id viene informado solo entran filas de ese agente o sin agente.
+        """
+        self._ensure_loaded()
+        vectors, norms, rows = self._snapshot
+        if vectors is None or match_count <= 0:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query_norm = float(np.linalg.norm(query))
+        if query_norm == 0.0 or query.shape[0] != vectors.shape[1]:
+            return []
+
+        denom = norms * query_norm
+        sims = np.divide(vectors @ query, denom, out=np.zeros_like(norms), where=denom > 0)
+
+        mask = sims > match_threshold
+        if agent_id is not None:
+            mask &= np.fromiter((r.get("agent_id") in (None, agent_id) for r in rows),
+                                dtype=bool, count=len(rows))
+        candidates = np.flatnonzero(mask)
+        if candidates.size > match_count:
+            top = np.argpartition(-sims[candidates], match_count - 1)[:match_count]
+            candidates = candidates[top]
+        ordered = candidates[np.argsort(-sims[candidates], kind="stable")]
+
+        return [
+            {"id": rows[i]["id"], "content": rows[i]["content"], "similarity": float(sims[i])}
+            for i in ordered
+        ]
+
+    # ------------------------------------------
+    # Sincronización incremental
+    # ------------------------------------------
+
+    def maybe_refresh(self, source: Any) -> bool:
+        """
+        Lanza la sincronización en un hilo aparte si toca (refresh_seconds, o el backoff tras un fallo).
+        Devuelve True si la ha lanzado; mientras tanto las búsquedas usan la generación publicada.
+        """
+        with self._refresh_guard:
+            if self._refreshing or time.time() < self._next_check:
+                return False
+            self._refreshing = True
+        threading.Thread(target=self._refresh, args=(source,), name="kb-index-sync", daemon=True).start()
+        return True
+
+    def _refresh(self, source: Any) -> None:
+        try:
+            self.sync(source)
+            self._failures = 0
+        except Exception as e:
+            # Sin esto, durante una caída de Supabase cada consulta volvería a intentar la sincronización
+            self._failures += 1
+            backoff = min(self.refresh_seconds, RETRY_BASE_SECONDS * 2 ** (self._failures - 1))
+            self._next_check = time.time() + backoff
+            log.warning(f"KB index refresh failed ({self._failures} in a row), retrying in {backoff}s: "
+                        f"{type(e).__name__}: {e}")
+        finally:
+            with self._refresh_guard:
+                self._refreshing = False
+
+    def sync(self, source: Any, force: bool = False) -> bool:
+        """
+        Trae de 'source' solo las filas cambiadas y los ids actuales, y publica una generación
+        nueva si algo cambió. Devuelve True si se publicó. Un lock de fichero evita que varios
+        workers sincronicen a la vez; el que llega tarde reutiliza lo que publicó el primero.
+        """
+        lock_fd = os.open(self._path(LOCK_FILE), os.O_CREAT | os.O_RDWR)
+        try:
+            if fcntl:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            self._ensure_loaded()
+            meta = self._meta
+            if not force and meta and time.time() - meta.get("checked_at", 0) < self.refresh_seconds:
+                self._next_check = time.time() + self.refresh_seconds
+                return False
+
+            since = _overlap_since(meta.get("synced_at"), self.overlap_seconds) if meta else None
+            fetched = source.fetch_changed(since)
+            current_ids = set(source.fetch_ids())
+
+            old_vectors, _, old_rows = self._snapshot if meta else (None, None, [])
+            # Por id: las filas del margen de solape que ya tenemos con la misma marca no cuentan como
+            # cambio, y una fila borrada entre las dos lecturas no debe reaparecer
+            known = {row["id"]: row.get("updated_at") for row in old_rows}
+            latest = {row["id"]: row for row in fetched}
+            changed = [row for row_id, row in latest.items()
+                       if row_id in current_ids and (row_id not in known or known[row_id] != row.get("updated_at"))]
+            changed_ids = {row["id"] for row in changed}
+            kept = [i for i, row in enumerate(old_rows)
+                    if row["id"] in current_ids and row["id"] not in changed_ids]
+            removed = sum(1 for row in old_rows if row["id"] not in current_ids)
+
+            published = False
+            if not meta or changed or removed:
+                self._publish(old_vectors, old_rows, kept, changed, meta)
+                published = True
+                log.info(f"KB index synced: {len(changed)} changed, {removed} removed, "
+                         f"{len(kept) + len(changed)} total rows")
+            else:
+                self._write_meta(dict(meta, checked_at=time.time()))
+            self._next_check = time.time() + self.refresh_seconds
+            return published
+        finally:
+            if fcntl:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            os.close(lock_fd)
+
+    def _publish(
+        self, old_vectors: Optional[np.ndarray], old_rows: List[Dict],
+        kept: List[int], changed: List[Dict], meta: Dict
+    ) -> None:
+        new_vectors = [np.asarray(_parse_embedding(row["embedding"]), dtype=np.float32) for row in changed]
+        dims = int(meta.get("dims") or 0)
+        if new_vectors:
+            dims = int(new_vectors[0].shape[0])
+
+        rows = [old_rows[i] for i in kept] + [
+            {"id": r["id"], "content": r["content"], "agent_id": r.get("agent_id"),
+             "updated_at": r.get("updated_at")}
+            for r in changed
+        ]
+        generation = int(meta.get("generation", 0)) + 1
+
+        if rows and dims:
+            matrix = np.empty((len(rows), dims), dtype=np.float32)
+            if kept:
+                matrix[:len(kept)] = old_vectors[kept]
+            if new_vectors:
+                matrix[len(kept):] = np.vstack(new_vectors)
+            norms = np.linalg.norm(matrix, axis=1).astype(np.float32)
+            self._write_array(f"vectors-{generation}.f32", matrix)
+            self._write_array(f"norms-{generation}.f32", norms)
+
+        stamps = [r["updated_at"] for r in rows if r.get("updated_at")]
+        synced_at = max(stamps) if stamps else meta.get("synced_at")
+        self._write_meta({
+            "generation": generation, "dims": dims, "rows": rows,
+            "synced_at": synced_at, "checked_at": time.time(),
+        })
+        self._remove_stale_generations(generation)
+
+    def _write_array(self, name: str, array: np.ndarray) -> None:
+        tmp = self._path(name + ".tmp")
+        array.tofile(tmp)
+        os.replace(tmp, self._path(name))
+
+    def _write_meta(self, meta: Dict) -> None:
+        tmp = self._path(META_FILE + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp, self._path(META_FILE))
+        self._ensure_loaded()
+
+    def _remove_stale_generations(self, generation: int) -> None:
+        # En Linux los procesos que aún tengan mapeada la generación anterior la siguen leyendo
+        for name in os.listdir(self.directory):
+            if name.endswith(".f32") and not name.endswith(f"-{generation}.f32"):
+                try:
+                    os.remove(self._path(name))
+                except OSError:
+                    pass
+
+
+_kb_index: Optional[LocalVectorIndex] = None
+_kb_index_guard = threading.Lock()
+
+
+def get_kb_index() -> Optional[LocalVectorIndex]:
+    """
+    Índice local listo para buscar, o None si está desactivado, aún no ha sincronizado nunca o no se
+    puede leer. La sincronización corre en segundo plano: nunca dentro del turno del usuario.
+    """
+    global _kb_index
+    from config import KB_LOCAL_SEARCH, KB_INDEX_DIR, KB_INDEX_REFRESH_SECONDS
+
+    if not KB_LOCAL_SEARCH:
+        return None
+    with _kb_index_guard:
+        if _kb_index is None:
+            _kb_index = LocalVectorIndex(KB_INDEX_DIR, KB_INDEX_REFRESH_SECONDS)
+    try:
+        _kb_index.maybe_refresh(SupabaseKBSource())
+        return _kb_index if _kb_index.ready else None
+    except Exception as e:
+        log.warning(f"Local KB index unavailable, using RPC: {type(e).__name__}: {e}")
+        return None
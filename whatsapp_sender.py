@@ -0,0 +1,220 @@
+"""
+Envío de mensajes de WhatsApp por la Graph API con un cliente de larga vida.
+Un único pool HTTP/2 hacia graph.facebook.com (los envíos concurrentes comparten conexión),
+reintentos con backoff para 429/5xx y los códigos de throttling de Meta, y métricas de latencia y errores.
+Se usa igual desde hilos (send) que desde corrutinas (send_async) sin crear event loops nuevos.
+"""
+import asyncio
+import random
+import threading
+import time
+import weakref
+from dataclasses import dataclass, asdict
+from typing import Dict, Optional
+import httpx
+from config import (
+    WHATSAPP_API_TOKEN, WHATSAPP_PHONE_NUMBER_ID,
+    WHATSAPP_API_VERSION, WHATSAPP_SEND_MAX_ATTEMPTS, WHATSAPP_SEND_TIMEOUT
+)
+from metrics import LatencyTracker
+from odoo_client import _mask_phone
+from logger import get_logger
+
+log = get_logger("whatsapp_sender")
+
+# Códigos de error de la Graph API que indican throttling o fallo transitorio (llegan con HTTP 400/429/5xx)
+RETRYABLE_ERROR_CODES = {4, 80007, 130429, 131000, 131016, 131056}
+
+# Espera máxima entre reintentos (también acota un Retry-After excesivo)
+MAX_BACKOFF_SECONDS = 30.0
+
+
+@dataclass
+class DeliveryResult:
+    """Resultado de un envío: id del mensaje en WhatsApp si se aceptó, o el último error."""
+    ok: bool
+    status_code: Optional[int] = None
+    message_id: Optional[str] = None
+    error_code: Optional[int] = None
+    error: Optional[str] = None
+    attempts: int = 0
+    latency: float = 0.0
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+def _body(response: httpx.Response) -> Dict:
+    try:
+        body = response.json()
+    except ValueError:
+        return {}
+    return body if isinstance(body, dict) else {}
+
+
+def _error_code(response: httpx.Response) -> Optional[int]:
+    return (_body(response).get("error") or {}).get("code")
+
+
+def _retryable(response: httpx.Response, error_code: Optional[int]) -> bool:
+    return response.status_code == 429 or response.status_code >= 500 or error_code in RETRYABLE_ERROR_CODES
+
+
+def _backoff(attempt: int, response: Optional[httpx.Response]) -> float:
+    """Retry-After si Meta lo envía; si no, exponencial con jitter (0.5 s, 1 s, 2 s... ± 25 %)."""
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), MAX_BACKOFF_SECONDS)
+        except ValueError:
+            pass
+    return min(0.5 * 2 ** (attempt - 1), MAX_BACKOFF_SECONDS) * random.uniform(0.75, 1.25)
+
+
+class WhatsAppSender:
+    """Cliente de envío con pool compartido. Seguro entre hilos; los clientes HTTP se crean al primer uso."""
+
+    def __init__(self, token: str = WHATSAPP_API_TOKEN, phone_number_id: str = WHATSAPP_PHONE_NUMBER_ID,
+                 api_version: str = WHATSAPP_API_VERSION, max_attempts: int = WHATSAPP_SEND_MAX_ATTEMPTS,
+                 timeout: float = WHATSAPP_SEND_TIMEOUT, transport: Optional[httpx.BaseTransport] = None) -> None:
+        self.token = token
+        self.phone_number_id = phone_number_id
+        self.url = f"https://graph.facebook.com/{api_version}/{phone_number_id}/messages"
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self._transport = transport
+        self._client: Optional[httpx.Client] = None
+        # Un AsyncClient por event loop (sus conexiones pertenecen al loop que las abrió)
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = \
+            weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.latency = LatencyTracker()
+        self._stats: Dict[str, int] = {"sent": 0, "failed": 0, "retries": 0}
+        self._errors: Dict[str, int] = {}
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.token and self.phone_number_id)
+
+    def _client_options(self) -> Dict:
+        return {
+            "http2": True,
+            "timeout": self.timeout,
+            "limits": httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=120),
+            "headers": {"Authorization": f"Bearer {self.token}"},
+        }
+
+    def _sync_client(self) -> httpx.Client:
+        with self._lock:
+            if self._client is None:
+                self._client = httpx.Client(transport=self._transport, **self._client_options())
+            return self._client
+
+    def _async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = httpx.AsyncClient(transport=self._transport, **self._client_options())
+                self._async_clients[loop] = client
+            return client
+
+    @staticmethod
+    def payload(phone_number: str, text: str) -> Dict:
+        return {
+            "messaging_product": "whatsapp",
+            "recipient_type": "individual",
+            "to": phone_number.replace("+", ""),
+            "type": "text",
+            "text": {"body": text},
+        }
+
+    # --- Resultado de cada intento ---
+
+    def _outcome(self, response: Optional[httpx.Response], exc: Optional[Exception], attempt: int):
+        """(resultado final o None si hay que reintentar, respuesta para calcular el backoff)."""
+        if exc is not None:
+            result = DeliveryResult(ok=False, error=type(exc).__name__, attempts=attempt)
+            return (None if attempt < self.max_attempts else result), None
+        if response.status_code in (200, 201):
+            messages = _body(response).get("messages") or [{}]
+            return DeliveryResult(ok=True, status_code=response.status_code,
+                                  message_id=messages[0].get("id"), attempts=attempt), None
+        error_code = _error_code(response)
+        result = DeliveryResult(ok=False, status_code=response.status_code, error_code=error_code,
+                                error=f"HTTP {response.status_code}", attempts=attempt)
+        if _retryable(response, error_code) and attempt < self.max_attempts:
+            return None, response
+        return result, None
+
+    def _record(self, phone_number: str, result: DeliveryResult, started: float) -> DeliveryResult:
+        result.latency = time.perf_counter() - started
+        self.latency.record("send", result.latency)
+        with self._lock:
+            self._stats["sent" if result.ok else "failed"] += 1
+            self._stats["retries"] += result.attempts - 1
+            if not result.ok:
+                key = str(result.error_code or result.error)
+                self._errors[key] = self._errors.get(key, 0) + 1
+        if result.ok:
+            log.info(f"WhatsApp message sent to {_mask_phone(phone_number)} (attempts={result.attempts})")
+        else:
+            log.error(f"WhatsApp send failed to {_mask_phone(phone_number)}: {result.error} "
+                      f"code={result.error_code} attempts={result.attempts}")
+        return result
+
+    def _missing_credentials(self) -> DeliveryResult:
+        log.warning("WhatsApp credentials missing")
+        return DeliveryResult(ok=False, error="credentials missing")
+
+    # --- Envío ---
+
+    def send(self, phone_number: str, text: str) -> DeliveryResult:
+        """Envío bloqueante (hilos del ejecutor y workers de la cola)."""
+        if not self.configured:
+            return self._missing_credentials()
+        client = self._sync_client()
+        started = time.perf_counter()
+        for attempt in range(1, self.max_attempts + 1):
+            response, exc = None, None
+            try:
+                response = client.post(self.url, json=self.payload(phone_number, text))
+            except httpx.TransportError as e:
+                exc = e
+            result, retry_response = self._outcome(response, exc, attempt)
+            if result is not None:
+                return self._record(phone_number, result, started)
+            time.sleep(_backoff(attempt, retry_response))
+
+    async def send_async(self, phone_number: str, text: str) -> DeliveryResult:
+        """Envío desde una corrutina, en el event loop que ya está corriendo."""
+        if not self.configured:
+            return self._missing_credentials()
+        client = self._async_client()
+        started = time.perf_counter()
+        for attempt in range(1, self.max_attempts + 1):
+            response, exc = None, None
+            try:
+                response = await client.post(self.url, json=self.payload(phone_number, text))
+            except httpx.TransportError as e:
+                exc = e
+            result, retry_response = self._outcome(response, exc, attempt)
+            if result is not None:
+                return self._record(phone_number, result, started)
+            await asyncio.sleep(_backoff(attempt, retry_response))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats: Dict = dict(self._stats)
+            stats["errors"] = dict(self._errors)
+        stats["latency"] = self.latency.snapshot()
+        return stats
+
+    def close(self) -> None:
+        with self._lock:
+            client, self._client = self._client, None
+        if client is not None:
+            client.close()
+
+
+whatsapp_sender = WhatsAppSender()
@@ -0,0 +1,74 @@
+"""
+Turno de WhatsApp (crew + respuesta por el planificador de salida), común a la API y a queue_worker.py.
+Importarlo no construye la app FastAPI ni el estado del servidor web (buzón, ejecutor, rate limiter),
+y el crew se importa de forma diferida: crew_logic arrastra CrewAI, OpenAI y Supabase y al importarse
+crea clientes y agentes (varios segundos).
+En la API el turno es una corrutina (process_whatsapp_message): contexto, guardados y envío en el
+event loop; queue_worker usa las variantes síncronas desde sus hilos.
+"""
+import asyncio
+from concurrent.futures import Future
+from typing import Awaitable, Callable, List
+from crew_executor import BUSY_MESSAGE, ExecutorSaturated
+from outbound_scheduler import outbound_scheduler, INTERACTIVE
+from whatsapp_sender import DeliveryResult
+from odoo_client import _mask_phone
+from logger import get_logger
+
+log = get_logger("whatsapp_turn")
+
+ERROR_MESSAGE = ("Disculpa, estoy experimentando dificultades técnicas. "
+                 "Por favor, inténtalo de nuevo en unos minutos. 🙏")
+
+
+_crew_module = None
+
+
+def _crew_logic():
+    global _crew_module
+    import crew_logic
+    _crew_module = crew_logic
+    return crew_logic
+
+
+def run_odoo_crew(session_id: str, user_message: str, emit=None, raise_errors: bool = False) -> str:
+    """crew_logic.run_odoo_crew, importando el crew en el primer turno si aún no está cargado."""
+    return _crew_logic().run_odoo_crew(session_id, user_message, emit, raise_errors=raise_errors)
+
+
+def send_whatsapp_parts(phone_number: str, parts: List[str], priority: int = INTERACTIVE) -> Future:
+    """Encola una respuesta ya troceada para la Graph API (con límites de envío); un DeliveryResult por trozo."""
+    return outbound_scheduler.submit_parts(phone_number, parts, priority)
+
+
+async def run_odoo_crew_async(session_id: str, user_message: str, run_blocking: Callable[..., Awaitable],
+                              raise_errors: bool = False) -> str:
+    """crew_logic.run_odoo_crew_async; si el crew aún no está cargado se importa en un hilo, no en el loop."""
+    crew_logic = _crew_module or await asyncio.to_thread(_crew_logic)
+    return await crew_logic.run_odoo_crew_async(session_id, user_message, run_blocking, raise_errors=raise_errors)
+
+
+async def send_whatsapp_message_async(phone_number: str, message_text: str) -> List[DeliveryResult]:
+    """Entrega una respuesta interactiva desde el event loop (mismos límites de envío que la cola)."""
+    return await outbound_scheduler.send_async(phone_number, message_text)
+
+
+async def process_whatsapp_message(phone_number: str, user_message: str,
+                                   run_blocking: Callable[..., Awaitable]) -> List[DeliveryResult]:
+    """
+    Turno completo como corrutina y envío de la respuesta (o de la disculpa si el turno falla).
+    Solo el crew sale del loop, por 'run_blocking'; si el ejecutor está saturado se avisa al usuario.
+    """
+    log.info(f"Processing message from {_mask_phone(phone_number)}")
+
+    try:
+        result = await run_odoo_crew_async(phone_number, user_message, run_blocking)
+    except ExecutorSaturated:
+        return await send_whatsapp_message_async(phone_number, BUSY_MESSAGE)
+    except Exception as e:
+        log.error(f"CrewAI error: {type(e).__name__}", exc_info=True)
+        result = ERROR_MESSAGE
+    if not str(result).strip():
+        log.warning(f"Empty reply for {_mask_phone(phone_number)}; sending apology")
+        result = ERROR_MESSAGE
+    return await send_whatsapp_message_async(phone_number, str(result))